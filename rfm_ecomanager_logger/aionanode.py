@@ -0,0 +1,490 @@
+"""
+An asyncio client for a Nanode running rfm_edf_ecomanager, for embedding
+the receiver in an asyncio application without a thread per port.
+Requires Python 3.  Manager still uses the blocking Nanode (nanode.py).
+
+The serial port is put in non-blocking mode and read by the event loop
+(loop.add_reader).  Every method which talks to the Nanode returns a
+Future, commands are queued and sent one at a time, and packets which
+arrive while a command is in flight are kept rather than flushed away:
+
+    nanode = await aionanode.open_nanode('/dev/ttyUSB0')
+    await nanode.send_command('n', 99)   # NanodeError if the Nanode NAKs
+    await nanode.switch(55, 1, timeout=2)
+    async for data in nanode:            # protocol.Data with timecode set
+        ...
+    nanode.close()                       # ends the async for
+
+There are no abort flags: cancel the Future (or the task awaiting it)
+instead.  A command which doesn't complete within its timeout fails with
+asyncio.TimeoutError.  If the Nanode restarts, the command in flight fails
+with NanodeRestart, the init commands are re-sent and on_restart (if set)
+is called so the caller can re-send its transmitters.
+
+This module is written with Futures and callbacks, not async/await, so
+that the rest of the tree still compiles on Python 2.  Ports of the form
+"emulator:NAME" are connected to an emulated Nanode (see emulator.py).
+"""
+
+from __future__ import print_function, division
+import asyncio
+import collections
+import os
+import time
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+import serial
+import protocol
+from protocol import (NanodeError, NanodeRestart, STARTUP_SEQUENCE,
+                      ACK, NAK, EMULATOR_PREFIX)
+
+COMMAND_TIMEOUT = 1 # seconds; the blocking Nanode's serial timeout
+READ_SIZE = 4096 # bytes
+MAX_QUEUED_PACKETS = 1000
+MAX_RETRIES = 20
+MAX_ACCEPTABLE_LATENCY = 0.2 # in seconds
+MAX_ACCEPTABLE_DRIFT = 0.5 # in seconds
+TIME_OFFSET_UPDATE_PERIOD = 60*10 # in seconds
+
+
+def open_nanode(port, binary=False, time_correction=True, loop=None):
+    """Open port and send the init commands.
+
+    Returns:
+        Future of an AsyncNanode
+    """
+    loop = loop or asyncio.get_event_loop()
+    if port.startswith(EMULATOR_PREFIX):
+        import emulator # only needed for emulated ports
+        transport = emulator.socket_bridge(port)
+    else:
+        transport = serial.Serial(port=port, baudrate=115200, timeout=0)
+    nanode = AsyncNanode(transport, port, binary, time_correction, loop)
+    opened = loop.create_future()
+
+    def done(future):
+        if future.cancelled():
+            nanode.close()
+            opened.cancel()
+        elif future.exception() is not None:
+            nanode.close()
+            opened.set_exception(future.exception())
+        else:
+            opened.set_result(nanode)
+
+    nanode.init_nanode().add_done_callback(done)
+    return opened
+
+
+def _drive(generator, loop):
+    """Run a generator which yields Futures (and is sent their results)
+    as a Future which completes when the generator finishes.  Cancelling
+    that Future cancels the Future the generator is waiting on."""
+    finished = loop.create_future()
+    waiting = [None]
+
+    def step(value=None, error=None):
+        if finished.done():
+            return
+        try:
+            if error is not None:
+                future = generator.throw(error)
+            else:
+                future = generator.send(value)
+        except StopIteration:
+            finished.set_result(None)
+        except Exception as e:
+            finished.set_exception(e)
+        else:
+            waiting[0] = future
+            future.add_done_callback(wake)
+
+    def wake(future):
+        if future.cancelled():
+            step(error=asyncio.CancelledError())
+        elif future.exception() is not None:
+            step(error=future.exception())
+        else:
+            step(future.result())
+
+    def cancelled(future):
+        if future.cancelled():
+            generator.close()
+            if waiting[0] is not None:
+                waiting[0].cancel()
+
+    finished.add_done_callback(cancelled)
+    step()
+    return finished
+
+
+class _Command(object):
+    """A command waiting to be sent, or in flight."""
+
+    def __init__(self, cmd, param, timeout, future):
+        self.cmd = cmd
+        self.param = param
+        self.timeout = timeout
+        self.future = future
+        self.expect = None # ACK, "echo" or "time"
+        self.param_sent = False
+        self.timer = None
+        self.start_time = None
+
+
+class AsyncNanode(object):
+    """Talks to a Nanode over a non-blocking file-like transport (a
+    serial.Serial or a socket) through the event loop.  Use open_nanode()
+    rather than constructing one directly."""
+
+    def __init__(self, transport, port, binary=False, time_correction=True,
+                 loop=None):
+        self.port = port
+        self.binary = binary # ask for binary frames (see framing.py)?
+        self.time_correction = time_correction
+        self.loop = loop or asyncio.get_event_loop()
+        self.on_restart = None # called with self after the Nanode restarts
+        self._transport = transport
+        self._fd = transport.fileno()
+        os.set_blocking(self._fd, False)
+        self._parser = protocol.StreamParser()
+        self._commands = collections.deque()
+        self._command = None # the command in flight
+        self._write_buffer = bytearray()
+        self._packets = collections.deque(maxlen=MAX_QUEUED_PACKETS)
+        self._packet_waiter = None
+        self._banner = 0 # startup banner lines seen so far
+        self._time_offset = None
+        self._last_nanode_time = 0
+        self._sync_handle = None
+        self._error = None
+        self.closed = False
+        self.loop.add_reader(self._fd, self._on_readable)
+
+    # Commands
+
+    def init_nanode(self):
+        """Send the init commands and set the time offset.
+
+        Returns:
+            Future
+        """
+        return _drive(self._init_nanode(), self.loop)
+
+    def _init_nanode(self):
+        log.info("Sending init commands to Nanode on {}...".format(self.port))
+        self._parser.binary = False # the Nanode always starts up printing JSON
+        self._time_offset = None
+        self._last_nanode_time = 0
+        try:
+            yield self.send_command("v", 4) # don't show any debug log messages
+        except NanodeRestart:
+            raise
+        except NanodeError:
+            pass # if Nanode code was compiled without LOGGING
+        yield self.send_command("m") # manual pairing mode
+        yield self.send_command("k") # only print data from known transmitters
+        if self.binary:
+            try:
+                yield self.send_command("b")
+            except NanodeRestart:
+                raise
+            except NanodeError:
+                log.info("Nanode on {} doesn't support binary frames. "
+                         "Using JSON.".format(self.port))
+            else:
+                log.info("Nanode on {} is sending binary frames."
+                         .format(self.port))
+        if self.time_correction:
+            yield self.sync_time()
+
+    def send_command(self, cmd, param=None, timeout=COMMAND_TIMEOUT):
+        """Send cmd, and param if given, and wait for the Nanode's ACK.
+
+        Returns:
+            Future which fails with NanodeError if the Nanode NAKs or
+            echoes param incorrectly, or asyncio.TimeoutError
+        """
+        return self._queue(_Command(str(cmd), None if param is None
+                                    else str(param), timeout,
+                                    self.loop.create_future()))
+
+    def pair(self, tx_id, timeout=COMMAND_TIMEOUT):
+        """Pair with the TRX tx_id, which has sent a pairing request."""
+        return self.send_command("p", tx_id, timeout)
+
+    def switch(self, tx_id, state, timeout=COMMAND_TIMEOUT):
+        """Switch the TRX tx_id off (state 0) or on (state 1)."""
+        return self.send_command("{:d}".format(state), tx_id, timeout)
+
+    def get_time(self, timeout=COMMAND_TIMEOUT):
+        """Ask the Nanode for the number of milliseconds since it started.
+
+        Returns:
+            Future of (start_time, nanode_time, end_time): UNIX times
+            immediately before asking and after receiving the answer
+        """
+        return self._queue(_Command("t", None, timeout,
+                                    self.loop.create_future()))
+
+    def sync_time(self):
+        """Update the offset between the Nanode's clock and UNIX time,
+        retrying while the round trip takes too long.  Also scheduled
+        every TIME_OFFSET_UPDATE_PERIOD seconds.
+
+        Returns:
+            Future
+        """
+        return _drive(self._sync_time(), self.loop)
+
+    def _sync_time(self):
+        for retry in range(MAX_RETRIES):
+            times = self.get_time()
+            yield times
+            start_time, nanode_time, end_time = times.result()
+            latency = end_time - start_time
+            if latency >= MAX_ACCEPTABLE_LATENCY:
+                log.debug("Latency {} too high".format(latency))
+                continue
+            # Nanode sends time 10ms after receipt of the 't' command
+            new_time_offset = ((start_time + end_time) / 2) - (nanode_time / 1000)
+            if (self._time_offset is not None and
+                nanode_time >= self._last_nanode_time and
+                abs(new_time_offset - self._time_offset) > MAX_ACCEPTABLE_DRIFT):
+                log.debug("new_time_offset is too dissimilar to self._time_offset")
+                continue
+            log.debug("Updated time_offset to {}".format(new_time_offset))
+            self._time_offset = new_time_offset
+            self._last_nanode_time = nanode_time
+            break
+        else:
+            raise NanodeError("Failed to set the time offset after {} retries"
+                              .format(MAX_RETRIES))
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+        self._sync_handle = self.loop.call_later(TIME_OFFSET_UPDATE_PERIOD,
+                                                 self._scheduled_sync)
+
+    def _scheduled_sync(self):
+        self._sync_handle = None
+        if not self.closed:
+            self.sync_time().add_done_callback(self._log_sync_failure)
+
+    def _log_sync_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.warning("Failed to update time offset for {}: {}"
+                        .format(self.port, future.exception()))
+
+    def _queue(self, command):
+        if self.closed:
+            command.future.set_exception(self._error or
+                                         NanodeError("Nanode is closed"))
+            return command.future
+        command.future.add_done_callback(
+            lambda future: self._command_done(command))
+        self._commands.append(command)
+        self._send_next()
+        return command.future
+
+    def _send_next(self):
+        while self._command is None and self._commands:
+            command = self._commands.popleft()
+            if command.future.done(): # cancelled while queued
+                continue
+            log.debug("send_command(cmd={}, param={})"
+                      .format(command.cmd, command.param))
+            self._command = command
+            command.expect = "time" if command.cmd == "t" else ACK
+            command.timer = self.loop.call_later(command.timeout,
+                                                 self._command_timed_out,
+                                                 command)
+            command.start_time = time.time()
+            self._write(command.cmd)
+
+    def _command_timed_out(self, command):
+        if not command.future.done():
+            command.future.set_exception(asyncio.TimeoutError(
+                "No response to {} {} from {}".format(command.cmd,
+                                                      command.param or "",
+                                                      self.port)))
+
+    def _command_done(self, command):
+        """Called however command finishes: answered, timed out or
+        cancelled."""
+        if command.timer is not None:
+            command.timer.cancel()
+        if self._command is command:
+            self._command = None
+            self.loop.call_soon(self._send_next)
+
+    def _handle_response(self, line):
+        command = self._command
+        if command is None or command.future.done():
+            log.debug("Unexpected line from {}: {}".format(self.port, line))
+            return
+        if command.expect == "time":
+            try:
+                nanode_time = int(line)
+            except ValueError:
+                log.debug("Expected time from {}, got {}".format(self.port, line))
+                return
+            command.future.set_result((command.start_time, nanode_time,
+                                       time.time()))
+        elif command.expect == "echo":
+            if line == command.param:
+                command.expect = ACK
+            else:
+                command.future.set_exception(NanodeError(
+                    "Attempted to send command {} {}, received incorrect "
+                    "echo: {}".format(command.cmd, command.param, line)))
+        elif line.split()[0] == NAK:
+            command.future.set_exception(NanodeError(line))
+        elif line.split()[0] == ACK:
+            if command.param is not None and not command.param_sent:
+                command.param_sent = True
+                command.expect = "echo"
+                self._write(command.param + "\r")
+            elif command.cmd == "b":
+                self._parser.binary = True
+                command.future.set_result(None)
+            else:
+                command.future.set_result(None)
+
+    # Reading
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._lost(NanodeError("Can't read from {}: {}".format(self.port, e)))
+            return
+        if not data:
+            self._lost(NanodeError("{} has closed".format(self.port)))
+            return
+        for item in self._parser.parse(data):
+            if isinstance(item, dict):
+                self._handle_packet(item)
+                continue
+            record = protocol.parse_line(item)
+            if record is not None:
+                self._handle_packet(record)
+            elif item in STARTUP_SEQUENCE:
+                self._handle_banner(item)
+            else:
+                self._handle_response(item)
+
+    def _handle_banner(self, line):
+        i = STARTUP_SEQUENCE.index(line)
+        self._banner = self._banner + 1 if i == self._banner else int(i == 0)
+        if self._banner < len(STARTUP_SEQUENCE):
+            return
+        log.info("Nanode on {} has restarted".format(self.port))
+        self._banner = 0
+        self._parser.binary = False
+        self._packets.clear()
+        for command in [self._command] + list(self._commands):
+            if command is not None and not command.future.done():
+                command.future.set_exception(NanodeRestart())
+        self.init_nanode().add_done_callback(self._restarted)
+
+    def _restarted(self, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            log.error("Failed to re-initialise Nanode on {}: {}"
+                      .format(self.port, future.exception()))
+        elif self.on_restart is not None:
+            self.on_restart(self)
+
+    def _handle_packet(self, record):
+        t = time.time()
+        data = protocol.to_data(record)
+        if data.pair_ack or data.is_pairing_request:
+            data.timecode = int(round(t))
+        elif self.time_correction and self._time_offset is not None:
+            nanode_time = data.nanode_time
+            if nanode_time < self._last_nanode_time: # roll-over of Nanode's clock
+                log.info("Roll-over detected")
+                nanode_time += 2**32
+                self._schedule_sync_now()
+            self._last_nanode_time = nanode_time
+            data.timecode = int(round(self._time_offset + nanode_time / 1000))
+        else:
+            data.timecode = int(round(t))
+        log.debug("LINE: {}".format(record))
+        waiter, self._packet_waiter = self._packet_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+        else:
+            self._packets.append(data)
+
+    def _schedule_sync_now(self):
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = self.loop.call_soon(self._scheduled_sync)
+
+    # Writing
+
+    def _write(self, text):
+        self._write_buffer += text.encode('ascii')
+        self._flush_writes()
+
+    def _flush_writes(self):
+        try:
+            n = os.write(self._fd, self._write_buffer)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            self._lost(NanodeError("Can't write to {}: {}".format(self.port, e)))
+            return
+        del self._write_buffer[:n]
+        if self._write_buffer:
+            self.loop.add_writer(self._fd, self._flush_writes)
+        else:
+            self.loop.remove_writer(self._fd)
+
+    # Iteration
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        """Returns a Future of the next packet (protocol.Data)."""
+        future = self.loop.create_future()
+        if self._packets:
+            future.set_result(self._packets.popleft())
+        elif self.closed:
+            if self._error is not None:
+                future.set_exception(self._error)
+            else:
+                future.set_exception(StopAsyncIteration())
+        else:
+            if self._packet_waiter is not None:
+                self._packet_waiter.cancel()
+            self._packet_waiter = future
+        return future
+
+    def _lost(self, error):
+        log.error(str(error))
+        self._error = error
+        self.close()
+
+    def close(self):
+        """Stop reading, fail outstanding commands and end iteration."""
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self._fd)
+        self.loop.remove_writer(self._fd)
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+        for command in [self._command] + list(self._commands):
+            if command is not None and not command.future.done():
+                command.future.set_exception(self._error or
+                                             NanodeError("Nanode is closed"))
+        waiter, self._packet_waiter = self._packet_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(self._error or StopAsyncIteration())
+        self._transport.close()
@@ -0,0 +1,176 @@
+"""
+Resample several channels onto a common time grid, producing one row per
+grid tick and one column per channel.  Used by merge_datasets.py --aligned.
+
+Channels are read in blocks and the grid is built CHUNK_TICKS rows at a
+time, so memory use doesn't depend on the length of the dataset.  Each
+channel's samples are joined onto the grid with NumPy:
+
+    ffill  each tick takes the most recent sample at or before it, unless
+           that sample is more than max_gap seconds old (then NaN)
+    mean   each tick takes the mean of the samples in [tick, tick + period)
+           (NaN if there are none)
+
+Example:
+
+    import align
+    streams = [align.ChannelStream('/data/channel_1.dat'),
+               align.ChannelStream('/data/channel_2.dat')]
+    for grid, matrix in align.align(streams, start, end, period=6):
+        ...
+"""
+
+from __future__ import print_function, division
+import os
+import numpy as np
+import reader
+
+FFILL = 'ffill'
+MEAN = 'mean'
+METHODS = [FFILL, MEAN]
+DEFAULT_PERIOD = 6 # seconds; about the interval between packets from a TX
+DEFAULT_MAX_GAP = 60 # seconds
+BLOCK_SIZE = 2**20 # bytes read from each channel file at a time
+CHUNK_TICKS = 2**16 # grid rows computed at a time
+CSV_FORMAT = '%.7g'
+
+
+class ChannelStream(object):
+    """Reads a channel_N.dat file in blocks, in time order.  A missing
+    file is treated as an empty channel."""
+
+    def __init__(self, filename, block_size=BLOCK_SIZE):
+        self.filename = filename
+        self.block_size = block_size
+        self._file = open(filename, 'rb') if os.path.exists(filename) else None
+        self._remainder = ''
+        self._timestamps = np.empty(0)
+        self._watts = np.empty(0)
+
+    def read_until(self, t):
+        """Returns (timestamps, watts) for all unread samples before t."""
+        while self._file is not None and (len(self._timestamps) == 0 or
+                                          self._timestamps[-1] < t):
+            self._read_block()
+        i = np.searchsorted(self._timestamps, t, side='left')
+        timestamps, self._timestamps = (self._timestamps[:i],
+                                        self._timestamps[i:])
+        watts, self._watts = self._watts[:i], self._watts[i:]
+        return timestamps, watts
+
+    def _read_block(self):
+        block = self._file.read(self.block_size)
+        if not block:
+            # Any remainder is a truncated final line
+            self._file.close()
+            self._file = None
+            return
+        text = self._remainder + block
+        end = text.rfind('\n') + 1
+        self._remainder = text[end:]
+        timestamps, watts, dummy = reader.parse_text(text[:end])
+        self._timestamps = np.concatenate([self._timestamps, timestamps])
+        self._watts = np.concatenate([self._watts, watts])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def grid_start(first_timestamp, period):
+    """Grid ticks are whole multiples of period in UNIX time."""
+    return np.floor(first_timestamp / period) * period
+
+
+def n_ticks(start, end, period):
+    return int((end - start) // period) + 1
+
+
+def align(streams, start, end, period=DEFAULT_PERIOD, method=FFILL,
+          max_gap=DEFAULT_MAX_GAP, chunk_ticks=CHUNK_TICKS):
+    """Join streams onto the grid start, start + period, ... <= end.
+
+    Args:
+        streams (list of ChannelStreams): one per column
+        max_gap (float): for ffill. None means no limit.
+
+    Yields:
+        (grid, matrix): grid is an array of chunk_ticks (or fewer) tick
+        timestamps and matrix has one row per tick and one column per stream
+    """
+    if method not in METHODS:
+        raise ValueError("method must be one of {}".format(METHODS))
+    # The last sample read from each stream, carried into the next chunk
+    last = [(None, np.nan)] * len(streams)
+    total = n_ticks(start, end, period)
+    for first in range(0, total, chunk_ticks):
+        grid = start + period * np.arange(first, min(first + chunk_ticks, total))
+        matrix = np.full((len(grid), len(streams)), np.nan)
+        for column, stream in enumerate(streams):
+            timestamps, watts = stream.read_until(grid[-1] + period)
+            if method == FFILL:
+                if last[column][0] is not None:
+                    timestamps = np.concatenate([[last[column][0]], timestamps])
+                    watts = np.concatenate([[last[column][1]], watts])
+                if len(timestamps):
+                    last[column] = (timestamps[-1], watts[-1])
+                    i = np.searchsorted(timestamps, grid, side='right') - 1
+                    valid = i >= 0
+                    if max_gap is not None:
+                        valid[valid] = (grid[valid] - timestamps[i[valid]]
+                                        <= max_gap)
+                    matrix[valid, column] = watts[i[valid]]
+            else:
+                bins = np.floor((timestamps - grid[0]) / period).astype(int)
+                keep = (bins >= 0) & (bins < len(grid))
+                counts = np.bincount(bins[keep], minlength=len(grid))
+                sums = np.bincount(bins[keep], weights=watts[keep],
+                                   minlength=len(grid))
+                has_data = counts > 0
+                matrix[has_data, column] = sums[has_data] / counts[has_data]
+        yield grid, matrix
+
+
+def write_aligned(filename, labels, chunks, total):
+    """Write aligned chunks to filename: CSV, or a .npy file which loads
+    with np.load() as a single float64 array.  Column 0 is the timestamp
+    and the others are in the order of labels.
+
+    Args:
+        labels (list of str): column names, written as the CSV header
+        chunks: from align()
+        total (int): number of rows, needed for the .npy header
+    """
+    with open(filename, 'wb') as fh:
+        if filename.endswith('.npy'):
+            np.lib.format.write_array_header_1_0(
+                fh, {'descr': '<f8', 'fortran_order': False,
+                     'shape': (total, len(labels) + 1)})
+            for grid, matrix in chunks:
+                np.column_stack([grid, matrix]).astype('<f8').tofile(fh)
+        else:
+            fh.write(','.join(['timestamp'] + labels) + '\n')
+            for grid, matrix in chunks:
+                np.savetxt(fh, np.column_stack([grid, matrix]), delimiter=',',
+                           fmt=['%.3f'] + [CSV_FORMAT] * len(labels))
+
+
+def align_data_dir(data_dir, filename, channels, start, end,
+                   period=DEFAULT_PERIOD, method=FFILL, max_gap=DEFAULT_MAX_GAP):
+    """Write an aligned table of data_dir's channel_N.dat files.
+
+    Args:
+        channels (list of (int, str)): (channel, label) for each column
+    """
+    start = grid_start(start, period)
+    streams = [ChannelStream(os.path.join(data_dir,
+                                          'channel_{:d}.dat'.format(channel)))
+               for channel, dummy in channels]
+    try:
+        write_aligned(filename, [label for dummy, label in channels],
+                      align(streams, start, end, period, method, max_gap),
+                      n_ticks(start, end, period))
+    finally:
+        for stream in streams:
+            stream.close()
@@ -0,0 +1,500 @@
+#!/usr/bin/python
+"""
+Edit transmitters while the logger is running.
+
+If started with --control-socket, the logger listens on a Unix socket
+(default rfm_ecomanager_logger.sock next to radioIDs.pkl).  Run this file
+to send it commands which mirror the --edit menu:
+
+    control.py list
+    control.py listen [--duration 30] [--promiscuous]
+    control.py pair RF_ID NAME [--log-chan N] [--base-unit PORT]
+    control.py add TX|TRX RF_ID NAME [SENSOR_ID=NAME...] [--base-unit PORT]
+    control.py rename LOG_CHAN NAME [--log-chan N] [--agg | --iam]
+    control.py delete LOG_CHAN
+    control.py switch LOG_CHAN on|off
+    control.py base-unit LOG_CHAN PORT
+
+Commands run inside the logger: anything which talks to a Nanode is run by
+that base unit's thread between packets, so logging carries on throughout.
+
+The protocol is one line of JSON each way.  A request is an object with a
+"command" and its arguments; the response is {"ok": true, "result": ...}
+or {"ok": false, "error": "..."}.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import json
+import socket
+import threading
+import time
+import inspect
+import Queue
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from transmitter import Cc_tx, Cc_trx, TransmitterError
+from sensor import Sensor
+from nanode import NanodeError
+
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+DEFAULT_SOCKET = os.path.realpath(os.path.join(FILE_PATH, "..",
+                                               "rfm_ecomanager_logger.sock"))
+PAIR_TIMEOUT = 5 # seconds
+MAX_LISTEN_DURATION = 300 # seconds
+
+
+class ControlError(Exception):
+    """For invalid control requests."""
+
+
+class Controller(object):
+    """Runs control commands against a logging Manager.  Commands which
+    change the registry are serialised by a lock."""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self._lock = threading.Lock()
+
+    def execute(self, request):
+        """
+        Args:
+            request (dict): "command" plus keyword arguments
+
+        Returns:
+            response (dict)
+        """
+        try:
+            command = request.pop('command')
+            method = getattr(self, 'cmd_' + str(command).replace('-', '_'), None)
+            if method is None:
+                raise ControlError("Unknown command '{}'".format(command))
+            if command in ['list', 'listen']:
+                result = method(**request)
+            else:
+                with self._lock:
+                    result = method(**request)
+        except (ControlError, TransmitterError, NanodeError, EnvironmentError,
+                ValueError, TypeError, KeyError) as e:
+            return {'ok': False, 'error': str(e)}
+        return {'ok': True, 'result': result}
+
+    def cmd_list(self):
+        transmitters = []
+        for tx_id, tx in sorted(self.manager.transmitters.iteritems()):
+            transmitters.append({
+                'id': tx_id, 'type': tx.TYPE, 'base_unit': tx.base_unit,
+                'state': tx.state if isinstance(tx, Cc_trx) else None,
+                'sensors': [{'sensor_id': s_id, 'log_chan': sensor.log_chan,
+                             'name': sensor.name, 'agg_chan': sensor.agg_chan}
+                            for s_id, sensor in sorted(tx.sensors.iteritems())]})
+        return transmitters
+
+    def cmd_listen(self, duration=30, promiscuous=False):
+        """Report pairing requests and unknown transmitters heard within
+        duration seconds.  In promiscuous mode the Nanodes are asked to
+        pass on packets from every transmitter, not just known ones."""
+        duration = min(float(duration), MAX_LISTEN_DURATION)
+        heard = {}
+        def listener(nanode, data):
+            if data.pair_ack:
+                return
+            heard[data.tx_id] = {'id': data.tx_id, 'type': data.tx_type,
+                                 'base_unit': nanode.port,
+                                 'pairing_request': data.is_pairing_request,
+                                 'sensors': getattr(data, 'sensors', None)}
+        self.manager.add_listener(listener)
+        try:
+            if promiscuous:
+                self._send_to_all_base_units("u")
+            try:
+                time.sleep(duration)
+            finally:
+                if promiscuous:
+                    self._send_to_all_base_units("k")
+        finally:
+            self.manager.remove_listener(listener)
+        return sorted(heard.values(), key=lambda tx: tx['id'])
+
+    def cmd_pair(self, rf_id, name, log_chan=None, base_unit=None):
+        """Accept a pairing request from an IAM."""
+        rf_id = int(rf_id)
+        self._check_unknown(rf_id)
+        port = self._base_unit(base_unit)
+        acks = Queue.Queue()
+        def listener(nanode, data):
+            if data.pair_ack and data.tx_id == rf_id:
+                acks.put(data)
+        self.manager.add_listener(listener)
+        try:
+            self.manager.call_on_base_unit(
+                port, lambda nanode: nanode.send_command("p", rf_id))
+            try:
+                ack = acks.get(timeout=PAIR_TIMEOUT)
+            except Queue.Empty:
+                raise ControlError("No pair acknowledgement from {}".format(rf_id))
+        finally:
+            self.manager.remove_listener(listener)
+        tx_class = Cc_tx if (ack.tx_type or "").lower() == "tx" else Cc_trx
+        tx = self._new_transmitter(tx_class, rf_id, port, {1: name}, log_chan)
+        self._save_with(tx)
+        return self._describe(tx)
+
+    def cmd_add(self, tx_type, rf_id, sensors, base_unit=None):
+        """Manually add a transmitter.
+
+        Args:
+            tx_type (str): "TX" or "TRX"
+            rf_id (int)
+            sensors (dict): maps sensor ID to name.  TRXs have one sensor.
+        """
+        rf_id = int(rf_id)
+        self._check_unknown(rf_id)
+        tx_type = tx_type.upper()
+        if tx_type not in ["TX", "TRX"]:
+            raise ControlError("'{}' is not TX or TRX".format(tx_type))
+        sensors = dict((int(s_id), name) for s_id, name in sensors.iteritems())
+        tx_class = Cc_tx if tx_type == "TX" else Cc_trx
+        if tx_class is Cc_tx:
+            invalid = set(sensors) - set(Cc_tx.VALID_SENSOR_IDS)
+            if invalid or not sensors:
+                raise ControlError("TX sensor IDs must be in {}"
+                                   .format(Cc_tx.VALID_SENSOR_IDS))
+        elif sensors.keys() != [1]:
+            raise ControlError("A TRX has exactly one sensor, with ID 1")
+        port = self._base_unit(base_unit)
+        tx = self._new_transmitter(tx_class, rf_id, port, sensors)
+        self.manager.call_on_base_unit(
+            port, lambda nanode: nanode.send_command(tx.ADD_COMMAND, rf_id))
+        self._save_with(tx)
+        return self._describe(tx)
+
+    def cmd_rename(self, log_chan, name, new_log_chan=None, agg_chan=None):
+        tx, sensor = self._find(log_chan)
+        if new_log_chan is not None:
+            new_log_chan = int(new_log_chan)
+        # Sensors' rollups are only touched by their base unit's thread
+        def rename(nanode):
+            if new_log_chan is not None and new_log_chan != sensor.log_chan:
+                # configure() starts new rollups and events for the new
+                # channel, so write out everything held for the old one
+                sensor.flush_rollups()
+            sensor.configure(tx, name, new_log_chan, agg_chan)
+        self._call_for(tx, rename)
+        self.manager.save_registry(dict(self.manager.transmitters))
+        return self._describe(tx)
+
+    def cmd_delete(self, log_chan):
+        tx, dummy = self._find(log_chan)
+        def delete(nanode):
+            if nanode is not None:
+                tx.delete_from_nanode()
+            for sensor in tx.sensors.itervalues():
+                sensor.flush_rollups()
+        self._call_for(tx, delete)
+        transmitters = dict(self.manager.transmitters)
+        del transmitters[tx.id]
+        self.manager.save_registry(transmitters)
+        return self._describe(tx)
+
+    def cmd_switch(self, log_chan, state):
+        tx, dummy = self._find(log_chan)
+        if not isinstance(tx, Cc_trx):
+            raise ControlError("{} is a TX not a TRX. We can't switch TXs."
+                               .format(tx.id))
+        state = {'on': 1, 'off': 0}.get(str(state).lower(), state)
+        if state not in [0, 1]:
+            raise ControlError("State must be on or off")
+        if tx.nanode is None:
+            raise ControlError("Base unit {} is not open".format(tx.base_unit))
+        self.manager.call_on_base_unit(tx.base_unit, lambda nanode: tx.switch(state))
+        self.manager.switch_back.cancel(tx) # the user knows best
+        tx.state = state
+        self.manager.save_registry(dict(self.manager.transmitters))
+        return self._describe(tx)
+
+    def cmd_base_unit(self, log_chan, port):
+        tx, dummy = self._find(log_chan)
+        port = self._base_unit(port)
+        if port == tx.base_unit:
+            return self._describe(tx)
+        if tx.nanode is not None:
+            self.manager.call_on_base_unit(tx.base_unit,
+                                           lambda nanode: tx.delete_from_nanode())
+        def move(nanode):
+            tx.base_unit = port
+            tx.add_to_nanode()
+        self.manager.call_on_base_unit(port, move)
+        self.manager.save_registry(dict(self.manager.transmitters))
+        return self._describe(tx)
+
+    def _send_to_all_base_units(self, command):
+        for port in self.manager.nanodes:
+            self.manager.call_on_base_unit(
+                port, lambda nanode: nanode.send_command(command))
+
+    def _check_unknown(self, rf_id):
+        if rf_id in self.manager.transmitters:
+            raise ControlError("Transmitter {} is already known ({})"
+                               .format(rf_id, self.manager.transmitters[rf_id]
+                                       .print_names()))
+
+    def _base_unit(self, port):
+        if port is None:
+            return self.manager.nanode.port
+        if port not in self.manager.nanodes:
+            raise ControlError("Unknown base unit {}. Open base units: {}"
+                               .format(port, ", ".join(sorted(self.manager.nanodes))))
+        return port
+
+    def _find(self, log_chan):
+        log_chan = int(log_chan)
+        for tx in self.manager.transmitters.itervalues():
+            for sensor in tx.sensors.itervalues():
+                if sensor.log_chan == log_chan:
+                    return tx, sensor
+        raise ControlError("No sensor is logged to channel {}".format(log_chan))
+
+    def _call_for(self, tx, func):
+        """Run func on tx's base unit thread, or here if that base unit
+        isn't open (in which case nothing is logging tx)."""
+        if tx.nanode is None:
+            func(None)
+        else:
+            self.manager.call_on_base_unit(tx.base_unit, func)
+
+    def _new_transmitter(self, tx_class, rf_id, port, sensors, log_chan=None):
+        tx = tx_class(rf_id, self.manager)
+        tx.base_unit = port
+        next_log_chan = self.manager.next_free_log_chan()
+        for s_id, name in sorted(sensors.iteritems()):
+            tx.sensors[s_id] = Sensor()
+            if log_chan is None:
+                tx.sensors[s_id].configure(tx, name, next_log_chan)
+                next_log_chan += 1
+            else:
+                tx.sensors[s_id].configure(tx, name, int(log_chan))
+        return tx
+
+    def _save_with(self, tx):
+        transmitters = dict(self.manager.transmitters)
+        transmitters[tx.id] = tx
+        self.manager.save_registry(transmitters)
+
+    def _describe(self, tx):
+        return "{} {} ({}) on {}".format(tx.TYPE, tx.id, tx.print_names(),
+                                         tx.base_unit)
+
+
+class ControlServer(object):
+    """Accepts connections on a Unix socket, one thread per connection."""
+
+    def __init__(self, path, controller):
+        self.path = path
+        self.controller = controller
+        if os.path.exists(path):
+            if _is_listening(path):
+                raise ControlError("Another logger is listening on {}"
+                                   .format(path))
+            os.remove(path) # left behind by a logger which crashed
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        os.chmod(path, 0o600)
+        self._socket.listen(5)
+        self._thread = None
+        self._stop = False
+
+    def start(self):
+        log.info("Listening for control commands on {}".format(self.path))
+        self._thread = threading.Thread(target=self._run, name="control")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop = True
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _run(self):
+        while not self._stop:
+            try:
+                connection, dummy = self._socket.accept()
+            except socket.error:
+                if self._stop:
+                    break
+                raise
+            thread = threading.Thread(target=self._handle, args=(connection,),
+                                      name="control-connection")
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, connection):
+        try:
+            try:
+                reply = json.dumps(self._respond(
+                    connection.makefile('r').readline()))
+            except Exception as e:
+                # Always reply, so the client isn't left with nothing to parse
+                log.exception("Control command failed")
+                reply = json.dumps({'ok': False, 'error': "{}: {}".format(
+                    type(e).__name__, e)})
+            connection.sendall(reply + "\n")
+        except Exception:
+            log.exception("Control connection failed")
+        finally:
+            connection.close()
+
+    def _respond(self, line):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+        except ValueError as e:
+            return {'ok': False, 'error': "Bad request: {}".format(e)}
+        log.info("Control command: {}".format(line.strip()))
+        return self.controller.execute(request)
+
+
+def _is_listening(path):
+    """Returns True if something accepts connections on the Unix socket
+    at path."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        return False
+    else:
+        return True
+    finally:
+        connection.close()
+
+
+def send(request, path=DEFAULT_SOCKET, timeout=None):
+    """Send one request to a running logger and return its response."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    connection.connect(path)
+    try:
+        connection.sendall(json.dumps(request) + "\n")
+        line = connection.makefile('r').readline()
+    finally:
+        connection.close()
+    if not line:
+        raise ControlError("The logger closed the connection without replying")
+    return json.loads(line)
+
+
+def print_transmitters(transmitters):
+    print("{:>8}{:>12}{:>6}{:>4}{:>8}{:>5}  {:20}{}"
+          .format("LOG_CHAN", "RF_ID", "TYPE", "ON", "SENSOR", "IAM?",
+                  "NAME", "BASE UNIT"))
+    rows = []
+    for tx in transmitters:
+        for sensor in tx['sensors']:
+            rows.append((sensor['log_chan'], tx, sensor))
+    for log_chan, tx, sensor in sorted(rows):
+        print("{:>8d}{:>12d}{:>6}{:>4}{:>8d}{:>5}  {:20}{}"
+              .format(log_chan, tx['id'], tx['type'],
+                      "?" if tx['state'] is None else tx['state'],
+                      sensor['sensor_id'], "agg" if sensor['agg_chan'] else "iam",
+                      sensor['name'], tx['base_unit']))
+
+
+def setup_argparser():
+    parser = argparse.ArgumentParser(description="Edit transmitters while"
+                                     " rfm_ecomanager_logger is running.")
+    parser.add_argument('--socket', dest='socket', default=DEFAULT_SOCKET,
+                        help='control socket (default: {})'.format(DEFAULT_SOCKET))
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('list', help='list all known transmitters')
+
+    listen = commands.add_parser('listen', help='listen for pairing requests'
+                                 ' and unknown transmitters')
+    listen.add_argument('--duration', type=float, default=30)
+    listen.add_argument('--promiscuous', action='store_true',
+                        help='ask the Nanodes to pass on every transmitter')
+
+    pair = commands.add_parser('pair', help='accept a pairing request')
+    pair.add_argument('rf_id', type=int)
+    pair.add_argument('name')
+    pair.add_argument('--log-chan', dest='log_chan', type=int)
+    pair.add_argument('--base-unit', dest='base_unit')
+
+    add = commands.add_parser('add', help='manually add a transmitter')
+    add.add_argument('tx_type', choices=['TX', 'TRX', 'tx', 'trx'])
+    add.add_argument('rf_id', type=int)
+    add.add_argument('sensors', nargs='+', metavar='NAME | SENSOR_ID=NAME')
+    add.add_argument('--base-unit', dest='base_unit')
+
+    rename = commands.add_parser('rename', help='rename a sensor or change'
+                                 ' its log channel')
+    rename.add_argument('log_chan', type=int)
+    rename.add_argument('name')
+    rename.add_argument('--log-chan', dest='new_log_chan', type=int)
+    agg = rename.add_mutually_exclusive_group()
+    agg.add_argument('--agg', dest='agg_chan', action='store_const', const=True)
+    agg.add_argument('--iam', dest='agg_chan', action='store_const', const=False)
+
+    delete = commands.add_parser('delete', help='delete a transmitter')
+    delete.add_argument('log_chan', type=int)
+
+    switch = commands.add_parser('switch', help='switch a TRX on or off')
+    switch.add_argument('log_chan', type=int)
+    switch.add_argument('state', choices=['on', 'off'])
+
+    base_unit = commands.add_parser('base-unit', help='assign a transmitter'
+                                    ' to a base unit')
+    base_unit.add_argument('log_chan', type=int)
+    base_unit.add_argument('port')
+
+    return parser.parse_args()
+
+
+def main():
+    args = setup_argparser()
+    request = vars(args).copy()
+    del request['socket']
+    if args.command == 'add':
+        sensors = {}
+        for i, sensor in enumerate(args.sensors):
+            s_id, _, name = sensor.rpartition('=')
+            sensors[s_id or str(i + 1)] = name
+        request['sensors'] = sensors
+    request = dict((key, value) for key, value in request.iteritems()
+                   if value is not None)
+
+    try:
+        response = send(request, args.socket)
+    except socket.error as e:
+        print("ERROR: can't connect to {} ({}). Is the logger running?"
+              .format(args.socket, e), file=sys.stderr)
+        return 1
+    except ControlError as e:
+        print("ERROR:", e, file=sys.stderr)
+        return 1
+    if not response['ok']:
+        print("ERROR:", response['error'], file=sys.stderr)
+        return 1
+
+    result = response['result']
+    if args.command == 'list':
+        print_transmitters(result)
+    elif args.command == 'listen':
+        if not result:
+            print("No transmitter heard")
+        for tx in result:
+            print("{} {} on {}: {}".format(
+                tx['type'], tx['id'], tx['base_unit'],
+                "pair request" if tx['pairing_request']
+                else "sensors {}".format(tx['sensors'])))
+    else:
+        print(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+Per-channel coverage index: a bitmap with one bit per minute which is set
+if the channel has at least one sample in that minute.  Used to measure
+true uptime, counting gaps inside runs (a crashed Nanode, a dead TX battery,
+a lost USB connection), which the span from first to last sample hides.
+
+The logger keeps channel_N.cov up to date in the data directory as it logs
+(see Sensor.log_data_to_disk).  For existing data, build() scans a
+channel_N.dat file in blocks with NumPy.  Bitmaps from several datasets
+are merged with a bitwise OR (see merge_datasets.py).
+
+File layout (little-endian):
+
+    magic    4 bytes, "RFCV"
+    origin   uint32, the UNIX minute of bit 0 (a multiple of 8)
+    bits     one bit per minute from origin, most significant bit first
+
+Origins are multiples of 8 so that the bytes of any two bitmaps line up
+and can be ORed without shifting.
+
+Example:
+
+    import coverage_index
+    cov = coverage_index.load('/data/house_1/channel_1.cov')
+    print(cov.n_minutes(), cov.gaps(min_minutes=10))
+"""
+
+from __future__ import print_function, division
+import os
+import struct
+import numpy as np
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+import reader
+
+MAGIC = b"RFCV"
+HEADER = struct.Struct("<4sI")
+MINUTE = 60 # seconds
+BLOCK_SIZE = 2**22 # bytes of channel_N.dat read at a time by build()
+
+
+class CoverageError(Exception):
+    """For unreadable coverage files."""
+
+
+def coverage_filename(data_filename):
+    return os.path.splitext(data_filename)[0] + '.cov'
+
+
+class Coverage(object):
+    """
+    Attributes:
+        origin (int): UNIX minute of the first bit, a multiple of 8
+        bits (np.ndarray of uint8): packed bits, most significant first
+    """
+
+    def __init__(self, origin=0, bits=None):
+        self.origin = origin
+        self.bits = np.zeros(0, dtype=np.uint8) if bits is None else bits
+
+    @classmethod
+    def from_timestamps(cls, timestamps):
+        """Returns a Coverage of timestamps (UNIX seconds)."""
+        coverage = cls()
+        coverage.add_timestamps(timestamps)
+        return coverage
+
+    def add_timestamps(self, timestamps):
+        minutes = np.floor_divide(np.asarray(timestamps, dtype=np.int64), MINUTE)
+        if len(minutes) == 0:
+            return
+        self._extend(int(minutes.min()), int(minutes.max()))
+        offsets = minutes - self.origin
+        np.bitwise_or.at(self.bits, offsets // 8,
+                         (0x80 >> (offsets % 8)).astype(np.uint8))
+
+    def add(self, timestamp):
+        """Set the bit for timestamp.  Returns the index of the byte
+        which changed, or None if the bit was already set."""
+        minute = int(timestamp) // MINUTE
+        self._extend(minute, minute)
+        i, mask = divmod(minute - self.origin, 8)
+        mask = 0x80 >> mask
+        if self.bits[i] & mask:
+            return None
+        self.bits[i] |= mask
+        return i
+
+    def _extend(self, first_minute, last_minute):
+        """Make room for bits first_minute to last_minute."""
+        if len(self.bits) == 0:
+            self.origin = first_minute - first_minute % 8
+        elif first_minute < self.origin:
+            new_origin = first_minute - first_minute % 8
+            self.bits = np.concatenate([
+                np.zeros((self.origin - new_origin) // 8, dtype=np.uint8),
+                self.bits])
+            self.origin = new_origin
+        n_bytes = (last_minute - self.origin) // 8 + 1
+        if n_bytes > len(self.bits):
+            # Grow geometrically so add() is amortised O(1)
+            grown = np.zeros(max(n_bytes, len(self.bits) * 2), dtype=np.uint8)
+            grown[:len(self.bits)] = self.bits
+            self.bits = grown
+
+    def __or__(self, other):
+        if len(self.bits) == 0:
+            return Coverage(other.origin, other.bits.copy())
+        if len(other.bits) == 0:
+            return Coverage(self.origin, self.bits.copy())
+        origin = min(self.origin, other.origin)
+        end = max(self.origin + 8 * len(self.bits),
+                  other.origin + 8 * len(other.bits))
+        bits = np.zeros((end - origin) // 8, dtype=np.uint8)
+        for coverage in [self, other]:
+            start = (coverage.origin - origin) // 8
+            bits[start:start + len(coverage.bits)] |= coverage.bits
+        return Coverage(origin, bits)
+
+    def minutes(self):
+        """Returns an array of the UNIX minutes which have data."""
+        return self.origin + np.flatnonzero(np.unpackbits(self.bits))
+
+    def n_minutes(self):
+        return int(np.unpackbits(self.bits).sum())
+
+    def span(self):
+        """Returns (first minute, last minute + 1) with data, or None."""
+        minutes = self.minutes()
+        if len(minutes) == 0:
+            return None
+        return int(minutes[0]), int(minutes[-1]) + 1
+
+    def uptime(self, start=None, end=None):
+        """Fraction of the minutes in [start, end) (UNIX minutes; defaults
+        to span()) which have data."""
+        span = self.span()
+        if span is None:
+            return 0.0
+        start = span[0] if start is None else start
+        end = span[1] if end is None else end
+        minutes = self.minutes()
+        n = np.count_nonzero((minutes >= start) & (minutes < end))
+        return n / (end - start) if end > start else 0.0
+
+    def gaps(self, min_minutes=1, start=None, end=None):
+        """
+        Args:
+            start, end (int): UNIX times in seconds.  Default to span().
+        Returns:
+            list of (start, end) UNIX times in seconds of each run of at
+            least min_minutes minutes without data inside [start, end)
+        """
+        span = self.span()
+        if span is None:
+            return []
+        start = span[0] if start is None else int(start) // MINUTE
+        end = span[1] if end is None else -(-int(end) // MINUTE)
+        minutes = self.minutes()
+        minutes = minutes[(minutes >= start) & (minutes < end)]
+        edges = np.concatenate([[start - 1], minutes, [end]])
+        lengths = np.diff(edges) - 1
+        i = np.flatnonzero(lengths >= min_minutes)
+        return [(int(edges[j] + 1) * MINUTE, int(edges[j + 1]) * MINUTE)
+                for j in i]
+
+    def trimmed(self):
+        """Returns the bits without the unused bytes add() grows into."""
+        used = np.flatnonzero(self.bits)
+        return self.bits[:used[-1] + 1] if len(used) else self.bits[:0]
+
+    def save(self, filename):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, self.origin))
+            fh.write(self.trimmed().tobytes())
+        os.rename(tmp_filename, filename)
+
+
+def load(filename):
+    """Returns the Coverage in filename."""
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    try:
+        magic, origin = HEADER.unpack_from(data)
+    except struct.error:
+        raise CoverageError("{} is truncated".format(filename))
+    if magic != MAGIC:
+        raise CoverageError("{} is not a coverage file".format(filename))
+    return Coverage(origin, np.frombuffer(data[HEADER.size:],
+                                          dtype=np.uint8).copy())
+
+
+def build(data_filename, block_size=BLOCK_SIZE):
+    """Returns the Coverage of a channel_N.dat file."""
+    coverage = Coverage()
+    remainder = ''
+    with open(data_filename, 'rb') as data_file:
+        while True:
+            block = data_file.read(block_size)
+            if not block:
+                break
+            text = remainder + block
+            end = text.rfind('\n') + 1
+            remainder = text[end:]
+            timestamps, dummy, dummy = reader.parse_text(text[:end])
+            coverage.add_timestamps(timestamps)
+    return coverage
+
+
+def load_or_build(data_filename):
+    """Load the channel's coverage file if it is at least as new as
+    data_filename, otherwise build the coverage from data_filename."""
+    filename = coverage_filename(data_filename)
+    if (os.path.exists(filename) and
+        os.path.getmtime(filename) >= os.path.getmtime(data_filename)):
+        try:
+            return load(filename)
+        except CoverageError as e:
+            log.warn(str(e))
+    return build(data_filename)
+
+
+class CoverageWriter(object):
+    """Keeps a channel_N.cov file up to date as samples are logged.
+    Writes at most one byte per new minute."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._last_minute = None
+        if os.path.exists(filename):
+            try:
+                self.coverage = load(filename)
+            except CoverageError as e:
+                log.warn("{}. Starting a new coverage file.".format(e))
+                self.coverage = Coverage()
+        else:
+            self.coverage = Coverage()
+
+    def add(self, timestamp):
+        minute = int(timestamp) // MINUTE
+        if minute == self._last_minute:
+            return
+        self._last_minute = minute
+        origin = self.coverage.origin
+        i = self.coverage.add(timestamp)
+        if i is None:
+            return
+        if origin != self.coverage.origin or not os.path.exists(self.filename):
+            self.coverage.save(self.filename)
+            return
+        with open(self.filename, 'r+b') as fh:
+            fh.seek(HEADER.size + i)
+            fh.write(self.coverage.bits[i:i + 1].tobytes())
@@ -0,0 +1,255 @@
+"""
+Non-interactive discovery of transmitters, for setting up a new house.
+
+    rfm_ecomanager_logger.py --scan 300 --candidates candidates.csv
+
+puts every base unit into promiscuous mode ('u') for 300 seconds and
+writes every unknown transmitter it hears to candidates.csv, with packet
+counts, mean sensor readings and whether it sent pairing requests.  Fill
+in the name column (and delete any rows you don't want), then:
+
+    rfm_ecomanager_logger.py --accept candidates.csv
+
+adds them all.  IAMs which sent pairing requests are paired: the pair
+commands for a base unit are sent together and the acknowledgements
+collected as they arrive, retrying any which don't arrive.  Everything
+else is added by ID, like the 'm' editing command.
+
+For TXs with several sensors, name each sensor: "1=aggregate;2=lighting".
+"""
+
+from __future__ import print_function, division
+import csv
+import threading
+import time
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from nanode import NanodeRestart, NanodeTooManyRetries
+from transmitter import Cc_tx, Cc_trx
+from sensor import Sensor
+
+COLUMNS = ['rf_id', 'type', 'base_unit', 'packets', 'pair_requests',
+           'mean_watts', 'name']
+PAIR_TIMEOUT = 10 # seconds to wait for a batch of pair acknowledgements
+PAIR_ROUNDS = 3
+
+
+class DiscoveryError(Exception):
+    """For invalid candidate files."""
+
+
+class Candidate(object):
+    """A transmitter heard during a scan."""
+
+    def __init__(self, rf_id, tx_type, base_unit):
+        self.rf_id = rf_id
+        self.tx_type = tx_type
+        self.base_unit = base_unit
+        self.packets = 0
+        self.pair_requests = 0
+        self.watts = {} # sensor ID: [total, count]
+        self.name = ""
+
+    def add(self, data):
+        if data.is_pairing_request:
+            self.pair_requests += 1
+            return
+        self.packets += 1
+        for s_id, watts in (data.sensors or {}).iteritems():
+            totals = self.watts.setdefault(int(s_id), [0, 0])
+            totals[0] += watts
+            totals[1] += 1
+
+    def mean_watts(self):
+        return dict((s_id, total / count)
+                    for s_id, (total, count) in self.watts.iteritems())
+
+    def sensor_names(self):
+        """Parses name, e.g. "kettle" or "1=aggregate;2=lighting".
+
+        Returns:
+            dict mapping sensor ID to name
+        """
+        names = {}
+        for i, part in enumerate(self.name.split(';')):
+            s_id, _, name = part.strip().rpartition('=')
+            try:
+                names[int(s_id) if s_id else i + 1] = name.strip()
+            except ValueError:
+                raise DiscoveryError("Transmitter {}: can't parse name '{}'"
+                                     .format(self.rf_id, self.name))
+        return names
+
+
+def scan(nanode, duration, known_ids=()):
+    """Listen to every transmitter within range of one base unit.
+
+    Returns:
+        dict mapping rf_id to Candidate
+    """
+    candidates = {}
+    log.info("Scanning on {} for {} seconds...".format(nanode.port, duration))
+    nanode.send_command("u") # pass on packets from unknown transmitters
+    try:
+        deadline = time.time() + duration
+        while time.time() < deadline and not nanode.abort:
+            try:
+                data = nanode.read_sensor_data(retries=0)
+            except NanodeTooManyRetries:
+                continue
+            except NanodeRestart:
+                nanode.init_nanode()
+                nanode.send_command("u")
+                continue
+            if not data or data.pair_ack or data.tx_id in known_ids:
+                continue
+            candidate = candidates.get(data.tx_id)
+            if candidate is None:
+                log.info("Heard {} {}".format(data.tx_type, data.tx_id))
+                candidate = candidates[data.tx_id] = Candidate(
+                    data.tx_id, (data.tx_type or "TRX").upper(), nanode.port)
+            candidate.add(data)
+    finally:
+        nanode.send_command("k")
+    return candidates
+
+
+def scan_all(nanodes, duration, known_ids=()):
+    """Scan on every base unit at once.  A transmitter heard by several
+    base units is assigned to the one which heard it most."""
+    results = []
+    def scan_one(nanode):
+        results.append(scan(nanode, duration, known_ids))
+    threads = [threading.Thread(target=scan_one, args=(nanode,), name=nanode.port)
+               for nanode in nanodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    candidates = {}
+    for result in results:
+        for rf_id, candidate in result.iteritems():
+            best = candidates.get(rf_id)
+            if (best is None or candidate.packets + candidate.pair_requests >
+                best.packets + best.pair_requests):
+                candidates[rf_id] = candidate
+    return candidates
+
+
+def write_candidates(filename, candidates):
+    with open(filename, 'wb') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(COLUMNS)
+        for rf_id, candidate in sorted(candidates.iteritems()):
+            mean_watts = ";".join("{}={:.0f}".format(s_id, watts) for s_id, watts
+                                  in sorted(candidate.mean_watts().iteritems()))
+            writer.writerow([rf_id, candidate.tx_type, candidate.base_unit,
+                             candidate.packets, candidate.pair_requests,
+                             mean_watts, candidate.name])
+
+
+def read_candidates(filename):
+    """Returns a list of Candidates, in file order."""
+    candidates = []
+    with open(filename, 'rb') as fh:
+        for row in csv.DictReader(fh):
+            try:
+                candidate = Candidate(int(row['rf_id']), row['type'].upper(),
+                                      row['base_unit'])
+                candidate.pair_requests = int(row['pair_requests'] or 0)
+            except (KeyError, ValueError, AttributeError) as e:
+                raise DiscoveryError("Bad row {} in {}: {}".format(row, filename, e))
+            if candidate.tx_type not in ["TX", "TRX"]:
+                raise DiscoveryError("Transmitter {} has unknown type {}"
+                                     .format(candidate.rf_id, candidate.tx_type))
+            candidate.name = (row.get('name') or "").strip()
+            if not candidate.name:
+                raise DiscoveryError("Transmitter {} has no name. Name it or "
+                                     "delete its row.".format(candidate.rf_id))
+            valid_ids = (Cc_tx.VALID_SENSOR_IDS if candidate.tx_type == "TX"
+                         else [1])
+            if not set(candidate.sensor_names()) <= set(valid_ids):
+                raise DiscoveryError("Transmitter {}: sensor IDs must be in {}"
+                                     .format(candidate.rf_id, valid_ids))
+            candidates.append(candidate)
+    return candidates
+
+
+def pair_all(nanode, rf_ids, timeout=PAIR_TIMEOUT, rounds=PAIR_ROUNDS):
+    """Send pair commands for all rf_ids and collect the acknowledgements
+    as they arrive, retrying any which haven't arrived after timeout.
+
+    Returns:
+        dict mapping each acknowledged rf_id to its type ("TX" or "TRX")
+    """
+    acked = {}
+    for round_number in range(rounds):
+        waiting = [rf_id for rf_id in rf_ids if rf_id not in acked]
+        if not waiting:
+            break
+        log.info("Pairing with {} on {} (round {})"
+                 .format(waiting, nanode.port, round_number + 1))
+        for rf_id in waiting:
+            # Don't flush the input: it may hold acks for earlier commands
+            nanode.send_command("p", rf_id, flush=False)
+        deadline = time.time() + timeout
+        while time.time() < deadline and not set(waiting) <= set(acked):
+            try:
+                data = nanode.read_sensor_data(retries=0)
+            except NanodeTooManyRetries:
+                continue
+            if data and data.pair_ack and data.tx_id in waiting:
+                acked[data.tx_id] = (data.tx_type or "TRX").upper()
+    return acked
+
+
+def accept(manager, candidates):
+    """Add candidates to manager's registry and to the Nanodes.
+
+    Returns:
+        list of rf_ids which couldn't be added
+    """
+    failed = []
+    by_port = {}
+    for candidate in candidates:
+        if candidate.rf_id in manager.transmitters:
+            log.warn("{} is already known. Skipping.".format(candidate.rf_id))
+            continue
+        if candidate.base_unit not in manager.nanodes:
+            log.warn("{} is on base unit {} which isn't open. Assigning it to {}."
+                     .format(candidate.rf_id, candidate.base_unit,
+                             manager.nanode.port))
+            candidate.base_unit = manager.nanode.port
+        by_port.setdefault(candidate.base_unit, []).append(candidate)
+
+    added = []
+    for port, port_candidates in sorted(by_port.iteritems()):
+        nanode = manager.nanodes[port]
+        to_pair = [c.rf_id for c in port_candidates
+                   if c.tx_type == "TRX" and c.pair_requests]
+        acked = pair_all(nanode, to_pair) if to_pair else {}
+        for candidate in port_candidates:
+            tx_class = Cc_tx if candidate.tx_type == "TX" else Cc_trx
+            if candidate.rf_id in to_pair:
+                if candidate.rf_id not in acked:
+                    log.error("Failed to pair with {}".format(candidate.rf_id))
+                    failed.append(candidate.rf_id)
+                    continue
+            else:
+                nanode.send_command(tx_class.ADD_COMMAND, candidate.rf_id)
+            added.append((candidate, tx_class))
+
+    # Assign log_chans in file order
+    for candidate, tx_class in added:
+        tx = tx_class(candidate.rf_id, manager)
+        tx.base_unit = candidate.base_unit
+        tx.sensors = {}
+        # next_free_log_chan() only looks at registered transmitters
+        manager.transmitters[tx.id] = tx
+        for s_id, name in sorted(candidate.sensor_names().iteritems()):
+            tx.sensors[s_id] = Sensor()
+            tx.sensors[s_id].configure(tx, name, manager.next_free_log_chan())
+        log.info("Added {} {}: {}".format(tx.TYPE, tx.id, tx.print_names()))
+    manager._pickle()
+    return failed
@@ -0,0 +1,389 @@
+"""
+Emulates a Nanode running rfm_edf_ecomanager, so that the logger can be
+tested and benchmarked without hardware.  Give a port of the form
+"emulator:NAME":
+
+    rfm_ecomanager_logger.py --port emulator:house
+
+Each NAME is one emulated base unit (an EmulatedNanode), shared by every
+port opened with that name, so a test can reach the same device the
+logger is reading from:
+
+    device = emulator.get_device("house")
+    device.transmit(99, "tx", {1: 300})    # a packet arrives over the air
+
+The emulator understands the commands the logger sends (see
+Nanode.send_command), keeps track of which transmitters it has been told
+about, and prints packets from known transmitters (or all of them in
+promiscuous mode) as JSON lines, or as binary frames once it has received
+the 'b' command (see framing.py).  Opening a port resets the device, as
+DTR does on a real Nanode.
+
+Faults can be injected for testing the logger's recovery (see faults.py):
+reset(banner=True) reboots the firmware mid-stream, inject() puts garbage
+on the line, hold() delays output, stall() hangs the firmware until it is
+next reset, unplug() makes the port disappear and millis_offset moves the
+firmware's clock towards roll-over.
+"""
+
+from __future__ import print_function
+import json
+import socket
+import threading
+import time
+import serial
+import framing
+from protocol import STARTUP_SEQUENCE, EMULATOR_PREFIX
+
+PREFIX = EMULATOR_PREFIX
+PARAM_COMMANDS = "vpnNrRsS01" # commands followed by a number and '\r'
+PLAIN_COMMANDS = "dDmkub"
+MILLIS_ROLLOVER = 2**32
+BOOT_TIME = 2 # seconds from power-on to the end of the startup banner
+
+_devices = {}
+_devices_lock = threading.Lock()
+
+
+def get_device(name):
+    """Returns the EmulatedNanode called name, creating it if necessary."""
+    if name.startswith(PREFIX):
+        name = name[len(PREFIX):]
+    with _devices_lock:
+        device = _devices.get(name)
+        if device is None:
+            device = _devices[name] = EmulatedNanode(name)
+        return device
+
+
+def open_port(port, timeout=None):
+    """Like serial.Serial(port, timeout=timeout) for an "emulator:NAME" port."""
+    device = get_device(port)
+    if not device.connected:
+        raise serial.SerialException("could not open port {}".format(port))
+    return FakeSerial(device, port, timeout)
+
+
+def socket_bridge(port):
+    """Open an "emulator:NAME" port as a socket, for clients which need a
+    file descriptor to poll (see aionanode.py).  Two daemon threads copy
+    bytes between the socket and the device until the socket is closed.
+
+    Returns:
+        socket.socket
+    """
+    device = get_device(port)
+    if not device.connected:
+        raise serial.SerialException("could not open port {}".format(port))
+    device.reset()
+    ours, theirs = socket.socketpair()
+    closed = threading.Event()
+
+    def to_device():
+        while True:
+            try:
+                data = ours.recv(4096)
+            except socket.error:
+                break
+            if not data:
+                break
+            device.receive(data)
+        with device._ready:
+            closed.set()
+            device._ready.notify_all()
+
+    def from_device():
+        while not closed.is_set():
+            try:
+                data = device.read_some(4096, timeout=0.1, stop=closed)
+                if data:
+                    ours.sendall(data)
+            except (socket.error, serial.SerialException):
+                break
+        ours.close()
+
+    for target in [to_device, from_device]:
+        thread = threading.Thread(target=target, name=port)
+        thread.daemon = True
+        thread.start()
+    return theirs
+
+
+class EmulatedNanode(object):
+    """The firmware: parses commands and queues output for FakeSerial."""
+
+    def __init__(self, name, clock=time.time):
+        self.name = name
+        self.clock = clock
+        self.binary_supported = True
+        self.millis_offset = 0 # added to millis(), e.g. to test roll-over
+        self.connected = True
+        self._held_until = 0
+        self._output = bytearray()
+        self._ready = threading.Condition()
+        self.reset()
+
+    # Firmware state
+
+    def reset(self, banner=False):
+        """Restart the firmware, optionally printing its startup banner."""
+        with self._ready:
+            self._start = self.clock() - BOOT_TIME
+            self.stalled = False
+            self.binary = False
+            self.promiscuous = False
+            self.txs = set()
+            self.trxs = set()
+            self.trx_states = {}
+            self.pair_requests = set()
+            self._command = None
+            self._param = ""
+            self._replies = [] # radio replies, printed after the next ACK
+            del self._output[:]
+            if banner:
+                for line in STARTUP_SEQUENCE:
+                    self._print(line)
+
+    def millis(self):
+        return (int((self.clock() - self._start) * 1000) +
+                self.millis_offset) % MILLIS_ROLLOVER
+
+    def receive(self, data):
+        """Bytes written to the serial port by the logger."""
+        with self._ready:
+            if self.stalled:
+                return
+            for char in data.decode('ascii') if isinstance(data, bytes) else data:
+                self._receive_char(char)
+
+    def _receive_char(self, char):
+        if self._command is not None:
+            if char == "\r":
+                command, param = self._command, self._param
+                self._command, self._param = None, ""
+                self._print(param) # echo
+                self._execute(command, int(param) if param else 0)
+                self._print("ACK")
+                for record in self._replies:
+                    self._emit(record)
+                del self._replies[:]
+            elif char.isdigit():
+                self._param += char
+        elif char == "t":
+            self._print(str(self.millis()))
+        elif char in PARAM_COMMANDS:
+            self._command = char
+            self._print("ACK")
+        elif char in PLAIN_COMMANDS:
+            if char == "b" and not self.binary_supported:
+                self._print("NAK")
+                return
+            self._execute(char)
+            self._print("ACK")
+        elif char not in "\r\n":
+            self._print("NAK")
+
+    def _execute(self, command, param=None):
+        if command == "n":
+            self.txs.add(param)
+        elif command == "N":
+            self.trxs.add(param)
+        elif command == "r":
+            self.txs.discard(param)
+        elif command == "R":
+            self.trxs.discard(param)
+            self.trx_states.pop(param, None)
+        elif command == "d":
+            self.txs.clear()
+        elif command == "D":
+            self.trxs.clear()
+            self.trx_states.clear()
+        elif command == "u":
+            self.promiscuous = True
+        elif command == "k":
+            self.promiscuous = False
+        elif command == "b":
+            self.binary = True
+        elif command == "p":
+            self.trxs.add(param)
+            self.pair_requests.discard(param)
+            # The IAM replies over the radio after the command is ACKed
+            self._replies.append({"pw": {"id": param, "type": "trx"}})
+        elif command in "01" and param in self.trxs:
+            self.trx_states[param] = int(command)
+
+    # The radio side
+
+    def transmit(self, tx_id, tx_type="tx", sensors=None, state=None):
+        """A packet from a transmitter.  Printed if the transmitter is known
+        or the device is in promiscuous mode.  A TRX reports the state it
+        was last switched to unless state is given.
+
+        Returns:
+            True if the packet was printed.
+        """
+        with self._ready:
+            known = tx_id in (self.txs if tx_type == "tx" else self.trxs)
+            if not (known or self.promiscuous) or self.stalled:
+                return False
+            record = {"t": self.millis(), "id": tx_id, "type": tx_type,
+                      "sensors": dict((str(s_id), watts) for s_id, watts
+                                      in (sensors or {}).items())}
+            if tx_type == "trx":
+                record["state"] = (self.trx_states.get(tx_id, 1)
+                                   if state is None else state)
+            self._emit(record)
+            return True
+
+    def request_pairing(self, tx_id, tx_type="trx"):
+        """An IAM's pairing button has been pressed."""
+        with self._ready:
+            self.pair_requests.add(tx_id)
+            self._emit({"pr": {"id": tx_id, "type": tx_type}})
+
+    # Faults
+
+    def inject(self, data):
+        """Put raw bytes on the serial line, e.g. garbage."""
+        with self._ready:
+            self._output += data
+            self._ready.notify_all()
+
+    def hold(self, seconds):
+        """Output (including responses to commands) only reaches the
+        serial port after seconds."""
+        with self._ready:
+            self._held_until = time.time() + seconds
+
+    def stall(self):
+        """Hang: ignore commands and packets until the next reset."""
+        with self._ready:
+            self.stalled = True
+
+    def unplug(self):
+        """The serial port disappears.  Reads and writes on open ports,
+        and attempts to open it, raise SerialException until plug()."""
+        with self._ready:
+            self.connected = False
+            self._ready.notify_all()
+
+    def plug(self):
+        with self._ready:
+            self.connected = True
+
+    # Output
+
+    def _emit(self, record):
+        if self.binary:
+            self._output += framing.encode(record)
+            self._ready.notify_all()
+        else:
+            self._print(json.dumps(record, separators=(",", ":")))
+
+    def _print(self, line):
+        self._output += line.encode('ascii') + b"\r\n"
+        self._ready.notify_all()
+
+    def read(self, size, timeout, line=False):
+        """Take up to size bytes of output (up to the end of a line if line),
+        waiting up to timeout seconds (forever if None) for them."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._ready:
+            while True:
+                self.check_connected()
+                now = time.time()
+                output = self._output if now >= self._held_until else b""
+                end = output.find(b"\n") + 1 if line else 0
+                available = end or (len(output) if line else
+                                    min(size, len(output)))
+                if (end or (not line and available >= size) or
+                    (deadline is not None and now >= deadline)):
+                    break
+                wake = deadline
+                if now < self._held_until:
+                    wake = min(wake or self._held_until, self._held_until)
+                self._ready.wait(None if wake is None else max(wake - now, 0))
+            data = bytes(self._output[:available])
+            del self._output[:available]
+            return data
+
+    def read_some(self, size, timeout, stop=None):
+        """Take up to size bytes of output, waiting up to timeout seconds
+        for at least one.  Returns nothing once stop (an Event) is set."""
+        deadline = time.time() + timeout
+        with self._ready:
+            while not self.waiting() and time.time() < deadline:
+                if stop is not None and stop.is_set():
+                    return b""
+
+                self.check_connected()
+                wake = deadline
+                if time.time() < self._held_until:
+                    wake = min(wake, self._held_until)
+                self._ready.wait(max(wake - time.time(), 0))
+            self.check_connected()
+            if stop is not None and stop.is_set():
+                return b""
+            data = bytes(self._output[:min(size, self.waiting())])
+            del self._output[:len(data)]
+            return data
+
+    def waiting(self):
+        return len(self._output) if time.time() >= self._held_until else 0
+
+    def check_connected(self):
+        if not self.connected:
+            raise serial.SerialException("Device {} has been unplugged"
+                                         .format(self.name))
+
+    def discard_output(self):
+        with self._ready:
+            del self._output[:]
+
+
+class FakeSerial(object):
+    """The subset of serial.Serial which Nanode uses, connected to an
+    EmulatedNanode."""
+
+    def __init__(self, device, port, timeout=None):
+        self.device = device
+        self.port = port
+        self.timeout = timeout
+        self.is_open = True
+        device.reset()
+
+    def _check_open(self):
+        if not self.is_open:
+            raise serial.SerialException("Port {} is closed".format(self.port))
+        self.device.check_connected()
+
+    def write(self, data):
+        self._check_open()
+        self.device.receive(data)
+        return len(data)
+
+    def read(self, size=1):
+        self._check_open()
+        return self.device.read(size, self.timeout)
+
+    def readline(self):
+        self._check_open()
+        return self.device.read(None, self.timeout, line=True)
+
+    def readall(self):
+        self._check_open()
+        return self.device.read(self.device.waiting(), 0)
+
+    def inWaiting(self):
+        self._check_open()
+        return self.device.waiting()
+
+    def flushInput(self):
+        self._check_open()
+        self.device.discard_output()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
@@ -0,0 +1,177 @@
+"""
+Appliance events detected as data are logged, so that questions like "when
+did the kettle run last month" read a few kilobytes of events instead of
+the whole channel file.
+
+Every sample which Sensor.log_data_to_disk() logs is fed through a small
+state machine for its channel which emits:
+
+    ON      power rose to at least on_watts
+    OFF     power fell below on_watts - hysteresis
+    STEP    while on, power moved by at least step_watts from its level
+    STATE   the IAM's state changed (a button press, as recorded in the
+            third column of channel_N.dat)
+
+A change only becomes an ON, OFF or STEP event once it has lasted for
+min_duration seconds; the event's timestamp is when the change started.
+Each event is appended as one fixed-size binary record to
+channel_<log_chan>.events in the data directory:
+
+    timestamp (uint32)    UNIX time
+    kind (uint8)          ON, OFF, STEP or STATE
+    state (int8)          the new IAM state for STATE events, else -1
+    watts (float32)       power after the change
+    delta (float32)       change in power (0 for STATE events)
+
+Records are in time order, so reader.DataDirectory.load_events() can
+binary search for a time range.  A detector for an existing events file
+(e.g. when resuming) starts from the state after the file's last event.
+"""
+
+from __future__ import print_function, division
+import os
+import struct
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+
+RECORD = struct.Struct("<IBbff")
+ON, OFF, STEP, STATE = 1, 2, 3, 4
+KIND_NAMES = {ON: "on", OFF: "off", STEP: "step", STATE: "state"}
+NO_STATE = -1
+
+ON_WATTS = 10 # watts
+HYSTERESIS = 5 # watts
+STEP_WATTS = 100 # watts
+MIN_DURATION = 10 # seconds.  Most transmitters send every 6 seconds.
+LEVEL_WEIGHT = 1 / 8 # weight of each sample in the level followed while on
+SEED_RECORDS = 64 # records read from the end of an existing events file
+
+
+def events_filename(data_directory, log_chan):
+    return os.path.join(data_directory, "channel_{:d}.events".format(log_chan))
+
+
+class Candidate(object):
+    """A change which hasn't lasted min_duration yet."""
+
+    def __init__(self, kind, start, watts):
+        self.kind = kind
+        self.start = start
+        self.watts = watts
+
+
+class ChannelEvents(object):
+    """Detects events in a single channel and appends them to its
+    events file.  Each sample is processed in O(1)."""
+
+    def __init__(self, data_directory, log_chan, on_watts=None,
+                 hysteresis=None, step_watts=None, min_duration=None):
+        self.filename = events_filename(data_directory, log_chan)
+        self.on_watts = ON_WATTS if on_watts is None else on_watts
+        self.hysteresis = HYSTERESIS if hysteresis is None else hysteresis
+        self.step_watts = STEP_WATTS if step_watts is None else step_watts
+        self.min_duration = (MIN_DURATION if min_duration is None
+                             else min_duration)
+        self.on = None # unknown until the first sample
+        self.level = None # watts
+        self.candidate = None
+        self._held = [] # STATE events which happened during the candidate
+        self._seed()
+
+    def _seed(self):
+        """Carry on from the last ON, OFF or STEP event in an existing
+        events file (e.g. when resuming), so the join isn't treated as a
+        fresh start."""
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as events_file:
+            events_file.seek(0, os.SEEK_END)
+            size = events_file.tell() - events_file.tell() % RECORD.size
+            start = max(size - SEED_RECORDS * RECORD.size, 0)
+            events_file.seek(start)
+            records = events_file.read(size - start)
+        for i in range(len(records) - RECORD.size, -1, -RECORD.size):
+            dummy, kind, dummy, watts, dummy = RECORD.unpack_from(records, i)
+            if kind != STATE:
+                self.on = kind != OFF
+                self.level = watts
+                return
+
+    def add(self, timecode, watts, new_state=None):
+        """Returns the list of events written, as
+        (timestamp, kind, state, watts, delta) tuples."""
+        events = []
+        kind = self._classify(watts)
+        candidate = self.candidate
+        if kind is None:
+            if self.on:
+                self.level += (watts - self.level) * LEVEL_WEIGHT
+            self._resolve(events)
+        elif (candidate is not None and candidate.kind == kind and
+              (kind != STEP or
+               (watts > self.level) == (candidate.watts > self.level))):
+            candidate.watts = watts # steps must keep going the same way
+        else:
+            self._resolve(events)
+            self.candidate = Candidate(kind, timecode, watts)
+
+        candidate = self.candidate
+        if (candidate is not None and
+            timecode - candidate.start >= self.min_duration):
+            events.append((int(candidate.start), candidate.kind, NO_STATE,
+                           watts, watts - self.level))
+            self.on = candidate.kind != OFF
+            self.level = watts
+            self._resolve(events)
+
+        if new_state is not None:
+            event = (int(timecode), STATE, new_state, watts, 0.0)
+            if self.candidate is None:
+                events.append(event)
+            else:
+                self._held.append(event)
+
+        if events:
+            self._write(events)
+        return events
+
+    def _classify(self, watts):
+        if self.on is None:
+            self.on = watts >= self.on_watts
+            self.level = watts
+            return None
+        if not self.on:
+            return ON if watts >= self.on_watts else None
+        if watts < self.on_watts - self.hysteresis:
+            return OFF
+        if abs(watts - self.level) >= self.step_watts:
+            return STEP
+        return None
+
+    def _resolve(self, events):
+        """Drop the candidate and release the events held while it was
+        pending (they all happened after it started)."""
+        self.candidate = None
+        events.extend(self._held)
+        del self._held[:]
+
+    def _write(self, events):
+        with open(self.filename, 'ab') as events_file:
+            events_file.write("".join(RECORD.pack(*event) for event in events))
+
+    def flush(self):
+        """Write any held events (e.g. on shutdown).  A change which
+        hasn't lasted min_duration is dropped."""
+        events = []
+        self._resolve(events)
+        if events:
+            self._write(events)
+
+
+def append_events_file(input_filename, output_filename):
+    """Append the event records in input_filename onto output_filename."""
+    with open(input_filename, 'rb') as input_file:
+        records = input_file.read()
+    records = records[:len(records) - len(records) % RECORD.size]
+    with open(output_filename, 'ab') as output_file:
+        output_file.write(records)
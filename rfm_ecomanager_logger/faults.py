@@ -0,0 +1,347 @@
+#!/usr/bin/python
+"""
+Fault-injection harness for the logger's recovery logic.
+
+    faults.py [--binary] [SCENARIO ...]
+
+Each scenario runs the real logging path (Manager._log_from_base_unit,
+Nanode, Cc_tx, Sensor and the sinks) against an emulated Nanode (see
+emulator.py) which receives a steady stream of packets from TRANSMITTERS
+transmitters, each sending every PERIOD seconds.  Part way through, a
+fault is injected:
+
+    reboot     the Nanode reboots and prints its startup banner
+    garbage    garbage bytes and partial lines on the serial line
+    latency    output is held up for a couple of seconds
+    rollover   the Nanode's uint32 millisecond clock rolls over
+    stall      the Nanode hangs until the logger reopens the port
+    unplug     the serial port disappears briefly
+
+and the harness measures:
+
+    resume     seconds from the end of the fault until the first packet
+               sent after it reaches the sinks
+    lost       packets sent during the run which never reached the sinks
+               (including any which Sensor's filters rejected)
+    error      the largest difference between a logged timestamp and the
+               time the packet was sent
+
+A scenario fails if any of these exceeds its Budget.  Timestamps are
+rounded to whole seconds so errors up to 0.5 s are expected.  Exits with
+status 1 if any scenario failed.
+"""
+
+from __future__ import print_function, division
+import abc
+import argparse
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+import emulator
+from nanode import Nanode
+from manager import Manager
+from transmitter import Cc_tx
+from sensor import Sensor
+from sinks import Sink
+
+TRANSMITTERS = 40
+PERIOD = 4 # seconds between packets from each transmitter.  Must be more
+           # than sensor.MIN_SAMPLE_PERIOD plus a second of rounding.
+INTERVAL = PERIOD / TRANSMITTERS # seconds between packets
+WARMUP = 1 # seconds of packets before the fault
+RUN_ON = 1 # seconds of packets after logging resumes
+SERIAL_TIMEOUT = 0.1 # seconds. Real Nanodes use Nanode.TIMEOUT.
+FLUSH_INTERVAL = 0.05 # seconds between the probe sink's writes
+FIRST_TX_ID = 1000
+
+
+class Budget(object):
+    def __init__(self, resume, lost, error=1.0):
+        self.resume = resume # seconds
+        self.lost = lost # packets
+        self.error = error # seconds
+
+
+class Result(object):
+    def __init__(self, scenario, sent, logged, resume, error):
+        self.scenario = scenario
+        self.sent = sent
+        self.logged = logged
+        self.lost = sent - logged
+        self.resume = resume # None if logging never resumed
+        self.error = error
+
+    def failures(self):
+        budget = self.scenario.budget
+        failures = []
+        if self.resume is None:
+            failures.append("logging didn't resume")
+        elif self.resume > budget.resume:
+            failures.append("resume {:.2f} s > {} s"
+                            .format(self.resume, budget.resume))
+        if self.lost > budget.lost:
+            failures.append("lost {} > {} packets".format(self.lost, budget.lost))
+        if self.error > budget.error:
+            failures.append("timestamp error {:.2f} s > {} s"
+                            .format(self.error, budget.error))
+        return failures
+
+    def __str__(self):
+        return ("{:10s} resume={} lost={}/{} error={:.2f}s {}"
+                .format(self.scenario.name,
+                        "never" if self.resume is None else
+                        "{:.2f}s".format(self.resume),
+                        self.lost, self.sent, self.error,
+                        "; ".join(self.failures()) or "OK"))
+
+
+class Scenario(object):
+    """Subclasses implement inject(), which returns when the fault is over,
+    and may override setup(), which is called before the port is opened."""
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+    budget = None
+
+    def setup(self, device):
+        device.millis_offset = 0
+
+    @abc.abstractmethod
+    def inject(self, device):
+        pass
+
+
+class Reboot(Scenario):
+    name = "reboot"
+    budget = Budget(resume=0.5, lost=4)
+
+    def inject(self, device):
+        device.reset(banner=True)
+
+
+class Garbage(Scenario):
+    name = "garbage"
+    budget = Budget(resume=0.5, lost=8) # a bad length byte in a frame
+                                        # can swallow several frames
+
+    def inject(self, device):
+        device.inject(b"\x00\xff\xfe garbage\r\n")
+        device.inject(b'{"t":12,"id":\r\n') # line cut short
+        device.inject(b'{"t":12,"i') # merges with the next packet
+        time.sleep(INTERVAL * 2)
+        device.inject(b"\xa5\x40\x01\x02") # bogus frame swallows the next packet
+        time.sleep(INTERVAL * 2)
+
+
+class Latency(Scenario):
+    name = "latency"
+    budget = Budget(resume=0.5, lost=3)
+    SECONDS = 2
+
+    def inject(self, device):
+        device.hold(self.SECONDS)
+        time.sleep(self.SECONDS)
+
+
+class Rollover(Scenario):
+    name = "rollover"
+    budget = Budget(resume=0.5, lost=2)
+    SECONDS_BEFORE = WARMUP + 1 # roll over this long after opening the port
+
+    def setup(self, device):
+        device.millis_offset = (emulator.MILLIS_ROLLOVER -
+                                (emulator.BOOT_TIME + self.SECONDS_BEFORE) * 1000)
+
+    def inject(self, device):
+        while device.millis() > emulator.MILLIS_ROLLOVER // 2:
+            time.sleep(0.05)
+
+
+class Stall(Scenario):
+    name = "stall"
+    budget = Budget(resume=4, lost=40)
+
+    def inject(self, device):
+        device.stall()
+
+
+class Unplug(Scenario):
+    name = "unplug"
+    budget = Budget(resume=1, lost=16)
+    SECONDS = 0.5 # must be less than the 1 s Nanode waits before reopening
+
+    def inject(self, device):
+        device.unplug()
+        time.sleep(self.SECONDS)
+        device.plug()
+
+
+SCENARIOS = [Reboot(), Garbage(), Latency(), Rollover(), Stall(), Unplug()]
+
+
+class ProbeSink(Sink):
+    """Records when each reading is written."""
+
+    NAME = "probe"
+
+    def __init__(self):
+        super(ProbeSink, self).__init__(flush_interval=FLUSH_INTERVAL)
+        self.logged = [] # (log_chan, watts, timestamp, time written)
+
+    def write_batch(self, records):
+        now = time.time()
+        self.logged.extend((log_chan, watts, timestamp, now)
+                           for timestamp, log_chan, watts, state in records)
+
+
+class Args(object):
+    def __init__(self, binary, data_directory):
+        self.binary = binary
+        self.data_directory = data_directory
+        self.time_correction = True
+        self.switch = False
+        self.edit = False
+
+
+class Harness(object):
+
+    def __init__(self, scenario, binary=False):
+        self.scenario = scenario
+        self.binary = binary
+        self._sent = {} # (log_chan, sequence number): time sent
+        self._stop_traffic = threading.Event()
+        self._probe = ProbeSink()
+
+    def run(self):
+        """Returns a Result."""
+        data_directory = tempfile.mkdtemp()
+        try:
+            return self._run(data_directory)
+        finally:
+            shutil.rmtree(data_directory)
+
+    def _run(self, data_directory):
+        port = emulator.PREFIX + "faults-" + self.scenario.name
+        device = emulator.get_device(port)
+        device.plug()
+        self.scenario.setup(device)
+        nanode = Nanode(Args(self.binary, data_directory), port,
+                        timeout=SERIAL_TIMEOUT)
+        manager = Manager([nanode], nanode.args)
+        manager.sinks.add(self._probe)
+        manager.transmitters = {}
+        for i in range(TRANSMITTERS):
+            tx = Cc_tx(FIRST_TX_ID + i, manager)
+            tx.base_unit = port
+            tx.sensors[1] = Sensor()
+            tx.sensors[1].configure(tx, "probe{}".format(i), i + 1)
+            manager.transmitters[tx.id] = tx
+        manager._tell_nanode_about_transmitters(nanode)
+
+        manager.sinks.start()
+        reader = threading.Thread(target=manager._run_base_unit, args=(nanode,),
+                                  name=port)
+        traffic = threading.Thread(target=self._transmit, args=(device,),
+                                   name="traffic")
+        reader.start()
+        traffic.start()
+        try:
+            time.sleep(WARMUP)
+            log.info("Injecting fault: {}".format(self.scenario.name))
+            self.scenario.inject(device)
+            fault_end = time.time()
+            deadline = fault_end + self.scenario.budget.resume * 2 + RUN_ON
+            while (time.time() < deadline and reader.is_alive() and
+                   self._resume_time(fault_end) is None):
+                time.sleep(0.1)
+            time.sleep(RUN_ON)
+        finally:
+            self._stop_traffic.set()
+            traffic.join()
+            time.sleep(0.2) # let the last packets arrive
+            manager._stop_base_units()
+            reader.join()
+            manager.sinks.stop()
+            nanode.close()
+            device.plug()
+        return self._result(fault_end)
+
+    def _transmit(self, device):
+        """Each transmitter sends every PERIOD seconds, staggered so that
+        a packet is sent every PERIOD / TRANSMITTERS seconds."""
+        start = time.time()
+        i = 0
+        while not self._stop_traffic.wait(max(start + i * INTERVAL -
+                                              time.time(), 0)):
+            sequence, log_chan = divmod(i, TRANSMITTERS)
+            log_chan += 1
+            self._sent[(log_chan, sequence)] = time.time()
+            device.transmit(FIRST_TX_ID + log_chan - 1, "tx", {1: sequence})
+            i += 1
+
+    def _logged(self):
+        for log_chan, watts, timestamp, written in list(self._probe.logged):
+            yield (log_chan, watts), timestamp, written
+
+    def _resume_time(self, fault_end):
+        """Seconds from fault_end until the first packet sent after it was
+        written, or None."""
+        resumed = [written for key, timestamp, written in self._logged()
+                   if self._sent.get(key, 0) >= fault_end]
+        return min(resumed) - fault_end if resumed else None
+
+    def _result(self, fault_end):
+        logged = set()
+        error = 0
+        for key, timestamp, dummy in self._logged():
+            if key in self._sent:
+                logged.add(key)
+                error = max(error, abs(timestamp - self._sent[key]))
+        return Result(self.scenario, len(self._sent), len(logged),
+                      self._resume_time(fault_end), error)
+
+
+def run_scenarios(scenarios, binary=False):
+    """Returns a list of Results."""
+    results = []
+    for scenario in scenarios:
+        result = Harness(scenario, binary).run()
+        print(result)
+        results.append(result)
+    return results
+
+
+def setup_argparser():
+    names = [scenario.name for scenario in SCENARIOS]
+    parser = argparse.ArgumentParser(description="Inject faults into an "
+                                     "emulated Nanode and check the logger "
+                                     "recovers within budget.")
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='one or more of {} (default: all)'
+                        .format(", ".join(names)))
+    parser.add_argument('--binary', action='store_true',
+                        help='use binary frames instead of JSON lines')
+    parser.add_argument('--log', dest='loglevel', type=str, default='CRITICAL',
+                        help='log level of the logger (default: CRITICAL)')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(names)
+    if unknown:
+        parser.error("unknown scenario(s): {}".format(", ".join(sorted(unknown))))
+    return args
+
+
+def main():
+    args = setup_argparser()
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not args.scenarios or scenario.name in args.scenarios]
+    results = run_scenarios(scenarios, args.binary)
+    return 1 if any(result.failures() for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
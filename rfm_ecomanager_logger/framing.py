@@ -0,0 +1,152 @@
+"""
+Compact binary frames which a Nanode may send instead of JSON lines.
+
+The logger asks for them by sending the 'b' command during init_nanode
+(see Nanode.init_nanode and --binary).  Firmware which doesn't know 'b'
+replies NAK and carries on printing JSON, so JSON remains the fallback.
+Command responses (ACK, NAK, echoes and the time) stay as text lines.
+
+A frame is:
+
+    SYNC      1 byte, 0xA5 (never the first byte of a text line)
+    length    1 byte, length of the payload
+    payload   length bytes
+    CRC       2 bytes, little-endian CRC-16/CCITT of length + payload
+
+and the payload is a fixed header followed by one entry per sensor:
+
+    kind           uint8   DATA, PAIR_REQUEST or PAIR_ACK
+    millis         uint32  Nanode's clock
+    id             uint32  transmitter ID
+    type           uint8   0 = tx, 1 = trx
+    state          int8    TRX state, or -1
+    reply_to_poll  int8    1 if the packet answered a poll, 0, or -1
+    n_sensors      uint8
+    then n_sensors times:
+      sensor ID    uint8
+      watts        uint16
+
+A one-sensor packet is 20 bytes, against about 60 as JSON.  decode()
+returns the same dict that json.loads() returns for the equivalent line,
+so read_sensor_data() handles both alike.
+"""
+
+from __future__ import print_function
+import binascii
+import struct
+
+SYNC = b'\xa5'
+SYNC_BYTE = 0xA5
+DATA, PAIR_REQUEST, PAIR_ACK = 0, 1, 2
+TYPES = ['tx', 'trx']
+NONE = -1
+CRC_INIT = 0xFFFF
+HEADER = struct.Struct('<BIIBbbB')
+SENSOR = struct.Struct('<BH')
+LENGTH = struct.Struct('<B')
+CRC = struct.Struct('<H')
+
+
+class FrameError(Exception):
+    """Frame is truncated, corrupt or can't be encoded."""
+
+
+def frame_length(length):
+    """Total bytes in a frame whose length byte is length."""
+    return 1 + LENGTH.size + length + CRC.size
+
+
+def checksum(data):
+    return binascii.crc_hqx(data, CRC_INIT)
+
+
+def encode(record):
+    """Encode a record (a dict in the form of the Nanode's JSON lines,
+    e.g. {"t": 1234, "id": 99, "type": "tx", "sensors": {"1": 300}})
+    as a complete frame.
+
+    Returns:
+        bytes
+    """
+    if 'pw' in record:
+        kind, fields = PAIR_ACK, record['pw']
+    elif 'pr' in record:
+        kind, fields = PAIR_REQUEST, record['pr']
+    else:
+        kind, fields = DATA, record
+
+    def optional(key):
+        value = fields.get(key)
+        return NONE if value is None else int(value)
+
+    sensors = sorted((int(s_id), watts) for s_id, watts
+                     in (fields.get('sensors') or {}).items())
+    try:
+        payload = HEADER.pack(kind, fields.get('t') or 0, fields['id'],
+                              TYPES.index(fields.get('type', 'tx')),
+                              optional('state'), optional('reply_to_poll'),
+                              len(sensors))
+        payload += b''.join(SENSOR.pack(s_id, int(watts))
+                            for s_id, watts in sensors)
+        length = LENGTH.pack(len(payload))
+    except (struct.error, KeyError, ValueError) as e:
+        raise FrameError("Can't encode {}: {}".format(record, e))
+    return SYNC + length + payload + CRC.pack(checksum(length + payload))
+
+
+def decode(payload):
+    """Decode a frame's payload into a dict in the form of a JSON line."""
+    try:
+        kind, millis, tx_id, tx_type, state, reply_to_poll, n_sensors = \
+            HEADER.unpack_from(payload)
+        tx_type = TYPES[tx_type]
+    except (struct.error, IndexError) as e:
+        raise FrameError("Bad payload: {}".format(e))
+    if len(payload) != HEADER.size + n_sensors * SENSOR.size:
+        raise FrameError("Payload is {} bytes but has {} sensors"
+                         .format(len(payload), n_sensors))
+
+    fields = {'id': tx_id, 'type': tx_type}
+    if kind == PAIR_ACK:
+        return {'pw': fields}
+    if kind == PAIR_REQUEST:
+        return {'pr': fields}
+    if kind != DATA:
+        raise FrameError("Unknown frame kind {}".format(kind))
+    fields['t'] = millis
+    fields['sensors'] = dict(
+        (str(s_id), watts) for s_id, watts in
+        (SENSOR.unpack_from(payload, HEADER.size + i * SENSOR.size)
+         for i in range(n_sensors)))
+    if state != NONE:
+        fields['state'] = state
+    if reply_to_poll != NONE:
+        fields['reply_to_poll'] = reply_to_poll
+    return fields
+
+
+def read_frame(read):
+    """Read the rest of a frame whose SYNC byte has been consumed.
+
+    Args:
+        read: function taking a number of bytes and returning at most
+            that many (e.g. serial.Serial.read)
+
+    Returns:
+        dict, as decode()
+
+    Raises:
+        FrameError if the frame is truncated or its CRC is wrong.
+    """
+    length = read(LENGTH.size)
+    if len(length) != LENGTH.size:
+        raise FrameError("Frame truncated before length")
+    n = LENGTH.unpack(length)[0]
+    rest = read(n + CRC.size)
+    if len(rest) != n + CRC.size:
+        raise FrameError("Frame truncated: expected {} bytes, got {}"
+                         .format(n + CRC.size, len(rest)))
+    payload = rest[:n]
+    if CRC.unpack(rest[n:])[0] != checksum(length + payload):
+        raise FrameError("Frame failed CRC check")
+    return decode(payload)
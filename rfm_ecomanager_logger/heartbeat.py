@@ -0,0 +1,125 @@
+"""
+Heartbeat published by a running logger so that a supervisor (see
+supervisor.py) can tell a healthy logger from a crashed or hung one.
+
+Enable it on the command line with:
+
+    --heartbeat /path/to/heartbeat.json    (rewritten atomically)
+    --heartbeat udp:HOST:PORT              (one JSON datagram per beat)
+    --heartbeat unix:/path/to/socket
+
+Every --heartbeat-interval seconds the logger publishes a JSON object:
+
+    pid               the logger's process ID
+    time              UNIX time of this heartbeat
+    start_time        UNIX time the logger started
+    last_packet_time  most recent packet from any base unit (or null)
+    last_write_time   most recent batch written by any sink (or null)
+    queue_depth       largest number of records waiting in a sink buffer
+    base_units        maps port to packets, unknown_tx, restarts,
+                      last_packet_time and last_loop_time
+    switch_back       TRXs waiting to be switched back after a power cut
+                      and how long the last set took to converge
+
+The heartbeat has its own thread so `time` keeps advancing even if a read
+loop hangs.  That's why each base unit reports last_loop_time: the time
+its read loop last went round (at least every few seconds, even when no
+packets arrive).
+"""
+
+from __future__ import print_function
+import os
+import json
+import socket
+import threading
+import time
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from stream import parse_address, DROPPED_ERRNOS
+
+
+def write_json_atomically(filename, obj):
+    """Readers see either the old or the new file, never half of one."""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as fh:
+        json.dump(obj, fh)
+    os.rename(tmp_filename, filename)
+
+
+def read_json(filename):
+    """Returns the object in filename, or None if it doesn't exist or
+    can't be parsed."""
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+class Heartbeat(object):
+    """Periodically publishes the state of a Manager."""
+
+    INTERVAL = 1 # seconds
+
+    def __init__(self, target, manager, interval=None):
+        """
+        Args:
+            target (str): filename, "udp:HOST:PORT" or "unix:PATH".
+                Raises SinkError if an address is not valid.
+            manager (Manager)
+            interval (float): seconds between heartbeats
+        """
+        self.target = target
+        self.manager = manager
+        self.interval = float(interval or Heartbeat.INTERVAL)
+        self._socket = None
+        if target.startswith('udp:') or target.startswith('unix:'):
+            family, self._address = parse_address(target)
+            self._socket = socket.socket(family, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def state(self):
+        metrics = self.manager.metrics
+        return {'pid': os.getpid(),
+                'time': time.time(),
+                'start_time': metrics.start_time,
+                'last_packet_time': metrics.last_packet_time(),
+                'last_write_time': self.manager.sinks.last_write_time(),
+                'queue_depth': self.manager.sinks.queue_depth(),
+                'base_units': metrics.snapshot(),
+                'switch_back': self.manager.switch_back.status()}
+
+    def beat(self):
+        state = self.state()
+        if self._socket is None:
+            write_json_atomically(self.target, state)
+        else:
+            try:
+                self._socket.sendto(json.dumps(state), self._address)
+            except socket.error as e:
+                if e.errno not in DROPPED_ERRNOS:
+                    raise
+
+    def start(self):
+        log.info("Publishing heartbeat to {} every {} s"
+                 .format(self.target, self.interval))
+        self._thread = threading.Thread(target=self._run, name="heartbeat")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._socket is not None:
+            self._socket.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.beat()
+            except Exception:
+                log.exception("Failed to publish heartbeat")
+            self._stop.wait(self.interval)
@@ -0,0 +1,361 @@
+#!/usr/bin/python
+"""
+A single append-only ingest log for every channel, demultiplexed into
+channel_N.dat files later.
+
+Writing a few bytes to each of many channel_N.dat files every second is
+the worst access pattern for SD cards and eMMC.  With
+
+    --sink ingest[:DIRECTORY][,segment=BYTES][,demux=SECONDS]
+
+every reading is instead appended to one log in DIRECTORY (default:
+DATA_DIR/ingest).  The log is split into segments:
+
+    segment_00000012.active     being written
+    segment_00000011.seg        closed, waiting to be demultiplexed
+
+The active segment is closed when it reaches segment bytes (default 4 MiB)
+or is demux seconds old (default 300), and then the closed segments are
+demultiplexed into the channel_N.dat files of the data directory in the
+sink's thread.  Set demux=0 to leave them for an on-demand or scheduled
+(e.g. cron) run of:
+
+    ingestlog.py DATA_DIR [--directory DIRECTORY]
+
+A segment is a sequence of blocks, one per batch written by the sink:
+
+    magic      4 bytes, "RFMI"
+    n_records  uint32
+    CRC        uint32, CRC-32 of the records
+    records    n_records x (timestamp uint32, log_chan uint32,
+                            watts int32, state int8, -1 if no state)
+
+all little-endian.  A torn or corrupt block (e.g. after a crash, or a
+write which failed part way and was retried after it) is skipped, and
+counted: decoding carries on from the next block with a good magic and
+CRC.
+
+Demultiplexing a segment is crash-safe.  Before appending to any channel
+file the demuxer writes a journal holding the segment's name and every
+channel file's size.  Once the appends have been fsynced, the segment is
+renamed to .done, which is the commit point, and then the journal and the
+segment are removed.  If a demux is interrupted before the commit, the
+next run truncates the channel files back to the sizes in the journal
+and starts that segment again.  A lock file stops two demuxers running at
+once.
+"""
+
+from __future__ import print_function, division
+import argparse
+import errno
+import fcntl
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+import numpy as np
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from sinks import Sink, NO_STATE, lock_data_directory
+
+DIRECTORY = "ingest"
+MAGIC = b"RFMI"
+BLOCK_HEADER = struct.Struct("<4sII") # magic, n_records, CRC
+RECORD = np.dtype([('timestamp', '<u4'), ('log_chan', '<u4'),
+                   ('watts', '<i4'), ('state', 'i1')])
+SEGMENT_SIZE = 4 * 2**20 # bytes
+DEMUX_INTERVAL = 300 # seconds
+ACTIVE = ".active"
+CLOSED = ".seg"
+DONE = ".done"
+JOURNAL = "demux.journal"
+LOCK = "demux.lock"
+
+
+def ingest_directory(data_directory):
+    return os.path.join(data_directory, DIRECTORY)
+
+
+def segment_filename(directory, number, suffix=CLOSED):
+    return os.path.join(directory, "segment_{:08d}{}".format(number, suffix))
+
+
+def list_segments(directory, suffix=CLOSED):
+    """Returns a sorted list of (number, filename) of segments."""
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith("segment_") and name.endswith(suffix):
+            try:
+                number = int(name[len("segment_"):-len(suffix)])
+            except ValueError:
+                continue
+            segments.append((number, os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def encode_block(records):
+    """Returns a block holding records, a list of
+    (timestamp, log_chan, watts, state) tuples."""
+    array = np.array([(timestamp, log_chan, watts,
+                       NO_STATE if state is None else state)
+                      for timestamp, log_chan, watts, state in records],
+                     dtype=RECORD)
+    payload = array.tobytes()
+    return BLOCK_HEADER.pack(MAGIC, len(array),
+                             zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def decode_segment(data):
+    """Decode the blocks of a segment, skipping torn or corrupt blocks by
+    scanning for the next block with a good magic and CRC.
+
+    Returns:
+        (records, n_bad_bytes): records is a structured array with
+        fields timestamp, log_chan, watts and state
+    """
+    chunks = []
+    n_good_bytes = 0
+    position = 0
+    while position + BLOCK_HEADER.size <= len(data):
+        magic, n_records, crc = BLOCK_HEADER.unpack_from(data, position)
+        start = position + BLOCK_HEADER.size
+        end = start + n_records * RECORD.itemsize
+        if (magic != MAGIC or end > len(data) or
+            zlib.crc32(data[start:end]) & 0xffffffff != crc):
+            position = data.find(MAGIC, position + 1)
+            if position < 0:
+                break
+            continue
+        chunks.append(np.frombuffer(data[start:end], dtype=RECORD))
+        n_good_bytes += end - position
+        position = end
+    records = np.concatenate(chunks) if chunks else np.empty(0, dtype=RECORD)
+    return records, len(data) - n_good_bytes
+
+
+def format_channel(records):
+    """Returns REDD-format text for one channel's records."""
+    has_state = records['state'] != NO_STATE
+    columns = np.column_stack([records['timestamp'], records['watts'],
+                               records['state']]).tolist()
+    return "".join(["{:d} {:d} {:d}\n".format(*row) if state else
+                    "{:d} {:d}\n".format(row[0], row[1])
+                    for row, state in zip(columns, has_state.tolist())])
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _channel_filename(data_directory, log_chan):
+    return os.path.join(data_directory, "channel_{:d}.dat".format(log_chan))
+
+
+class Demuxer(object):
+    """Demultiplexes closed segments into channel_N.dat files."""
+
+    def __init__(self, data_directory, directory=None):
+        self.data_directory = data_directory
+        self.directory = directory or ingest_directory(data_directory)
+        self.journal = os.path.join(self.directory, JOURNAL)
+
+    def run(self):
+        """Demultiplex every closed segment, oldest first.  Does nothing
+        if another demuxer holds the lock.
+
+        Returns:
+            (n_segments, n_records)
+        """
+        with open(os.path.join(self.directory, LOCK), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    log.info("Another demuxer is running on {}"
+                             .format(self.directory))
+                    return 0, 0
+                raise
+            data_lock = lock_data_directory(self.data_directory)
+            try:
+                self.recover()
+                n_segments = n_records = 0
+                for number, filename in list_segments(self.directory):
+                    n_records += self.demux_segment(filename)
+                    n_segments += 1
+            finally:
+                data_lock.close()
+            return n_segments, n_records
+
+    def recover(self):
+        """Finish or undo a demux which was interrupted."""
+        if not os.path.exists(self.journal):
+            for number, done in list_segments(self.directory, DONE):
+                os.remove(done) # committed, but not removed
+            return
+        with open(self.journal) as fh:
+            journal = json.load(fh)
+        segment = os.path.join(self.directory, journal['segment'])
+        if os.path.exists(segment):
+            log.info("Undoing interrupted demux of {}".format(segment))
+            for log_chan, size in journal['sizes'].items():
+                filename = _channel_filename(self.data_directory, int(log_chan))
+                if os.path.exists(filename) and os.path.getsize(filename) > size:
+                    with open(filename, 'r+b') as fh:
+                        fh.truncate(size)
+                        fh.flush()
+                        os.fsync(fh.fileno())
+        else:
+            done = segment[:-len(CLOSED)] + DONE
+            if os.path.exists(done):
+                os.remove(done)
+        os.remove(self.journal)
+
+    def demux_segment(self, filename):
+        """Returns the number of records demultiplexed."""
+        with open(filename, 'rb') as fh:
+            records, n_bad_bytes = decode_segment(fh.read())
+        if n_bad_bytes:
+            log.warning("Ignoring {} bytes of torn or corrupt data at the end"
+                        " of {}".format(n_bad_bytes, filename))
+        order = np.argsort(records['log_chan'], kind='mergesort') # stable
+        records = records[order]
+        log_chans, starts = np.unique(records['log_chan'], return_index=True)
+        ends = list(starts[1:]) + [len(records)]
+        log_chans = log_chans.tolist()
+
+        sizes = {}
+        for log_chan in log_chans:
+            channel = _channel_filename(self.data_directory, log_chan)
+            sizes[log_chan] = (os.path.getsize(channel)
+                               if os.path.exists(channel) else 0)
+        self._write_journal({'segment': os.path.basename(filename),
+                             'sizes': sizes})
+
+        for log_chan, start, end in zip(log_chans, starts, ends):
+            with open(_channel_filename(self.data_directory, log_chan),
+                      'ab') as fh:
+                fh.write(format_channel(records[start:end]).encode('ascii'))
+                fh.flush()
+                os.fsync(fh.fileno())
+
+        done = filename[:-len(CLOSED)] + DONE
+        os.rename(filename, done) # commit
+        _fsync_directory(self.directory)
+        os.remove(self.journal)
+        os.remove(done)
+        return len(records)
+
+    def _write_journal(self, journal):
+        temporary = self.journal + ".tmp"
+        with open(temporary, 'w') as fh:
+            json.dump(journal, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(temporary, self.journal)
+        _fsync_directory(self.directory)
+
+
+class IngestSink(Sink):
+    """Appends each batch as one block to the active segment."""
+
+    NAME = "ingest"
+
+    def __init__(self, data_directory, directory=None, segment=SEGMENT_SIZE,
+                 demux=DEMUX_INTERVAL, **kwargs):
+        super(IngestSink, self).__init__(**kwargs)
+        self.data_directory = data_directory
+        self.directory = directory or ingest_directory(data_directory)
+        self.segment_size = int(segment)
+        self.demux_interval = float(demux)
+        self.demuxer = Demuxer(data_directory, self.directory)
+        self._file = None
+        self._number = 0
+        self._opened_at = None
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Close any segment left active by a crash
+        for number, filename in list_segments(self.directory, ACTIVE):
+            log.info("Closing {} left by previous run".format(filename))
+            os.rename(filename, segment_filename(self.directory, number))
+        numbers = [number for number, dummy in
+                   list_segments(self.directory) +
+                   list_segments(self.directory, DONE)]
+        self._number = max(numbers or [0])
+        self._demux()
+
+    def write_batch(self, records):
+        if self._file is None:
+            self._number += 1
+            self._file = open(segment_filename(self.directory, self._number,
+                                               ACTIVE), 'ab')
+            self._opened_at = time.time()
+        self._file.write(encode_block(records))
+        self._file.flush()
+        if (self._file.tell() >= self.segment_size or
+            (self.demux_interval and
+             time.time() - self._opened_at >= self.demux_interval)):
+            # The batch has been written, so don't raise (which would make
+            # Sink write it again)
+            try:
+                self._close_segment()
+                self._demux()
+            except Exception:
+                log.exception("Failed to close or demultiplex segment {}"
+                              .format(self._number))
+
+    def _close_segment(self):
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        os.rename(segment_filename(self.directory, self._number, ACTIVE),
+                  segment_filename(self.directory, self._number))
+        _fsync_directory(self.directory)
+
+    def _demux(self):
+        if not self.demux_interval:
+            return
+        start = time.time()
+        n_segments, n_records = self.demuxer.run()
+        if n_segments:
+            log.info("Demultiplexed {} records from {} segments in {:.3f}s"
+                     .format(n_records, n_segments, time.time() - start))
+
+    def close(self):
+        if self._file is not None:
+            self._close_segment()
+        self._demux()
+
+
+def setup_argparser():
+    parser = argparse.ArgumentParser(description="Demultiplex closed ingest "
+                                     "log segments into channel_N.dat files.")
+    parser.add_argument('data_directory', metavar='DATA_DIR',
+                        help='directory holding the channel_N.dat files')
+    parser.add_argument('--directory', type=str,
+                        help='directory holding the segments '
+                        '(default: DATA_DIR/{})'.format(DIRECTORY))
+    parser.add_argument('--log', dest='loglevel', type=str, default='INFO',
+                        help='DEBUG or INFO or WARNING (default: INFO)')
+    return parser.parse_args()
+
+
+def main():
+    args = setup_argparser()
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+    start = time.time()
+    n_segments, n_records = Demuxer(args.data_directory, args.directory).run()
+    print("Demultiplexed {} records from {} segments in {:.3f}s"
+          .format(n_records, n_segments, time.time() - start))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
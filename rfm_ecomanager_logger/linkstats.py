@@ -0,0 +1,206 @@
+"""
+Streaming packet-loss statistics for each transmitter.
+
+EDF transmitters send a packet every few seconds on a nearly fixed cadence,
+so missed packets can be counted as they happen.  For each transmitter
+LinkStats learns the period between packets and keeps:
+
+    period       learned seconds between packets
+    received     packets received
+    expected     packets which should have been received, up to and
+                 including the last one received
+    duplicates   packets which arrived less than half a period after the
+                 previous one (not counted as received)
+    gap          seconds since the last packet
+    longest_gap  longest interval between two packets
+    alerts       times the transmitter has gone silent
+    sensors      for each sensor: readings, and how many were rejected by
+                 Sensor.log_data_to_disk's filters (too_high, too_soon)
+
+Each packet updates these in O(1).  A transmitter is reported as silent,
+with a warning in the log, once nothing has been heard from it for
+silence_multiple (default 10) learned periods, and is reported again when
+it comes back.
+
+Give the logger --link-stats FILENAME to have the statistics written
+(atomically, as compact JSON keyed by transmitter ID) every
+--link-stats-interval seconds.
+"""
+
+from __future__ import print_function, division
+import json
+import os
+import threading
+import time
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+
+ALPHA = 1 / 16 # weight of each new interval in the learned period
+SILENCE_MULTIPLE = 10 # learned periods without a packet before an alert
+INTERVAL = 60 # seconds between status files and silence checks
+
+
+class TransmitterStats(object):
+
+    def __init__(self, tx_type):
+        self.type = tx_type
+        self.period = None
+        self.n_intervals = 0
+        self.received = 0
+        self.expected = 0
+        self.duplicates = 0
+        self.last_time = None
+        self.longest_gap = 0
+        self.silent = False
+        self.alerts = 0
+        self.sensors = {} # s_id: {'readings': n, reason: n}
+
+    def packet(self, timecode):
+        """Returns the length of the silence which has just ended, if the
+        transmitter had been reported silent, else None."""
+        if self.last_time is None:
+            self.received = self.expected = 1
+            self.last_time = timecode
+            return None
+        interval = timecode - self.last_time
+        if self.period is not None and interval < self.period / 2:
+            self.duplicates += 1
+            return None
+        if self.period is None:
+            slots = 1
+        else:
+            slots = max(int(interval / self.period + 0.5), 1)
+        if slots == 1:
+            # Average the first few intervals, then follow slow drift
+            self.n_intervals += 1
+            alpha = max(1 / self.n_intervals, ALPHA)
+            self.period = (interval if self.period is None else
+                           self.period + (interval - self.period) * alpha)
+        self.received += 1
+        self.expected += slots
+        self.longest_gap = max(self.longest_gap, interval)
+        self.last_time = timecode
+        if self.silent:
+            self.silent = False
+            return interval
+        return None
+
+    def reading(self, s_id, reason):
+        counts = self.sensors.get(s_id)
+        if counts is None:
+            counts = self.sensors[s_id] = {'readings': 0}
+        counts['readings'] += 1
+        if reason is not None:
+            counts[reason] = counts.get(reason, 0) + 1
+
+    def is_silent(self, now, silence_multiple):
+        return (self.period is not None and
+                now - self.last_time > silence_multiple * self.period)
+
+    def status(self, now):
+        return {'type': self.type,
+                'period': None if self.period is None else round(self.period, 2),
+                'received': self.received,
+                'expected': self.expected,
+                'duplicates': self.duplicates,
+                'gap': round(now - self.last_time, 1),
+                'longest_gap': round(self.longest_gap, 1),
+                'silent': self.silent,
+                'alerts': self.alerts,
+                'sensors': dict((str(s_id), counts.copy())
+                                for s_id, counts in self.sensors.iteritems())}
+
+
+class LinkStats(object):
+    """Statistics for every transmitter on every base unit.  packet() and
+    reading() are called from the base units' threads."""
+
+    def __init__(self, silence_multiple=None):
+        self.silence_multiple = float(silence_multiple or SILENCE_MULTIPLE)
+        self._lock = threading.Lock()
+        self._transmitters = {} # tx.id: TransmitterStats
+        self._stop = threading.Event()
+        self._thread = None
+
+    def packet(self, tx, timecode):
+        with self._lock:
+            stats = self._transmitters.get(tx.id)
+            if stats is None:
+                stats = self._transmitters[tx.id] = TransmitterStats(tx.TYPE)
+            silence = stats.packet(timecode)
+        if silence is not None:
+            log.info("{} {} is transmitting again after {:.0f} s of silence"
+                     .format(tx.TYPE, tx.id, silence))
+
+    def reading(self, tx, s_id, reason=None):
+        """Record a reading from sensor s_id of tx.  reason is what
+        Sensor.log_data_to_disk returned: None if the reading was logged."""
+        with self._lock:
+            stats = self._transmitters.get(tx.id)
+            if stats is not None:
+                stats.reading(s_id, reason)
+
+    def check_silence(self, now=None):
+        """Warn about transmitters which have just gone silent.
+
+        Returns:
+            list of IDs of the transmitters which have just gone silent
+        """
+        now = time.time() if now is None else now
+        silenced = []
+        with self._lock:
+            for tx_id, stats in self._transmitters.iteritems():
+                if (not stats.silent and
+                    stats.is_silent(now, self.silence_multiple)):
+                    stats.silent = True
+                    stats.alerts += 1
+                    silenced.append((tx_id, stats))
+        for tx_id, stats in silenced:
+            log.warn("{} {} has been silent for {:.0f} s (usually transmits"
+                     " every {:.1f} s)".format(stats.type, tx_id,
+                                               now - stats.last_time,
+                                               stats.period))
+        return [tx_id for tx_id, dummy in silenced]
+
+    def status(self, now=None):
+        """Returns a dict mapping transmitter ID (str) to its statistics."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return dict((str(tx_id), stats.status(now))
+                        for tx_id, stats in self._transmitters.iteritems())
+
+    def write(self, filename, now=None):
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w') as fh:
+            json.dump(self.status(now), fh, separators=(',', ':'),
+                      sort_keys=True)
+        os.rename(tmp_filename, filename)
+
+    def start(self, filename=None, interval=None):
+        """Check for silent transmitters, and write the statistics to
+        filename if it is given, every interval seconds."""
+        interval = float(interval or INTERVAL)
+        if filename:
+            log.info("Writing link statistics to {} every {} s"
+                     .format(filename, interval))
+        self._thread = threading.Thread(target=self._run, name="linkstats",
+                                        args=(filename, interval))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, filename, interval):
+        while True:
+            stopping = self._stop.wait(interval)
+            try:
+                self.check_silence()
+                if filename:
+                    self.write(filename)
+            except Exception:
+                log.exception("Failed to update link statistics")
+            if stopping:
+                break
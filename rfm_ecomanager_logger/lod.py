@@ -0,0 +1,267 @@
+"""
+Level-of-detail (LOD) pyramids for plotting long time ranges without
+loading every sample.
+
+Each level summarises a channel_N.dat file in buckets of 2**exponent
+seconds, for each exponent in LEVELS (16 seconds up to about 48 days).
+Each level is a separate file, channel_N_lod<exponent>.lod, of fixed-size
+binary records, one per non-empty bucket, in time order:
+
+    start (uint32)        UNIX time of the start of the bucket (a multiple
+                          of the bucket width)
+    count (uint32)        number of samples in the bucket
+    mean (float32)        mean watts
+    min, max (float32)    min and max watts
+
+The finest level is built by scanning channel_N.dat in blocks with NumPy
+and each coarser level is built from the level below it.  update() only
+rebuilds the last bucket of each level and carries on from there, so it
+can be run as often as new data arrive.
+
+query() picks the coarsest level with at least one bucket per pixel for
+the requested time range, so plotting a year of data 1000 pixels wide
+reads a few thousand records instead of millions of lines.
+
+Example:
+
+    import lod
+    lod.update('/data/house_1/channel_1.dat')
+    seconds, buckets = lod.query('/data/house_1', 'aggregate',
+                                 start=1360396444, end=1391932444, width=1000)
+    plot(buckets['start'], buckets['min'], buckets['start'], buckets['max'])
+"""
+
+from __future__ import print_function, division
+import os
+import numpy as np
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+import reader
+
+LEVELS = range(4, 24, 2) # bucket width of each level is 2**exponent seconds
+DTYPE = np.dtype([('start', '<u4'), ('count', '<u4'), ('mean', '<f4'),
+                  ('min', '<f4'), ('max', '<f4')])
+BLOCK_SIZE = 2**22 # bytes of channel_N.dat read at a time
+CHUNK_SIZE = 2**18 # records of the level below read at a time
+BISECT_SIZE = 2**16 # stop bisecting channel_N.dat when this close
+DEFAULT_WIDTH = 1000 # pixels
+
+
+def lod_filename(data_filename, exponent):
+    return (os.path.splitext(data_filename)[0] +
+            "_lod{:02d}.lod".format(exponent))
+
+
+class _Level(object):
+    """Appends buckets to one level's file.  The last bucket is held back
+    until close() in case more samples fall into it."""
+
+    def __init__(self, filename, exponent):
+        self.filename = filename
+        self.seconds = 2**exponent
+        self.pending = None # (start, count, total, min, max)
+
+    def add(self, starts, counts, totals, mins, maxs):
+        """Add samples (or buckets of a finer level) which start at starts,
+        which must be multiples of self.seconds."""
+        if not len(starts):
+            return
+        if self.pending is not None:
+            starts, counts, totals, mins, maxs = [
+                np.concatenate([[pending], values]) for pending, values
+                in zip(self.pending, [starts, counts, totals, mins, maxs])]
+        # Out-of-order samples go into the latest bucket so far, which
+        # keeps the file in time order
+        starts = np.maximum.accumulate(starts)
+        first = np.flatnonzero(np.concatenate([[True],
+                                               starts[1:] != starts[:-1]]))
+        buckets = np.zeros(len(first), dtype=DTYPE)
+        buckets['start'] = starts[first]
+        buckets['count'] = np.add.reduceat(counts, first)
+        buckets['mean'] = np.add.reduceat(totals, first) / buckets['count']
+        buckets['min'] = np.minimum.reduceat(mins, first)
+        buckets['max'] = np.maximum.reduceat(maxs, first)
+        last = buckets[-1]
+        self.pending = (last['start'], last['count'],
+                        float(last['mean']) * last['count'],
+                        last['min'], last['max'])
+        self._write(buckets[:-1])
+
+    def close(self):
+        if self.pending is not None:
+            start, count, total, min_watts, max_watts = self.pending
+            self._write(np.array([(start, count, total / count, min_watts,
+                                   max_watts)], dtype=DTYPE))
+            self.pending = None
+
+    def _write(self, buckets):
+        if len(buckets):
+            with open(self.filename, 'ab') as lod_file:
+                lod_file.write(buckets.tobytes())
+
+
+def _load(filename):
+    """Returns a read-only memmap of the records in filename, ignoring any
+    partial record at the end."""
+    n_records = (os.path.getsize(filename) // DTYPE.itemsize
+                 if os.path.exists(filename) else 0)
+    if not n_records:
+        return np.zeros(0, dtype=DTYPE)
+    return np.memmap(filename, dtype=DTYPE, mode='r', shape=(n_records,))
+
+
+def _truncate(filename, start):
+    """Remove the records in filename from start onwards."""
+    if not os.path.exists(filename):
+        return
+    i = np.searchsorted(_load(filename)['start'], start, side='left')
+    with open(filename, 'r+b') as lod_file:
+        lod_file.truncate(i * DTYPE.itemsize)
+
+
+def _find_offset(data_file, file_size, timestamp):
+    """Bisect the (time-ordered) data_file for a line start before the
+    first line at or after timestamp.  All lines before the returned
+    offset are earlier than timestamp."""
+    lo, hi = 0, file_size
+    while hi - lo > BISECT_SIZE:
+        mid = (lo + hi) // 2
+        data_file.seek(mid)
+        data_file.readline() # skip the rest of the line we landed in
+        position = data_file.tell()
+        line = data_file.readline()
+        try:
+            if not line.endswith('\n'):
+                raise ValueError()
+            line_timestamp = float(line.split(' ', 1)[0])
+        except ValueError:
+            hi = mid
+            continue
+        if line_timestamp < timestamp:
+            lo = position + len(line)
+        else:
+            hi = mid
+    return lo
+
+
+def _extend_first_level(data_filename, level, resume, block_size):
+    """Add the samples in data_filename at or after resume (a UNIX time, or
+    None for all samples) to level."""
+    file_size = os.path.getsize(data_filename)
+    with open(data_filename, 'rb') as data_file:
+        position = (0 if resume is None else
+                    _find_offset(data_file, file_size, resume))
+        data_file.seek(position)
+        remainder = ''
+        while True:
+            block = data_file.read(block_size)
+            if not block:
+                break
+            text = remainder + block
+            end = text.rfind('\n') + 1
+            remainder = text[end:] # incl. a truncated final line
+            timestamps, watts, dummy = reader.parse_text(text[:end])
+            keep = np.isfinite(timestamps) & np.isfinite(watts)
+            if resume is not None:
+                keep &= timestamps >= resume
+            timestamps = timestamps[keep]
+            watts = watts[keep]
+            starts = (timestamps // level.seconds).astype(np.int64) * level.seconds
+            level.add(starts, np.ones(len(watts), dtype=np.int64),
+                      watts, watts, watts)
+    level.close()
+
+
+def _extend_level(finer_filename, level, resume):
+    """Add the buckets in finer_filename which start at or after resume
+    to (the coarser) level."""
+    finer = _load(finer_filename)
+    i = np.searchsorted(finer['start'], resume, side='left')
+    for j in range(i, len(finer), CHUNK_SIZE):
+        chunk = np.array(finer[j:j + CHUNK_SIZE])
+        counts = chunk['count'].astype(np.int64)
+        starts = chunk['start'].astype(np.int64)
+        level.add(starts - starts % level.seconds, counts,
+                  chunk['mean'].astype(np.float64) * counts,
+                  chunk['min'], chunk['max'])
+    level.close()
+
+
+def update(data_filename, block_size=BLOCK_SIZE):
+    """Build the LOD files for data_filename or, if they exist, extend
+    them with any samples logged since they were last updated.  Delete the
+    LOD files first to rebuild them after rewriting data_filename."""
+    filenames = [lod_filename(data_filename, exponent) for exponent in LEVELS]
+    finest = _load(filenames[0])
+    resume = int(finest['start'][-1]) if len(finest) else None
+    del finest
+
+    levels = [_Level(filename, exponent)
+              for filename, exponent in zip(filenames, LEVELS)]
+    for filename, level in zip(filenames, levels):
+        if resume is None:
+            if os.path.exists(filename):
+                os.remove(filename)
+        else:
+            # The last bucket may have been incomplete
+            _truncate(filename, resume - resume % level.seconds)
+
+    _extend_first_level(data_filename, levels[0], resume, block_size)
+    for finer_filename, level in zip(filenames, levels[1:]):
+        _extend_level(finer_filename, level,
+                      0 if resume is None else resume - resume % level.seconds)
+
+
+def update_data_dir(data_dir):
+    """update() every channel in data_dir (a reader.DataDirectory)."""
+    for chan in data_dir.channels():
+        update(data_dir.filename(chan))
+
+
+def choose_level(duration, width=DEFAULT_WIDTH):
+    """Returns the exponent of the coarsest level with at least one bucket
+    per pixel when plotting duration seconds width pixels wide."""
+    seconds_per_pixel = duration / width
+    exponents = [exponent for exponent in LEVELS
+                 if 2**exponent <= seconds_per_pixel]
+    return exponents[-1] if exponents else LEVELS[0]
+
+
+def query(data_dir, channel, start=None, end=None, width=DEFAULT_WIDTH):
+    """
+    Args:
+        data_dir (str or reader.DataDirectory)
+        channel (int or str): channel number or label synonym
+        start, end (float or datetime): Optional.  Time range to plot.
+            Naive datetimes are interpreted in the data directory's timezone.
+            Default to the first and last samples.
+        width (int): width of the plot in pixels
+
+    Returns:
+        (seconds, buckets): the width of each bucket in seconds and a
+        structured np.ndarray with fields start, count, mean, min and max
+        for the buckets which overlap [start, end].  Only those buckets are
+        read from disk.
+    """
+    if not isinstance(data_dir, reader.DataDirectory):
+        data_dir = reader.DataDirectory(data_dir)
+    data_filename = data_dir.filename(data_dir.resolve(channel))
+    start = reader._to_timestamp(start, data_dir.tz)
+    end = reader._to_timestamp(end, data_dir.tz)
+    if start is None or end is None:
+        finest = _load(lod_filename(data_filename, LEVELS[0]))
+        if not len(finest):
+            return 2**LEVELS[0], np.zeros(0, dtype=DTYPE)
+        if start is None:
+            start = int(finest['start'][0])
+        if end is None:
+            end = int(finest['start'][-1]) + 2**LEVELS[0]
+        del finest
+
+    exponent = choose_level(end - start, width)
+    seconds = 2**exponent
+    buckets = _load(lod_filename(data_filename, exponent))
+    starts = buckets['start']
+    i = np.searchsorted(starts, start - seconds, side='right')
+    j = np.searchsorted(starts, end, side='right')
+    return seconds, np.array(buckets[i:j])
@@ -3,12 +3,23 @@ from transmitter import Cc_tx, Cc_trx, TransmitterError, NeedToPickle
 import pickle
 import time
 import sys
+import threading
+import collections
+import Queue
 import logging
 import ConfigParser
 log = logging.getLogger("rfm_ecomanager_logger")
 import os, inspect
-from nanode import NanodeRestart, NanodeTooManyRetries, Nanode, NanodeDataWaiting
+from nanode import (NanodeRestart, NanodeTooManyRetries, Nanode,
+                    NanodeDataWaiting, NanodeError)
 from input_with_cancel import *
+from sinks import SinkDispatcher, SinkError, create_sink
+from metrics import Metrics
+from switchback import SwitchBackScheduler
+from heartbeat import Heartbeat
+from linkstats import LinkStats
+from control import Controller, ControlServer
+import reader
 
 FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
 
@@ -16,38 +27,75 @@ from os import path
 
 path.join('a')
 
+# Seconds to wait for a base unit's thread to run a function
+BASE_UNIT_TIMEOUT = 30
+
 class Manager(object):
     """ 
     Attributes:
-      - nanode (Nanode)
+      - nanodes (dict): maps port (str) to Nanode, one per base unit
+      - nanode (Nanode): the first base unit.  Used for editing and
+        new transmitters are assigned to it.
       - transmitters (dict of Transmitters)
+      - sinks (SinkDispatcher): outputs shared by all sensors on all
+        base units
+      - metrics (Metrics): shared by all base units
+      - switch_back (SwitchBackScheduler): restores TRXs after power cuts
+      - link_stats (LinkStats): packet loss and gaps for each transmitter
+      - heartbeat (Heartbeat): None unless args.heartbeat is set
+      - control (ControlServer): None unless args.control_socket is set
       - args
       - abort (boolean)
+      - reload_requested (boolean): set by SIGHUP; see reload()
+      - resuming (boolean): appending to an existing data directory
+        (args.resume); see _resume()
       - _require_pair_request (boolean)
       
     """
     
     PICKLE_FILE = os.path.join(FILE_PATH, "..", "radioIDs.pkl")
     
-    def __init__(self, nanode, args):
-        self.nanode = nanode
+    def __init__(self, nanodes, args):
+        self.nanodes = {}
+        self.nanode = None
+        self.metrics = Metrics()
+        self.switch_back = SwitchBackScheduler()
+        self.link_stats = LinkStats(getattr(args, 'silence_multiple', None))
+        for nanode in nanodes or []:
+            self.nanodes[nanode.port] = nanode
+            self.metrics.add_base_unit(nanode.port)
+            if self.nanode is None:
+                self.nanode = nanode
         self.args = args
         self.abort = False
+        self.reload_requested = False
+        self.resuming = False
+        self.sinks = SinkDispatcher()
+        self.heartbeat = None
+        self.control = None
         self._require_pair_request = True        
+        self._pickle_lock = threading.Lock()
+        # Functions waiting to be run by each base unit's thread
+        self._base_unit_queues = dict((port, Queue.Queue())
+                                      for port in self.nanodes)
+        # Called with (nanode, data) for packets which aren't readings from
+        # known transmitters (see add_listener)
+        self._listeners = []
+        self._listeners_lock = threading.Lock()
 
     def unpickle(self):
         # if radioIDs.pkl exists then open it and load data, tell Nanode
         # how many TXs and TRXs there are and then inform Nanode of
         # each TX and TRX.
         try:
-            pkl_file = open(Manager.PICKLE_FILE, "rb")
+            pkl_file = open(self.args.pickle_file, "rb")
         except:
             if self.args.edit:
                 self.transmitters = {}
             else:
                 log.critical("{:s} file not found. Please run with --edit "
                              "command line option to train the system before "
-                             "logging data.".format(Manager.PICKLE_FILE))
+                             "logging data.".format(self.args.pickle_file))
                 sys.exit(1)
                 
         else:
@@ -58,23 +106,44 @@ class Manager(object):
                 self._pre_process_data_directory()
                 self._create_labels_file()
                 self._create_metadata_file()
+                self._create_sinks()
+                self._create_heartbeat()
 
             for dummy, tx in self.transmitters.iteritems():
                 tx.unpickle(self)
+                if tx.base_unit is None:
+                    # Pickled before we supported multiple base units
+                    tx.base_unit = self.nanode.port
+                elif tx.base_unit not in self.nanodes:
+                    log.warn("Transmitter {} is assigned to base unit {} "
+                             "which is not open. It will not be logged."
+                             .format(tx.id, tx.base_unit))
+            if self.resuming:
+                self._resume()
             
-            self._tell_nanode_about_transmitters()
+            for nanode in self.nanodes.itervalues():
+                self._tell_nanode_about_transmitters(nanode)
                         
-    def _create_labels_file(self):
+    def _get_labels(self):
+        """Returns a sorted list of (log_chan, name) tuples."""
         log_chans = []
         for dummy, tx in self.transmitters.iteritems():
             for dummy, sensor in tx.sensors.iteritems():
                 log_chans.append((sensor.log_chan, sensor.name))
         
         log_chans.sort()
+        return log_chans
+
+    def _create_labels_file(self):
+        log_chans = self._get_labels()
 
-        with open(self.args.data_directory + "/labels.dat", "w") as labels_file:
+        # Write a new file and rename it into place so that readers never
+        # see a half-written labels.dat (we rewrite it on reload)
+        filename = self.args.data_directory + "/labels.dat"
+        with open(filename + ".tmp", "w") as labels_file:
             for log_chan, name in log_chans:
                 labels_file.write("{:d} {:s}\n".format(log_chan, name))
+        os.rename(filename + ".tmp", filename)
             
     def _pre_process_data_directory(self):
         """If args.data_directory is set then correctly format it.
@@ -84,9 +153,11 @@ class Manager(object):
         Create a new directory if necessary.
         """
         
+        resume = getattr(self.args, 'resume', False)
         if self.args.data_directory:
             # append trailing slash to data_directory if necessary
             self.args.data_directory = os.path.realpath(self.args.data_directory)
+            self.resuming = resume and os.path.isdir(self.args.data_directory)
                 
             # if directory doesn't exist then create it
             if not os.path.isdir(self.args.data_directory):
@@ -113,6 +184,14 @@ class Manager(object):
                                        if not any(char.isalpha() for char in subdir)]
                     
                     numeric_subdirs.sort()
+                    if resume and numeric_subdirs:
+                        latest = data_dir + "/" + numeric_subdirs[-1]
+                        if self._can_resume(latest):
+                            log.info("Resuming data directory {}"
+                                     .format(latest))
+                            self.args.data_directory = latest
+                            self.resuming = True
+                            return
                     try:
                         new_subdir_number = int(numeric_subdirs[-1]) + 1
                     except:
@@ -130,6 +209,68 @@ class Manager(object):
                              " --data-directory")
                 sys.exit(1)
                 
+    def _can_resume(self, data_dir):
+        """Returns True if data_dir's labels.dat gives every channel which
+        is still being logged the same name as now."""
+        labels_filename = os.path.join(data_dir, "labels.dat")
+        if not os.path.exists(labels_filename):
+            log.info("Not resuming {}: it has no labels.dat".format(data_dir))
+            return False
+        old_labels = dict((chan, "/".join(synonyms)) for chan, synonyms
+                          in reader.load_labels_file(labels_filename).items())
+        old_chans = dict((name, chan) for chan, name in old_labels.items())
+        for log_chan, name in self._get_labels():
+            name = "/".join(synonym.strip() for synonym in name.split("/"))
+            if (old_labels.get(log_chan, name) != name or
+                old_chans.get(name, log_chan) != log_chan):
+                log.info("Not resuming {}: channel {} was called {} and is now"
+                         " called {}".format(data_dir, log_chan,
+                                             old_labels.get(log_chan),
+                                             name))
+                return False
+        return True
+
+    def _resume(self):
+        """Carry on from the end of each channel file in the data directory.
+        Only the tail of each file is read, so this takes O(channels)."""
+        n_resumed = 0
+        for tx in self.transmitters.itervalues():
+            for sensor in tx.sensors.itervalues():
+                if not sensor.log_chan or not os.path.exists(sensor.filename):
+                    continue
+                last_timestamp, complete_size = reader.read_tail(sensor.filename)
+                size = os.path.getsize(sensor.filename)
+                if complete_size < size:
+                    log.warn("Removing truncated final line ({} bytes) from {}"
+                             .format(size - complete_size, sensor.filename))
+                    with open(sensor.filename, 'r+b') as fh:
+                        fh.truncate(complete_size)
+                if last_timestamp is not None:
+                    sensor.last_logged_timecode = last_timestamp
+                    n_resumed += 1
+        log.info("Resumed {} channels in {}"
+                 .format(n_resumed, self.args.data_directory))
+
+    def _create_sinks(self):
+        for spec in self.args.sinks or ["redd"]:
+            try:
+                sink = create_sink(spec, self.args.data_directory,
+                                   dict(self._get_labels()))
+            except SinkError as e:
+                log.critical("Invalid --sink: {}".format(e))
+                sys.exit(1)
+            self.sinks.add(sink)
+
+    def _create_heartbeat(self):
+        if not getattr(self.args, 'heartbeat', None):
+            return
+        try:
+            self.heartbeat = Heartbeat(self.args.heartbeat, self,
+                                       self.args.heartbeat_interval)
+        except SinkError as e:
+            log.critical("Invalid --heartbeat: {}".format(e))
+            sys.exit(1)
+
     def _create_metadata_file(self):
         TZFILE_NAME = '/etc/timezone'
         try:
@@ -149,32 +290,39 @@ class Manager(object):
             
             return metadata_filename
 
-    def _restart_nanode(self):
-        log.info("restart_nanode. Initialising nanode...")
-        self.nanode.init_nanode()
-        self._tell_nanode_about_transmitters()
+    def _restart_nanode(self, nanode):
+        log.info("restart_nanode {}. Initialising nanode...".format(nanode.port))
+        self.metrics.increment(nanode.port, 'restarts')
+        nanode.init_nanode()
+        self._tell_nanode_about_transmitters(nanode)
         log.info("Nanode has been re-initalised.")                
 
-    def _tell_nanode_about_transmitters(self):
-        self.nanode.send_command("d") # delete all TXs
-        self.nanode.send_command("D") # delete all TRXs        
-        if self.transmitters:
-            num_txs, num_trxs = self._count_transmitters()
-            log.info("Adding {} TXs and {} TRXs to Nanode."
-                     .format(num_txs, num_trxs))
+    def _transmitters_for(self, nanode):
+        return [tx for tx in self.transmitters.itervalues()
+                if tx.base_unit == nanode.port]
+
+    def _tell_nanode_about_transmitters(self, nanode):
+        nanode.send_command("d") # delete all TXs
+        nanode.send_command("D") # delete all TRXs        
+        transmitters = self._transmitters_for(nanode)
+        if transmitters:
+            num_txs, num_trxs = self._count_transmitters(transmitters)
+            log.info("Adding {} TXs and {} TRXs to Nanode on {}."
+                     .format(num_txs, num_trxs, nanode.port))
             if num_txs:
-                self.nanode.send_command('s', num_txs)
+                nanode.send_command('s', num_txs)
             if num_trxs:
-                self.nanode.send_command('S', num_trxs)       
-            for dummy, tx in self.transmitters.iteritems():
+                nanode.send_command('S', num_trxs)       
+            for tx in transmitters:
                 tx.add_to_nanode()
         else:
-            log.warn("No transmitters to add to Nanode!")
+            log.warn("No transmitters to add to Nanode on {}!"
+                     .format(nanode.port))
 
-    def _count_transmitters(self):
+    def _count_transmitters(self, transmitters):
         num_txs = 0
         num_trxs = 0
-        for dummy, tx in self.transmitters.iteritems():
+        for tx in transmitters:
             tx.manager = self
             if isinstance(tx, Cc_tx):
                 num_txs += 1
@@ -184,50 +332,268 @@ class Manager(object):
         return num_txs, num_trxs
 
     def run_logging(self):
+        """Log from every base unit concurrently, one thread per base unit,
+        until self.abort is set or a base unit fails."""
         log.info("Running logging mode. Press CTRL+C to exit.")
-        while not self.abort:
+        self.sinks.start()
+        if self.heartbeat:
+            self.heartbeat.start()
+        self.link_stats.start(getattr(self.args, 'link_stats', None),
+                              getattr(self.args, 'link_stats_interval', None))
+        if getattr(self.args, 'control_socket', None):
+            self.control = ControlServer(self.args.control_socket,
+                                         Controller(self))
+            self.control.start()
+        threads = []
+        for port, nanode in self.nanodes.iteritems():
+            thread = threading.Thread(target=self._run_base_unit, name=port,
+                                      args=(nanode,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # Don't call join() without a timeout: it would block signals.
+        while not self.abort and all(thread.is_alive() for thread in threads):
+            if self.reload_requested:
+                self.reload_requested = False
+                try:
+                    self.reload()
+                except Exception:
+                    log.exception("Failed to reload configuration.")
+            time.sleep(0.5)
+
+        self._stop_base_units()
+        if self.control:
+            self.control.stop()
+        for thread in threads:
+            thread.join()
+        self.sinks.stop()
+        self._flush_rollups()
+        self.link_stats.stop()
+        if self.heartbeat:
+            self.heartbeat.stop()
+
+    def _stop_base_units(self):
+        self.abort = True
+        for nanode in self.nanodes.itervalues():
+            nanode.abort = True
+
+    def _run_base_unit(self, nanode):
+        try:
+            self._log_from_base_unit(nanode)
+        except (Exception, SystemExit):
+            log.exception("Base unit on {} failed. Stopping logging."
+                          .format(nanode.port))
+            self._stop_base_units()
+
+    def run_on_base_unit(self, port, func):
+        """Run func(nanode) on the thread which reads from the base unit
+        on port, between packets.  Nanodes aren't thread safe so this is
+        the only way other threads may talk to a Nanode while logging."""
+        self._base_unit_queues[port].put(func)
+
+    def call_on_base_unit(self, port, func, timeout=BASE_UNIT_TIMEOUT):
+        """Like run_on_base_unit() but waits for func to finish.
+
+        Returns:
+            whatever func returns.  Exceptions raised by func are re-raised.
+
+        Raises:
+            NanodeError if the base unit's thread doesn't run func
+            within timeout seconds.
+        """
+        done = threading.Event()
+        result = {}
+        def call(nanode):
             try:
-                data = self._read_sensor_data(retries=7)
+                result['value'] = func(nanode)
+            except Exception as e:
+                result['error'] = e
+            finally:
+                done.set()
+        self.run_on_base_unit(port, call)
+        if not done.wait(timeout):
+            raise NanodeError("Timed out waiting for base unit {}".format(port))
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def add_listener(self, listener):
+        """Call listener(nanode, data) from the base unit threads for every
+        pairing request, pair acknowledgement and packet from an unknown
+        transmitter.  Listeners must return quickly."""
+        with self._listeners_lock:
+            self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        with self._listeners_lock:
+            self._listeners = [l for l in self._listeners if l is not listener]
+
+    def _notify_listeners(self, nanode, data):
+        for listener in self._listeners:
+            try:
+                listener(nanode, data)
+            except Exception:
+                log.exception("Listener failed")
+
+    def save_registry(self, transmitters):
+        """Swap in a new transmitter registry while logging, then rewrite
+        labels.dat, update the sinks' labels and pickle the registry."""
+        self.transmitters = transmitters
+        self._create_labels_file()
+        self.sinks.set_labels(dict(self._get_labels()))
+        self._pickle()
+
+    def _run_base_unit_queue(self, nanode):
+        queue = self._base_unit_queues.get(nanode.port)
+        while queue is not None:
+            try:
+                func = queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                func(nanode)
+            except NanodeRestart:
+                self._restart_nanode(nanode)
+            except Exception:
+                log.exception("Failed to run {} on base unit {}"
+                              .format(getattr(func, '__name__', func),
+                                      nanode.port))
+
+    def _log_from_base_unit(self, nanode):
+        while not self.abort and not nanode.abort:
+            self.metrics.loop_iteration(nanode.port)
+            self._run_base_unit_queue(nanode)
+            self.switch_back.service(nanode)
+            try:
+                data = self._read_sensor_data(retries=7, nanode=nanode)
             except NanodeTooManyRetries, e:
                 log.error(e)
-                log.error("The Nanode has probably crashed. "
-                          "Checking for sure by attempting to get time from Nanode.")
+                log.error("The Nanode on {} has probably crashed. "
+                          "Checking for sure by attempting to get time from Nanode."
+                          .format(nanode.port))
                 
                 try:
-                    self.nanode._get_nanode_time()
+                    nanode._get_nanode_time()
                 except NanodeDataWaiting, e:
                     log.warn("Attempted to get nanode_time but data is "
                               "waiting so continuing logging loop.")
                     log.warn("NanodeDataWaiting({}) (data lost)".format(e))
                     continue
                 except NanodeRestart:
-                    self._restart_nanode()
+                    self._restart_nanode(nanode)
                     continue
                 except NanodeTooManyRetries:
                     # Nanode must have crashed so try to restart                    
                     log.error("Nanode isn't responding so attempting to restart.")
-                    self.nanode._serial.close()
-                    self.nanode._open_port()
-                    self._restart_nanode()
+                    nanode._serial.close()
+                    nanode._open_port()
+                    self._restart_nanode(nanode)
                     log.info("Nanode restarted")
                 else:
                     log.info("Nanode responded to time check.")
             else:
                 if data:
-                    if data.tx_id in self.transmitters:
+                    self.metrics.packet_received(nanode.port, time.time())
+                    if data.pair_ack or data.is_pairing_request:
+                        self._notify_listeners(nanode, data)
+                    elif data.tx_id in self.transmitters:
                         self.transmitters[data.tx_id].new_reading(data)
                         if (self.transmitters[data.tx_id].TYPE == "TRX" and 
                             self.transmitters[data.tx_id].state_just_changed):
                             self._pickle()
                     else:
+                        self.metrics.increment(nanode.port, 'unknown_tx')
                         log.error("Unknown TX: {}".format(data.tx_id))
+                        self._notify_listeners(nanode, data)
+
+    def reload(self):
+        """Reload the transmitter registry from the pickle file while
+        logging.  Transmitters which are unchanged keep their runtime state;
+        the Nanodes are only told about transmitters which have been added,
+        removed, changed type or moved to another base unit."""
+        log.info("Reloading {}".format(self.args.pickle_file))
+        with open(self.args.pickle_file, "rb") as pkl_file:
+            reloaded = pickle.load(pkl_file)
+
+        transmitters = {}
+        to_delete = collections.defaultdict(list) # port: [Transmitter]
+        to_add = collections.defaultdict(list)
+        retired_sensors = collections.defaultdict(list)
+        for tx_id, new_tx in reloaded.iteritems():
+            new_tx.unpickle(self)
+            if new_tx.base_unit is None:
+                new_tx.base_unit = self.nanode.port
+            old_tx = self.transmitters.get(tx_id)
+            if (old_tx is not None and old_tx.TYPE == new_tx.TYPE and
+                old_tx.base_unit == new_tx.base_unit):
+                retired_sensors[old_tx.base_unit].extend(
+                    old_tx.update_sensors(new_tx.sensors))
+                transmitters[tx_id] = old_tx
+            else:
+                if old_tx is not None:
+                    to_delete[old_tx.base_unit].append(old_tx)
+                to_add[new_tx.base_unit].append(new_tx)
+                transmitters[tx_id] = new_tx
+        for tx_id, old_tx in self.transmitters.iteritems():
+            if tx_id not in reloaded:
+                to_delete[old_tx.base_unit].append(old_tx)
+        for port, txs in to_delete.iteritems():
+            for tx in txs:
+                retired_sensors[port].extend(tx.sensors.values())
 
-    def _read_sensor_data(self, retries=Nanode.MAX_RETRIES):
+        # Swap in the new registry with a single assignment: the base unit
+        # threads see either the old or the new one and never wait.
+        self.transmitters = transmitters
+        self._create_labels_file()
+        self.sinks.set_labels(dict(self._get_labels()))
+
+        for port in set(to_delete) | set(to_add) | set(retired_sensors):
+            if port in self.nanodes:
+                self.run_on_base_unit(port, self._update_base_unit_func(
+                    to_delete[port], to_add[port], retired_sensors[port]))
+            else:
+                for sensor in retired_sensors[port]:
+                    sensor.flush_rollups()
+        log.info("Reloaded: {} transmitters added and {} removed."
+                 .format(sum(len(txs) for txs in to_add.itervalues()),
+                         sum(len(txs) for txs in to_delete.itervalues())))
+
+    def _update_base_unit_func(self, to_delete, to_add, retired_sensors):
+        """Returns a function for run_on_base_unit() which applies the
+        changes found by reload() to one base unit."""
+        def update_base_unit(nanode):
+            # Sensors' rollups are only touched from this thread
+            for sensor in retired_sensors:
+                sensor.flush_rollups()
+            try:
+                for tx in to_delete:
+                    nanode.send_command(tx.DEL_COMMAND, tx.id)
+                for tx in to_add:
+                    nanode.send_command(tx.ADD_COMMAND, tx.id)
+            except NanodeRestart:
+                # Forgot every transmitter: initialise it and re-send them all
+                self._restart_nanode(nanode)
+            except NanodeError as e:
+                # e.g. the Nanode has run out of room for transmitters
+                log.warn("Failed to update transmitters on {} ({}). "
+                         "Re-sending all transmitters.".format(nanode.port, e))
+                self._tell_nanode_about_transmitters(nanode)
+        return update_base_unit
+
+    def _flush_rollups(self):
+        log.info("Flushing rollups")
+        for dummy, tx in self.transmitters.iteritems():
+            for dummy, sensor in tx.sensors.iteritems():
+                sensor.flush_rollups()
+
+    def _read_sensor_data(self, retries=Nanode.MAX_RETRIES, nanode=None):
+        nanode = nanode or self.nanode
         while True:
             try:
-                data = self.nanode.read_sensor_data(retries=retries)
+                data = nanode.read_sensor_data(retries=retries)
             except NanodeRestart:
-                self._restart_nanode()
+                self._restart_nanode(nanode)
             else:
                 break
         return data
@@ -268,6 +634,7 @@ class Manager(object):
                 elif cmd.isdigit(): self._edit_transmitter(cmd)
                 elif cmd == "d": self._delete_transmitter()
                 elif cmd == "s": self._switch_trx()
+                elif cmd == "b": self._assign_base_unit()
                 elif cmd == "q": break
                 elif cmd == "" : continue
                 else:
@@ -285,6 +652,7 @@ class Manager(object):
         print("<index>: edit known transmitter")
         print("d      : delete known transmitter")
         print("s      : switch TRX on or off")
+        print("b      : assign transmitter to a base unit")
         print("q      : quit")
         
     def _list_transmitters(self):
@@ -303,6 +671,12 @@ class Manager(object):
             print("{:>5d}{:>12d}{:>6}{:>3}{}"
                   .format(log_chan, tx_id, 
                           tx.TYPE, state, tx.print_sensors()))
+
+        if len(self.nanodes) > 1:
+            print("\n=====  BASE UNITS  =====\n")
+            for log_chan, tx_id in log_chans:
+                print("{:>5d}{:>12d}  {}".format(log_chan, tx_id,
+                                             self.transmitters[tx_id].base_unit))
     
     def _edit_transmitter(self, cmd):
         try:
@@ -393,12 +767,14 @@ class Manager(object):
     def _add_transmitter(self, tx_id, tx_type):
         self.transmitters[tx_id] = Cc_tx(tx_id, self) if tx_type.lower()=="tx" \
                                    else Cc_trx(tx_id, self)
+        self.transmitters[tx_id].base_unit = self.nanode.port
         
     def _pickle(self):
         log.info("Pickling")
-        with open(Manager.PICKLE_FILE, "wb") as output:
-            # "with" ensures we close the file, even if an exception occurs.
-            pickle.dump(self.transmitters, output)
+        with self._pickle_lock:
+            with open(self.args.pickle_file, "wb") as output:
+                # "with" ensures we close the file, even if an exception occurs.
+                pickle.dump(self.transmitters, output)
                                 
     def _user_accepts_pairing(self, data):
         if data.is_pairing_request:
@@ -463,3 +839,22 @@ class Manager(object):
         self.transmitters[tx_id].state = on_or_off
         self._pickle()
         
+
+    def _assign_base_unit(self):
+        print("Assigning transmitter to a base unit...")
+        tx_id = self._ask_user_for_index_and_retrieve_id()
+        tx = self.transmitters[tx_id]
+        ports = sorted(self.nanodes.keys())
+        for i, port in enumerate(ports):
+            print("{:d}: {}{}".format(i, port,
+                                      " (current)" if port == tx.base_unit else ""))
+        i = input_int_with_cancel("Base unit: ")
+        if i == "" or i < 0 or i >= len(ports):
+            raise Cancel("Not a valid base unit.")
+        if ports[i] == tx.base_unit:
+            return
+        if tx.nanode is not None:
+            tx.delete_from_nanode()
+        tx.base_unit = ports[i]
+        tx.add_to_nanode()
+        self._pickle()
@@ -0,0 +1,53 @@
+from __future__ import print_function
+import threading
+import time
+
+class Metrics(object):
+    """Counters shared by all base units in a logger process.
+
+    Attributes:
+      - base_units (dict): maps port (str) to a dict of counters:
+          packets, unknown_tx, restarts, last_packet_time, last_loop_time
+    """
+
+    COUNTERS = ['packets', 'unknown_tx', 'restarts']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.base_units = {}
+        self.start_time = time.time()
+
+    def add_base_unit(self, port):
+        with self._lock:
+            counters = dict.fromkeys(Metrics.COUNTERS, 0)
+            counters['last_packet_time'] = None
+            counters['last_loop_time'] = None
+            self.base_units[port] = counters
+
+    def increment(self, port, counter):
+        with self._lock:
+            self.base_units[port][counter] += 1
+
+    def loop_iteration(self, port):
+        """Called each time a base unit's read loop goes round."""
+        with self._lock:
+            self.base_units[port]['last_loop_time'] = time.time()
+
+    def packet_received(self, port, timecode):
+        with self._lock:
+            counters = self.base_units[port]
+            counters['packets'] += 1
+            counters['last_packet_time'] = timecode
+
+    def last_packet_time(self):
+        """Returns the most recent packet time across all base units."""
+        with self._lock:
+            times = [counters['last_packet_time']
+                     for counters in self.base_units.itervalues()
+                     if counters['last_packet_time'] is not None]
+        return max(times) if times else None
+
+    def snapshot(self):
+        with self._lock:
+            return dict((port, counters.copy())
+                        for port, counters in self.base_units.iteritems())
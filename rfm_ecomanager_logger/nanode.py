@@ -1,30 +1,79 @@
 from __future__ import print_function, division
 import serial
-import json
 import logging
 log = logging.getLogger("rfm_ecomanager_logger")
 import select
 import time
 import sys
+import collections
 
-class NanodeError(Exception):
-    """Base class for errors from the Nanode."""
+from protocol import (NanodeError, NanodeRestart, NanodeTooManyRetries,
+                      NanodeDataWaiting, Data, STARTUP_SEQUENCE,
+                      EMULATOR_PREFIX)
+import protocol
 
 
-class NanodeRestart(NanodeError):
-    """Nanode has restarted."""
-    
-    
-class NanodeTooManyRetries(NanodeError):
-    """Nanode has restarted."""
-    
-class NanodeDataWaiting(NanodeError):
-    """Data is waiting yet this function needs a clear input buffer.
-    Caller must read and process data or flush before calling this function again.
-    The NanodeDataWaiting object may contain a line of data."""
+class SerialReader(object):
+    """Reads lines (and binary frames) from a serial port in bulk.
 
-class Data(object):
-    """Struct for storing data from Nanode"""
+    pyserial's readline() calls read() once per byte.  Instead, read()
+    waits for the first byte with a single read(1) and then takes
+    everything which has arrived with one read(inWaiting()).  The bytes are
+    split into lines by a protocol.StreamParser, which keeps partial lines
+    and frames until the rest arrives.  Each batch is handed out one item
+    at a time, so the parser's binary flag can change between items (as
+    it does when the Nanode ACKs the 'b' command).
+    """
+
+    def __init__(self, serial_port):
+        self.serial = serial_port
+        self.parser = protocol.StreamParser()
+        self._items = iter([]) # the batch being handed out
+
+    def read(self):
+        """
+        Returns the next line (stripped) or binary frame (a dict), or an
+        empty string if nothing complete arrives within the serial port's
+        timeout (serial.timeout may be changed between calls).
+        """
+        timeout = self.serial.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            bad_frames = self.parser.bad_frames
+            item = next(self._items, None)
+            if self.parser.bad_frames != bad_frames:
+                log.warning("Discarded {} bad frames from {}".format(
+                    self.parser.bad_frames - bad_frames, self.serial.port))
+            if item is not None:
+                return item
+            n_waiting = self.serial.inWaiting()
+            if n_waiting:
+                data = self.serial.read(n_waiting)
+            elif deadline is not None and time.time() >= deadline:
+                return ""
+            else:
+                data = self.serial.read(1) # blocks for up to timeout
+                n_waiting = self.serial.inWaiting()
+                if n_waiting:
+                    data += self.serial.read(n_waiting)
+            self._items = self.parser.parse(data)
+
+    def data_waiting(self):
+        """True if any input, complete or not, hasn't been returned yet."""
+        return bool(self.serial.inWaiting() or self.parser.pending())
+
+    def flush(self):
+        """
+        Discard all input.  Just using serial.flushInput() appeared to
+        render the serial port unreadable if the buffer was full, so
+        first read whatever is waiting.
+        """
+        n_waiting = self.serial.inWaiting()
+        if n_waiting:
+            self.serial.read(n_waiting)
+        self.serial.flushInput()
+        self.parser.clear()
+        self._items = iter([])
 
 
 class Nanode(object):
@@ -35,19 +84,39 @@ class Nanode(object):
     TIME_OFFSET_UPDATE_PERIOD = 60*10 # in seconds
     MAX_ACCEPTABLE_DRIFT = 0.5 # in seconds
     TIMEOUT = 1 # serial timeout in seconds
+    MAX_BACKLOG = 100 # lines
+    MAX_STEP_BACK = 2**31 # ms; a bigger step back in the Nanode's time is a roll-over
     
-    def __init__(self, args):
+    def __init__(self, args, port, timeout=TIMEOUT):
         self.abort = False        
         self.args = args
+        self.port = port
+        self.timeout = timeout # serial timeout in seconds
         self._deadline_to_update_time_offset = 0        
+        # JSON lines which arrived while we were waiting for a command's
+        # response (e.g. pair acknowledgements).  read_sensor_data() returns
+        # these before reading any more from the serial port.
+        self._backlog = collections.deque(maxlen=Nanode.MAX_BACKLOG)
+        self._reader = None
         self._open_port()
         try:
             self.init_nanode()
         except NanodeRestart:
             self.init_nanode() # re-send init commands after restart
         
+    @property
+    def binary(self):
+        """Is the Nanode sending binary frames?"""
+        return self._reader.parser.binary
+
+    @binary.setter
+    def binary(self, value):
+        self._reader.parser.binary = value
+
     def init_nanode(self):
         log.info("Sending init commands to Nanode...")
+        self._backlog.clear()
+        self.binary = False # the Nanode always starts up printing JSON
         retries = 2
         while retries > 0 and not self.abort:
             retries -= 1
@@ -65,6 +134,8 @@ class Nanode(object):
             # Other Nanode config commands...
             self.send_command("m") # manual pairing mode
             self.send_command("k") # Only print data from known transmitters
+            if self.args.binary:
+                self._negotiate_binary()
             self._time_offset = None
             self._last_nanode_time = 0
             break
@@ -77,6 +148,7 @@ class Nanode(object):
                 log.debug("Setting _last_nanode_time and _time_offset for"
                           " first time. Retries left={}".format(retries))
                 self.flush()           
+                self._backlog.clear()
                 try:
                     self._last_nanode_time = self._get_nanode_time()[1]
                     self._set_time_offset()
@@ -85,6 +157,21 @@ class Nanode(object):
                 else:
                     break
         
+    def _negotiate_binary(self):
+        """Ask the Nanode to send binary frames (see framing.py) instead
+        of JSON lines.  Firmware which doesn't support them replies NAK
+        and we carry on with JSON."""
+        try:
+            self.send_command("b")
+        except NanodeRestart:
+            raise
+        except NanodeError:
+            log.info("Nanode on {} doesn't support binary frames. "
+                     "Using JSON.".format(self.port))
+        else:
+            log.info("Nanode on {} is sending binary frames.".format(self.port))
+            self.binary = True
+
     def _set_time_offset(self):
         """
         Returns nothing but sets self._last_nanode_time if successful.
@@ -135,6 +222,9 @@ class Nanode(object):
                 
                 # If we get to here then new_time_offset is sane so save it
                 self._time_offset = new_time_offset
+                # After a roll-over, new_time_offset is for the rolled-over
+                # clock so packet times must no longer have 2**32 added
+                self._last_nanode_time = nanode_time
                 self._deadline_to_update_time_offset = start_time + \
                                      Nanode.TIME_OFFSET_UPDATE_PERIOD
                 break
@@ -162,10 +252,11 @@ class Nanode(object):
         while retries < Nanode.MAX_RETRIES and not self.abort:
             retries += 1
             
-            # check if any data is waiting for us
-            n_waiting = self._serial.inWaiting() 
-            if n_waiting > 0:
-                log.debug("{} chars waiting".format(n_waiting))
+            # check if any data is waiting for us.  Lines in the backlog
+            # arrived earlier, so they must be timestamped (with the current
+            # offset and _last_nanode_time) before we read the time.
+            if self._backlog or self._reader.data_waiting():
+                log.debug("Data waiting")
                 raise NanodeDataWaiting()
             
             # ask Nanode for its time and also record the round-trip time
@@ -212,7 +303,12 @@ class Nanode(object):
                 # Hence we should process this data if it is valid JSON.
                 log.debug(e)
                 log.debug("Data is waiting so won't update time on this cycle")
-                line = str(e)
+                if e.args and e.args[0]:
+                    # Return lines in the order they arrived
+                    self._backlog.append(e.args[0])
+
+        if self._backlog:
+            line = self._backlog.popleft()
 
         if not line:
             # If data hasn't already been loaded from the NanodeDataWaiting
@@ -222,69 +318,50 @@ class Nanode(object):
         # Record time immediately after _readline returns.
         t = time.time()
             
-        # Convert string to JSON object
-        if line and isinstance(line, basestring) and line[0]=="{":
-            try:
-                json_line = json.loads(line)
-            except:
-                json_line = None
+        # Convert string to JSON object (binary frames are already decoded)
+        if isinstance(line, dict):
+            json_line = line
+        elif line and isinstance(line, basestring):
+            json_line = protocol.parse_line(line)
         
         # Process JSON object
         if json_line:
             log.debug("LINE: {}".format(json_line))            
-            data = Data()
-            
-            # Handle "pair with" responses
-            if json_line.get("pw"):
-                data.pair_ack = True
-                data.tx_id = json_line.get("pw").get("id")
-                data.tx_type = json_line.get("pw").get("type")
+            data = protocol.to_data(json_line)
+            if data.pair_ack or data.is_pairing_request:
                 return data
-            else:
-                data.pair_ack = False
-            
-            data.is_pairing_request = True if json_line.get("pr") else False
-            if data.is_pairing_request:
-                json_line = json_line.get("pr")
-            else:
-                # Handle time                
-                if self.args.time_correction:
-                    nanode_time = json_line.get("t")
-                    
-                    if nanode_time < self._last_nanode_time: # roll-over of Nanode's clock
-                        log.info("Roll-over detected")
-                        # nanode's time is a uint32:
-                        nanode_time += 2**32
-                        # ensure we update time offset on next cycle:
-                        self._deadline_to_update_time_offset = time.time() 
-                    
-                    self._last_nanode_time = nanode_time
-                    
-                    data.timecode = self._time_offset + (nanode_time / 1000)
-                    log.debug("ETA={:.3f}, time received={:.3f}, diff={:.3f}"
-                          .format(data.timecode, t, data.timecode-t))
-                else:
-                    data.timecode = t
+
+            # Handle time                
+            if self.args.time_correction:
+                nanode_time = data.nanode_time
                 
-                data.timecode = int(round(data.timecode))
+                if (self._last_nanode_time - nanode_time >
+                    Nanode.MAX_STEP_BACK):
+                    # roll-over of Nanode's clock.  (A packet which is only
+                    # a little older than the last one can't be a roll-over)
+                    log.info("Roll-over detected")
+                    # nanode's time is a uint32:
+                    nanode_time += 2**32
+                    # ensure we update time offset on next cycle:
+                    self._deadline_to_update_time_offset = time.time() 
                 
-                data.sensors  = json_line.get("sensors")
+                self._last_nanode_time = max(nanode_time, self._last_nanode_time)
                 
-            data.tx_id    = json_line.get("id")
-            data.tx_type  = json_line.get("type")
-            data.state    = json_line.get("state")
-            data.state = None if data.state is None else int(data.state)
-            data.reply_to_poll = json_line.get("reply_to_poll")
-            data.reply_to_poll = (None if data.reply_to_poll is None else
-                                  int(data.reply_to_poll))
+                data.timecode = self._time_offset + (nanode_time / 1000)
+                log.debug("ETA={:.3f}, time received={:.3f}, diff={:.3f}"
+                      .format(data.timecode, t, data.timecode-t))
+            else:
+                data.timecode = t
+            
+            data.timecode = int(round(data.timecode))
             return data
 
            
     def _readline_with_exception_handling(self):
-        """Wrap serial.readline() with exception handling."""
+        """Wrap SerialReader.read() with exception handling."""
         try:
             log.debug("Waiting for line from Nanode")
-            line = self._serial.readline().strip()
+            line = self._reader.read()
         except select.error:
             if self.abort:
                 log.debug("Caught select.error but this is nothing to "
@@ -302,26 +379,17 @@ class Nanode(object):
             log.info("Up and running again.")
             raise NanodeRestart()
         except serial.serialutil.SerialException:
-            log.critical("Is the Nanode plugged into port {}?".format(self.args.port))
+            log.critical("Is the Nanode plugged into port {}?".format(self.port))
             sys.exit(1)
         else:
             log.debug("From Nanode: {}".format(line))                
             return line
         
     def flush(self):
-        """
-        Flush the serial port.
-        
-        Just using serial.flushInput() appeared to render the serial port
-        unreadable if the buffer was full.
-        """
+        """Flush the serial port."""
         
         log.debug("Flushing serial input...")
-        timeout = self._serial.timeout
-        self._serial.timeout = 0
-        self._serial.readall() # flush the serial port (flushInput() seems to sometimes stop us from getting any further data)
-        self._serial.timeout = timeout
-        self._serial.flushInput()
+        self._reader.flush()
         self._serial.flush()
         log.debug("Done flushing!")
     
@@ -331,11 +399,7 @@ class Nanode(object):
             - NanodeRestart
             - NanodeTooManyRetries
         """
-        startup_seq = ["EDF IAM Receiver",
-                       "SPI initialised", 
-                       "Attaching interrupt", 
-                       "Interrupt attached", 
-                       "Finished init"]
+        startup_seq = STARTUP_SEQUENCE
         
         while retries >= 0 and not self.abort:
             retries -= 1
@@ -368,15 +432,18 @@ class Nanode(object):
                             nanode_init_ok = False
                             break
                         
-                        line = self._readline_with_exception_handling()
+                        # Don't wait for another line after the last one
+                        if i < len(startup_seq) - 1:
+                            line = self._readline_with_exception_handling()
                         
-                    self._serial.timeout = Nanode.TIMEOUT
+                    self._serial.timeout = self.timeout
                         
                     if nanode_init_ok:
                         log.info("Nanode has finished initialising")
                         raise NanodeRestart()
 
-                elif ignore_json and line[0]=="{":
+                elif ignore_json and (isinstance(line, dict) or line[0]=="{"):
+                    self._backlog.append(line)
                     continue
                 else: # line is something we should return              
                     return line
@@ -390,22 +457,39 @@ class Nanode(object):
                               "after {:d} times".format(retries))
         
     def _open_port(self):
-        log.info("Opening port {}".format(self.args.port))
+        log.info("Opening port {}".format(self.port))
         try:
-            self._serial = serial.Serial(port=self.args.port, 
-                                         baudrate=115200,
-                                         timeout=Nanode.TIMEOUT) # timeout in seconds
+            if self.port.startswith(EMULATOR_PREFIX):
+                import emulator # only needed for emulated ports
+                self._serial = emulator.open_port(self.port,
+                                                  timeout=self.timeout)
+            else:
+                self._serial = serial.Serial(port=self.port, 
+                                             baudrate=115200,
+                                             timeout=self.timeout)
         except serial.serialutil.SerialException:
-            log.critical("Is the Nanode plugged into port {}?".format(self.args.port))
+            log.critical("Is the Nanode plugged into port {}?".format(self.port))
             sys.exit(1)
         else:
-            log.info("Successfully opened port {}".format(self.args.port))
+            log.info("Successfully opened port {}".format(self.port))
+            # Keep the binary flag: after a serial restart the Nanode may
+            # still be sending frames (init_nanode clears it if it restarted)
+            binary = self._reader is not None and self.binary
+            self._reader = SerialReader(self._serial)
+            self.binary = binary
 
         
-    def send_command(self, cmd, param=None):
+    def send_command(self, cmd, param=None, flush=True):
+        """
+        Args:
+            flush (bool): discard any input first.  If False, JSON lines
+                which are already waiting go to the backlog (e.g. pair
+                acknowledgements while sending several pair commands).
+        """
         cmd = str(cmd)
         log.debug("send_command(cmd={}, param={})".format(cmd, str(param)))
-        self.flush()
+        if flush:
+            self.flush()
         self._serial.write(cmd)
         self._process_response()
         if param:
@@ -438,4 +522,7 @@ class Nanode(object):
 
     def __exit__(self, _type, value, traceback):
         log.debug("Nanode __exit__")
+        self.close()
+
+    def close(self):
         self._serial.close()
@@ -0,0 +1,171 @@
+"""
+The Nanode's serial protocol: exceptions, the startup banner and parsing
+of its output.  Shared by the blocking Nanode (nanode.py) and the asyncio
+client (aionanode.py), so this module works on Python 2 and 3.
+
+The Nanode prints text lines (ACK, NAK, command echoes, its time in
+milliseconds, the startup banner and JSON packets) and, once it has been
+sent the 'b' command, binary frames for packets (see framing.py).
+"""
+
+from __future__ import print_function
+import json
+import framing
+
+STARTUP_SEQUENCE = ["EDF IAM Receiver",
+                    "SPI initialised",
+                    "Attaching interrupt",
+                    "Interrupt attached",
+                    "Finished init"]
+ACK = "ACK"
+NAK = "NAK"
+EMULATOR_PREFIX = "emulator:" # ports with this prefix are emulated (see
+                              # emulator.py)
+
+
+class NanodeError(Exception):
+    """Base class for errors from the Nanode."""
+
+
+class NanodeRestart(NanodeError):
+    """Nanode has restarted."""
+
+
+class NanodeTooManyRetries(NanodeError):
+    """Nanode has restarted."""
+
+class NanodeDataWaiting(NanodeError):
+    """Data is waiting yet this function needs a clear input buffer.
+    Caller must read and process data or flush before calling this function again.
+    The NanodeDataWaiting object may contain a line of data."""
+
+
+class Data(object):
+    """Struct for storing data from Nanode"""
+
+
+def parse_line(line):
+    """Returns the dict for a JSON packet line, or None for any other line."""
+    if not line or line[0] != "{":
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def to_data(record):
+    """Convert a packet (a dict from parse_line or framing.decode) to Data.
+
+    Sets pair_ack, is_pairing_request, tx_id, tx_type, state,
+    reply_to_poll, sensors and nanode_time (the Nanode's clock in ms when
+    it received the packet, or None).  Callers set timecode.
+    """
+    data = Data()
+    data.pair_ack = "pw" in record
+    data.is_pairing_request = "pr" in record
+    fields = record.get("pw") or record.get("pr") or record
+    data.tx_id = fields.get("id")
+    data.tx_type = fields.get("type")
+    data.state = fields.get("state")
+    data.state = None if data.state is None else int(data.state)
+    data.reply_to_poll = fields.get("reply_to_poll")
+    data.reply_to_poll = (None if data.reply_to_poll is None else
+                          int(data.reply_to_poll))
+    if data.pair_ack or data.is_pairing_request:
+        data.sensors = None
+        data.nanode_time = None
+    else:
+        data.sensors = fields.get("sensors")
+        data.nanode_time = fields.get("t")
+    return data
+
+
+def _text(raw):
+    """bytes to str on both Python 2 and 3."""
+    return raw if isinstance(raw, str) else raw.decode('latin-1')
+
+
+class StreamParser(object):
+    """Splits the bytes arriving from a Nanode into text lines and (when
+    binary is set) decoded binary frames.  Partial lines and frames are
+    kept until the rest arrives.
+
+    Example:
+        for item in parser.parse(os.read(fd, 4096)):
+            ...  # item is a str (a stripped line) or a dict (a frame)
+
+    parse() is a generator: setting binary while handling one item changes
+    how the items after it are parsed, which is what happens when the
+    Nanode ACKs the 'b' command.
+    """
+
+    def __init__(self, binary=False):
+        self.binary = binary
+        self.bad_frames = 0
+        self._buffer = bytearray()
+
+    def parse(self, data=b""):
+        self._buffer += data
+        buf = self._buffer
+        while buf:
+            if self.binary:
+                # Skip bytes which can't start a frame or a line (e.g. the
+                # rest of a corrupt frame) to resynchronise
+                i = 0
+                while (i < len(buf) and buf[i] != framing.SYNC_BYTE and
+                       not 32 <= buf[i] <= 126):
+                    i += 1
+                del buf[:i]
+                if not buf:
+                    return
+                if buf[0] == framing.SYNC_BYTE:
+                    if len(buf) < 2:
+                        return
+                    end = framing.frame_length(buf[1])
+                    if len(buf) < end:
+                        return
+                    frame = bytes(buf[1:end])
+                    del buf[:end]
+                    try:
+                        yield framing.read_frame(_Reader(frame))
+                    except framing.FrameError:
+                        self.bad_frames += 1
+                    continue
+                # Text lines are printable, so a line cut short by a frame
+                # ends at the first byte which isn't
+                i = 1
+                while i < len(buf) and (32 <= buf[i] <= 126 or buf[i] == 13):
+                    i += 1
+                if i == len(buf):
+                    return
+                if buf[i] != 10:
+                    del buf[:i]
+                    continue
+            end = buf.find(b"\n") + 1
+            if not end:
+                return
+            line = _text(bytes(buf[:end])).strip()
+            del buf[:end]
+            if line:
+                yield line
+
+    def pending(self):
+        """Returns the number of bytes held back in a partial line or frame."""
+        return len(self._buffer)
+
+    def clear(self):
+        del self._buffer[:]
+
+
+class _Reader(object):
+    """Gives framing.read_frame() a read() over a bytes object."""
+
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+
+    def __call__(self, size):
+        chunk = self._data[self._position:self._position + size]
+        self._position += size
+        return chunk
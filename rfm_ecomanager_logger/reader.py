@@ -0,0 +1,476 @@
+"""
+Load data directories written by rfm_ecomanager_logger (or merged by
+scripts/merge_datasets.py) into NumPy arrays.
+
+Example:
+
+    import reader
+    data_dir = reader.DataDirectory('/data/house_1')
+    kettle = data_dir.load('kettle')
+    print(kettle.watts.mean())
+    everything = data_dir.load_many(start=1360396444, end=1360400145)
+
+Parsed channels are cached in-process, keyed on the file's size and mtime,
+so calling load() again on an unchanged file returns immediately.
+"""
+
+from __future__ import print_function, division
+import os
+import ConfigParser
+import datetime
+import calendar
+import multiprocessing
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+import numpy as np
+import pytz
+import rollup
+import events
+
+TZFILE_NAME = '/etc/timezone'
+NO_STATE = -1 # value in ChannelData.states for samples without a button press
+INDEX_STRIDE = 1024 # number of lines between entries in a channel_N.idx file
+TAIL_SIZE = 4096 # bytes read at a time by read_tail()
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'), ('offset', '<i8')])
+ROLLUP_DTYPE = np.dtype([('start', '<u4'), ('count', '<u4'), ('mean', '<f4'),
+                         ('energy', '<f8'), ('min', '<f4'), ('max', '<f4')])
+EVENT_DTYPE = np.dtype([('timestamp', '<u4'), ('kind', 'u1'), ('state', 'i1'),
+                        ('watts', '<f4'), ('delta', '<f4')])
+
+# Maps (filename, start, end) to (file size, file mtime, ChannelData)
+_cache = {}
+
+
+class ReaderError(Exception):
+    """For errors raised while reading a data directory."""
+
+
+class ChannelData(object):
+    """
+    Attributes:
+      - channel (int)
+      - label (str): the primary label for this channel
+      - timestamps (np.ndarray of float64): UNIX timestamps
+      - watts (np.ndarray of float64)
+      - states (np.ndarray of int8): IAM state recorded with each sample
+        or NO_STATE if the IAM's state did not change at that sample
+      - tz (pytz timezone): taken from the data directory's metadata.dat
+    """
+
+    def __init__(self, channel, label, timestamps, watts, states, tz):
+        self.channel = channel
+        self.label = label
+        self.timestamps = timestamps
+        self.watts = watts
+        self.states = states
+        self.tz = tz
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def datetimes(self):
+        """Returns a list of timezone-aware datetimes, one per sample."""
+        return [datetime.datetime.fromtimestamp(t, self.tz)
+                for t in self.timestamps]
+
+    def button_presses(self):
+        """Returns (timestamps, states) for samples with a button press."""
+        mask = self.states != NO_STATE
+        return self.timestamps[mask], self.states[mask]
+
+
+def load_labels_file(labels_filename):
+    """
+    Args:
+        labels_filename (str): including full path
+
+    Returns:
+        dict mapping channel number (int) to a list of synonyms (strings).
+        The first synonym is the primary label.  e.g.:
+        {1: ['aggregate', 'agg'], 2: ['boiler']}
+    """
+    labels = {}
+    with open(labels_filename) as labels_file:
+        for line in labels_file:
+            chan, _, label = line.partition(' ')
+            try:
+                chan = int(chan)
+            except ValueError:
+                log.warn("unprocessed line from {}: '{}'"
+                         .format(labels_filename, line))
+            else:
+                labels[chan] = [synonym.strip() for synonym in label.split('/')]
+    return labels
+
+
+def load_timezone(data_dir):
+    """Returns the pytz timezone recorded in data_dir/metadata.dat.
+    Falls back to the local machine's timezone, and then to UTC.
+    """
+    metadata_parser = ConfigParser.RawConfigParser()
+    metadata_parser.read(os.path.join(data_dir, 'metadata.dat'))
+    try:
+        tz_string = metadata_parser.get('datetime', 'timezone').strip()
+    except ConfigParser.Error:
+        try:
+            with open(TZFILE_NAME) as tz_file:
+                tz_string = tz_file.readline().strip()
+        except IOError:
+            tz_string = 'UTC'
+    return pytz.timezone(tz_string)
+
+
+def index_filename(data_filename):
+    return os.path.splitext(data_filename)[0] + '.idx'
+
+
+def build_index(data_filename, stride=INDEX_STRIDE):
+    """Write a sparse (timestamp, byte offset) index next to data_filename
+    with one entry every `stride` lines.  Used by load() to jump straight to
+    the requested time range instead of parsing the whole file.
+
+    Returns:
+        the index filename
+    """
+    entries = []
+    offset = 0
+    with open(data_filename, 'rb') as data_file:
+        for i, line in enumerate(data_file):
+            if not line.endswith('\n'):
+                break # don't index a truncated final line
+            if i % stride == 0:
+                entries.append((float(line.split(' ', 1)[0]), offset))
+            offset += len(line)
+    index = np.array(entries, dtype=INDEX_DTYPE)
+    idx_filename = index_filename(data_filename)
+    tmp_filename = idx_filename + '.tmp'
+    index.tofile(tmp_filename)
+    os.rename(tmp_filename, idx_filename)
+    return idx_filename
+
+
+def read_tail(data_filename, block_size=TAIL_SIZE):
+    """Find the last timestamp in data_filename by reading backwards from
+    the end of the file, so the cost doesn't depend on the file's length.
+    A truncated final line (e.g. after a power cut) and unparsable lines
+    are skipped.
+
+    Returns:
+        (last_timestamp, complete_size): last_timestamp is None if there
+        are no parsable lines.  complete_size is the size of the file
+        without its truncated final line, if it has one.
+    """
+    with open(data_filename, 'rb') as data_file:
+        data_file.seek(0, os.SEEK_END)
+        position = data_file.tell()
+        tail = ''
+        complete_size = None
+        while position > 0:
+            n_bytes = min(block_size, position)
+            position -= n_bytes
+            data_file.seek(position)
+            tail = data_file.read(n_bytes) + tail
+            lines = tail.split('\n')
+            if complete_size is None and len(lines) > 1:
+                complete_size = position + len(tail) - len(lines[-1])
+            # lines[0] may be the end of a line which started further back
+            first = 0 if position == 0 else 1
+            for line in reversed(lines[first:-1]):
+                try:
+                    return float(line.split()[0]), complete_size
+                except (IndexError, ValueError):
+                    pass
+            if len(lines) > 1:
+                tail = lines[0] + '\n'
+    return None, complete_size or 0
+
+
+def _byte_range(data_filename, file_size, start, end):
+    """Use the index (if one exists) to find the byte range of data_filename
+    which covers [start, end].  Returns (0, file_size) if there is no
+    usable index.
+    """
+    idx_filename = index_filename(data_filename)
+    if (start is None and end is None) or not os.path.exists(idx_filename):
+        return 0, file_size
+
+    index = np.fromfile(idx_filename, dtype=INDEX_DTYPE)
+    if len(index) == 0 or index['offset'][-1] >= file_size:
+        log.debug("Ignoring stale index {}".format(idx_filename))
+        return 0, file_size
+
+    first_byte = 0
+    last_byte = file_size
+    if start is not None:
+        i = np.searchsorted(index['timestamp'], start, side='right') - 1
+        if i > 0:
+            first_byte = int(index['offset'][i])
+    if end is not None:
+        i = np.searchsorted(index['timestamp'], end, side='right')
+        if i < len(index):
+            last_byte = int(index['offset'][i])
+    return first_byte, last_byte
+
+
+def parse_text(text):
+    """
+    Args:
+        text (str): complete lines from a channel_N.dat file
+
+    Returns:
+        timestamps, watts, states (np.ndarrays)
+    """
+    n_lines = text.count('\n')
+    if text.count(' ') == n_lines:
+        # Fast path: every line is "<timestamp> <watts>"
+        values = np.fromstring(text, sep=' ')
+        if len(values) == n_lines * 2:
+            values = values.reshape(-1, 2)
+            return (values[:, 0], values[:, 1],
+                    np.full(n_lines, NO_STATE, dtype=np.int8))
+
+    # Slow path: some lines have a third (button press) column,
+    # or the text is malformed.
+    timestamps = np.empty(n_lines, dtype=np.float64)
+    watts = np.empty(n_lines, dtype=np.float64)
+    states = np.full(n_lines, NO_STATE, dtype=np.int8)
+    n = 0
+    for line in text.splitlines():
+        parts = line.split()
+        try:
+            timestamps[n] = float(parts[0])
+            watts[n] = float(parts[1])
+            if len(parts) > 2:
+                states[n] = int(parts[2])
+        except (IndexError, ValueError):
+            if line.strip():
+                log.warn("Ignoring unparsable line '{}'".format(line))
+            continue
+        n += 1
+    return timestamps[:n], watts[:n], states[:n]
+
+
+def load_file(data_filename, start=None, end=None):
+    """Parse a channel_N.dat file, ignoring any truncated final line.
+
+    Returns:
+        timestamps, watts, states (np.ndarrays) for start <= t <= end
+    """
+    file_size = os.path.getsize(data_filename)
+    first_byte, last_byte = _byte_range(data_filename, file_size, start, end)
+    with open(data_filename, 'rb') as data_file:
+        data_file.seek(first_byte)
+        text = data_file.read(last_byte - first_byte)
+    text = text[:text.rfind('\n') + 1]
+    timestamps, watts, states = parse_text(text)
+
+    if start is not None or end is not None:
+        i_start = (0 if start is None else
+                   np.searchsorted(timestamps, start, side='left'))
+        i_end = (len(timestamps) if end is None else
+                 np.searchsorted(timestamps, end, side='right'))
+        timestamps = timestamps[i_start:i_end]
+        watts = watts[i_start:i_end]
+        states = states[i_start:i_end]
+
+    # Merged datasets keep button presses in a separate file
+    button_press_filename = (os.path.splitext(data_filename)[0] +
+                             '_button_press.dat')
+    if (os.path.exists(button_press_filename) and len(timestamps) and
+        os.path.getsize(button_press_filename) > 0):
+        bp = np.loadtxt(button_press_filename, ndmin=2)
+        i = np.searchsorted(timestamps, bp[:, 0])
+        valid = i < len(timestamps)
+        valid[valid] = timestamps[i[valid]] == bp[valid, 0]
+        states[i[valid]] = bp[valid, 1]
+
+    return timestamps, watts, states
+
+
+def _load_file_star(args):
+    """For multiprocessing.Pool.map, which can only pass one argument."""
+    return load_file(*args)
+
+
+def _cache_lookup(key):
+    filename = key[0]
+    if not os.path.exists(filename):
+        raise ReaderError("{} does not exist".format(filename))
+    stat = os.stat(filename)
+    cached = _cache.get(key)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return stat, cached[2]
+    return stat, None
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _to_timestamp(t, tz):
+    """Convert t (None, a number or a datetime) to a UNIX timestamp.
+    Naive datetimes are assumed to be in timezone tz."""
+    if t is None or not isinstance(t, datetime.datetime):
+        return t
+    if t.tzinfo is None:
+        t = tz.localize(t)
+    return calendar.timegm(t.utctimetuple()) + t.microsecond / 1E6
+
+
+class DataDirectory(object):
+    """A single dataset directory or a merged dataset directory.
+
+    Attributes:
+      - data_dir (str)
+      - labels (dict): maps channel number to a list of synonyms
+      - tz (pytz timezone)
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = os.path.realpath(os.path.expanduser(data_dir))
+        labels_filename = os.path.join(self.data_dir, 'labels.dat')
+        if not os.path.exists(labels_filename):
+            raise ReaderError("{} is not a data directory (no labels.dat)"
+                              .format(self.data_dir))
+        self.labels = load_labels_file(labels_filename)
+        self.tz = load_timezone(self.data_dir)
+
+    def filename(self, chan):
+        return os.path.join(self.data_dir, 'channel_{:d}.dat'.format(chan))
+
+    def channels(self):
+        """Returns a sorted list of channels which have a data file."""
+        return [chan for chan in sorted(self.labels)
+                if os.path.exists(self.filename(chan))]
+
+    def resolve(self, channel):
+        """
+        Args:
+            channel (int or str): a channel number or any synonym of a label
+
+        Returns:
+            channel number (int)
+
+        Raises:
+            ReaderError if channel cannot be found.
+        """
+        if isinstance(channel, (int, long, np.integer)):
+            if channel in self.labels:
+                return int(channel)
+        else:
+            for chan, synonyms in self.labels.iteritems():
+                if channel in synonyms:
+                    return chan
+        raise ReaderError("Channel '{}' not found in {}"
+                          .format(channel, self.data_dir))
+
+    def load_rollup(self, channel, resolution='1hour'):
+        """
+        Args:
+            channel (int or str): channel number or label synonym
+            resolution (str): one of the names in rollup.RESOLUTIONS
+
+        Returns:
+            structured np.ndarray with fields start, count, mean,
+            energy (watt-hours), min and max
+        """
+        filename = rollup.rollup_filename(self.data_dir, self.resolve(channel),
+                                          resolution)
+        if not os.path.exists(filename):
+            return np.zeros(0, dtype=ROLLUP_DTYPE)
+        return np.fromfile(filename, dtype=ROLLUP_DTYPE)
+
+    def load_events(self, channel, start=None, end=None, kinds=None):
+        """
+        Args:
+            channel (int or str): channel number or label synonym
+            start, end: see load()
+            kinds (list of ints): Optional.  e.g. [events.ON, events.OFF]
+
+        Returns:
+            structured np.ndarray with fields timestamp, kind, state,
+            watts and delta.  Only the records in [start, end] are read.
+        """
+        filename = events.events_filename(self.data_dir, self.resolve(channel))
+        n_records = (os.path.getsize(filename) // EVENT_DTYPE.itemsize
+                     if os.path.exists(filename) else 0)
+        if not n_records:
+            return np.zeros(0, dtype=EVENT_DTYPE)
+        records = np.memmap(filename, dtype=EVENT_DTYPE, mode='r',
+                            shape=(n_records,))
+        start = _to_timestamp(start, self.tz)
+        end = _to_timestamp(end, self.tz)
+        timestamps = records['timestamp']
+        i = 0 if start is None else np.searchsorted(timestamps, start, 'left')
+        j = (n_records if end is None else
+             np.searchsorted(timestamps, end, 'right'))
+        selected = np.array(records[i:j])
+        if kinds is not None:
+            selected = selected[np.in1d(selected['kind'], kinds)]
+        return selected
+
+    def build_indexes(self, stride=INDEX_STRIDE):
+        for chan in self.channels():
+            build_index(self.filename(chan), stride)
+
+    def _channel_data(self, chan, arrays):
+        timestamps, watts, states = arrays
+        return ChannelData(chan, self.labels[chan][0], timestamps, watts,
+                           states, self.tz)
+
+    def load(self, channel, start=None, end=None):
+        """
+        Args:
+            channel (int or str): channel number or label synonym
+            start, end (float or datetime): Optional.  Inclusive time range.
+                Naive datetimes are interpreted in self.tz.
+
+        Returns:
+            ChannelData
+        """
+        return self.load_many([channel], start, end, processes=1).values()[0]
+
+    def load_many(self, channels=None, start=None, end=None, processes=None):
+        """Load several channels, using a process pool for any channels
+        which are not already cached.
+
+        Args:
+            channels (list of ints or strs): Optional. Defaults to all channels.
+            start, end: see load()
+            processes (int): Optional. Size of process pool.  Defaults to
+                the number of CPUs.
+
+        Returns:
+            dict mapping channel number to ChannelData
+        """
+        if channels is None:
+            channels = self.channels()
+        start = _to_timestamp(start, self.tz)
+        end = _to_timestamp(end, self.tz)
+
+        results = {}
+        to_load = [] # list of (chan, key, stat)
+        for channel in channels:
+            chan = self.resolve(channel)
+            key = (self.filename(chan), start, end)
+            stat, cached = _cache_lookup(key)
+            if cached is None:
+                to_load.append((chan, key, stat))
+            else:
+                results[chan] = cached
+
+        if len(to_load) > 1 and processes != 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                loaded = pool.map(_load_file_star, [key for _, key, _ in to_load])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            loaded = [load_file(*key) for _, key, _ in to_load]
+
+        for (chan, key, stat), arrays in zip(to_load, loaded):
+            results[chan] = self._channel_data(chan, arrays)
+            _cache[key] = (stat.st_size, stat.st_mtime, results[chan])
+
+        return results
@@ -3,9 +3,13 @@ from __future__ import print_function
 import argparse
 import logging.handlers
 log = logging.getLogger("rfm_ecomanager_logger")
-import time, os, sighandler, inspect
+import time, os, sys, sighandler, inspect
 from nanode import Nanode
 from manager import Manager
+import control
+import linkstats
+import events
+import discovery
 
 FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
 
@@ -18,6 +22,18 @@ def setup_argparser():
                         const=True, default=False, 
                         help="Pair with new transmitters or edit existing transmitters.")
    
+    parser.add_argument('--scan', dest='scan', type=float, metavar='SECONDS',
+                        help="Listen to every transmitter in range for SECONDS"
+                        " and write unknown ones to the --candidates file.")
+    
+    parser.add_argument('--candidates', dest='candidates', type=str
+                        ,default='candidates.csv'
+                        ,help='file written by --scan (default: candidates.csv)')
+    
+    parser.add_argument('--accept', dest='accept', type=str, metavar='FILE',
+                        help="Add every transmitter in FILE (written by --scan"
+                        " and then given names).")
+   
     parser.add_argument('--log', dest='loglevel', type=str, default='INFO',
                         help='DEBUG or INFO or WARNING (default: INFO)')  
     
@@ -25,14 +41,104 @@ def setup_argparser():
                         ,default=""
                         ,help='directory for storing data (default: $DATA_DIR/XYZ/)')
     
-    parser.add_argument('--port', dest='port', type=str
-                        ,default='/dev/ttyUSB0'
-                        ,help='serial port (default: /dev/ttyUSB0)') 
+    parser.add_argument('--resume', dest='resume', action='store_const',
+                        const=True, default=False
+                        ,help='instead of creating a new $DATA_DIR/NNN,'
+                        ' carry on logging into the latest one if its'
+                        ' labels.dat matches the current transmitters.'
+                        ' Samples are only appended after the last sample'
+                        ' in each channel file.')
+    
+    parser.add_argument('--port', dest='port', type=str, nargs='+'
+                        ,default=['/dev/ttyUSB0']
+                        ,help='serial port(s). Give several ports to log from'
+                        ' several base units in one process. New transmitters'
+                        ' are paired with the first port. "emulator:NAME"'
+                        ' opens an emulated Nanode. (default: /dev/ttyUSB0)') 
+    
+    parser.add_argument('--sink', dest='sinks', action='append'
+                        ,metavar='TYPE[:ARG][,OPTION=VALUE...]'
+                        ,help='output sink. May be given several times.'
+                        ' TYPE is redd, binary, sqlite[:FILENAME],'
+                        ' socket:HOST:PORT, stream:udp:HOST:PORT,'
+                        ' stream:unix:PATH, ring[:FILENAME] or'
+                        ' ingest[:DIRECTORY].'
+                        ' OPTIONs are flush (seconds),'
+                        ' buffer (records) and overflow (drop_oldest or'
+                        ' drop_newest), plus segment (bytes) and demux'
+                        ' (seconds) for ingest. (default: redd)')
+    
+    parser.add_argument('--heartbeat', dest='heartbeat', type=str
+                        ,metavar='FILENAME|udp:HOST:PORT|unix:PATH'
+                        ,help='publish a JSON heartbeat (last packet time,'
+                        ' last write time, queue depth) to a file or'
+                        ' datagram socket. Used by supervisor.py.')
+    
+    parser.add_argument('--heartbeat-interval', dest='heartbeat_interval',
+                        type=float, default=1
+                        ,help='seconds between heartbeats (default: 1)')
+    
+    parser.add_argument('--link-stats', dest='link_stats', type=str
+                        ,metavar='FILENAME'
+                        ,help='write packet loss and gap statistics for each'
+                        ' transmitter to FILENAME as JSON.')
+    
+    parser.add_argument('--link-stats-interval', dest='link_stats_interval',
+                        type=float, default=linkstats.INTERVAL
+                        ,help='seconds between link statistics files and'
+                        ' checks for silent transmitters (default: {})'
+                        .format(linkstats.INTERVAL))
+    
+    parser.add_argument('--silence-multiple', dest='silence_multiple',
+                        type=float, default=linkstats.SILENCE_MULTIPLE
+                        ,help='warn when a transmitter has been silent for'
+                        ' this many of its usual periods between packets'
+                        ' (default: {})'.format(linkstats.SILENCE_MULTIPLE))
+    
+    parser.add_argument('--event-on-watts', dest='event_on_watts',
+                        type=float, default=events.ON_WATTS
+                        ,help='a channel is on at or above this power, for'
+                        ' the on/off events in channel_N.events'
+                        ' (default: {})'.format(events.ON_WATTS))
+    
+    parser.add_argument('--event-hysteresis', dest='event_hysteresis',
+                        type=float, default=events.HYSTERESIS
+                        ,help='a channel which is on only turns off below'
+                        ' --event-on-watts minus this many watts'
+                        ' (default: {})'.format(events.HYSTERESIS))
+    
+    parser.add_argument('--event-step-watts', dest='event_step_watts',
+                        type=float, default=events.STEP_WATTS
+                        ,help='smallest change in power recorded as a step'
+                        ' event while a channel is on'
+                        ' (default: {})'.format(events.STEP_WATTS))
+    
+    parser.add_argument('--event-min-duration', dest='event_min_duration',
+                        type=float, default=events.MIN_DURATION
+                        ,help='seconds a change must last to be recorded as'
+                        ' an event (default: {})'.format(events.MIN_DURATION))
+    
+    parser.add_argument('--control-socket', dest='control_socket', type=str
+                        ,nargs='?', const=control.DEFAULT_SOCKET, default=None
+                        ,help='listen on a Unix socket for editing transmitters'
+                        ' while logging with control.py'
+                        ' (default path: {})'.format(control.DEFAULT_SOCKET))
+    
+    parser.add_argument('--pickle-file', dest='pickle_file', type=str
+                        ,default=Manager.PICKLE_FILE
+                        ,help='file storing the transmitter registry'
+                        ' (default: {})'.format(Manager.PICKLE_FILE))
     
     parser.add_argument('--do-not-switch', dest='switch', action='store_const',
                         const=False, default=True, 
                         help="Do not switch TRXs on if they are detected to be off.")
     
+    parser.add_argument('--binary', dest='binary', action='store_const',
+                        const=True, default=False,
+                        help="Ask the Nanode to send compact binary frames instead"
+                        " of JSON lines. Falls back to JSON if the Nanode's"
+                        " firmware doesn't support them.")
+    
     parser.add_argument('--no-time-correction', dest='time_correction', action='store_const',
                         const=False, default=True, 
                         help="Disable time correction and just use arrival time of packet on serial port")    
@@ -50,8 +156,12 @@ def setup_logger(args):
     logger.setLevel(numeric_level)
 
     # create formatter
-    formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s",
-                                  "%y-%m-%d %H:%M:%S %Z")
+    if len(args.port) > 1:
+        # Tag each line with the base unit's port (the thread name)
+        fmt = "%(asctime)s %(levelname)s [%(threadName)s] %(message)s"
+    else:
+        fmt = "%(asctime)s %(levelname)s %(message)s"
+    formatter = logging.Formatter(fmt, "%y-%m-%d %H:%M:%S %Z")
     
     # create console handler
     ch = logging.StreamHandler()
@@ -74,6 +184,10 @@ def setup_logger(args):
 def main():    
     args = setup_argparser()
     
+    # Scanning and accepting are editing modes: they don't log data
+    if args.scan or args.accept:
+        args.edit = True
+    
     if args.edit:
         args.time_correction = False
     
@@ -81,25 +195,47 @@ def main():
     
     log.info("Please wait for Nanode to initialise...")
     
+    nanodes = []
     try:
-        with Nanode(args) as nanode:
-            manager = Manager(nanode, args)
-            manager.unpickle()
-            
-            if args.edit:
-                log.info("Running editing...")
-                manager.run_editing()
-            else:
-                # register SIGINT and SIGTERM handler
-                sig_handler = sighandler.SigHandler()
-                sig_handler.add_objects_to_stop([nanode, manager])
-                                
-                # start logging
-                manager.run_logging()
+        for port in args.port:
+            nanodes.append(Nanode(args, port))
+        manager = Manager(nanodes, args)
+        manager.unpickle()
+        
+        if args.scan:
+            candidates = discovery.scan_all(nanodes, args.scan,
+                                            manager.transmitters.keys())
+            discovery.write_candidates(args.candidates, candidates)
+            log.info("Wrote {} candidates to {}. Name them and then run"
+                     " with --accept {}".format(len(candidates),
+                                                args.candidates, args.candidates))
+        elif args.accept:
+            try:
+                candidates = discovery.read_candidates(args.accept)
+            except discovery.DiscoveryError as e:
+                log.critical(e)
+                sys.exit(1)
+            failed = discovery.accept(manager, candidates)
+            if failed:
+                log.error("Failed to add {}".format(failed))
+        elif args.edit:
+            log.info("Running editing...")
+            manager.run_editing()
+        else:
+            # register SIGINT, SIGTERM and SIGHUP handlers
+            sig_handler = sighandler.SigHandler()
+            sig_handler.add_objects_to_stop(nanodes + [manager])
+            sig_handler.add_objects_to_reload([manager])
+                            
+            # start logging
+            manager.run_logging()
     except SystemExit:
         pass
     except:
         log.exception("")
+    finally:
+        for nanode in nanodes:
+            nanode.close()
 
     log.info("shutdown\n")
     logging.shutdown()
@@ -0,0 +1,242 @@
+"""
+Memory-mapped ring buffer holding the most recent samples of every channel,
+for consumers on the same machine (babysitter, displays etc).
+
+The logger writes it with a RingSink, selected with "--sink ring[:FILENAME]".
+The default filename is /dev/shm/rfm_ecomanager_logger.ring (falling back to
+the data directory if /dev/shm doesn't exist).
+
+File layout (all little-endian, every section 8-byte aligned):
+
+    header      magic "RFRB", version, n_channels, capacity (uint32 each)
+    channels    n_channels x (log_chan uint32, label 28 bytes)
+    control     n_channels x (seq uint64, count uint64)
+    samples     n_channels x capacity x (timestamp float64, watts float32,
+                                          state int8, 3 bytes padding)
+
+Each channel has one writer.  Writes use a seqlock: the writer increments
+seq (making it odd), writes the sample and count, then increments seq again.
+Readers never lock: they read seq, read the data and then check that seq
+is unchanged and even, retrying if not.
+
+Example:
+
+    import ringbuffer
+    ring = ringbuffer.RingReader('/dev/shm/rfm_ecomanager_logger.ring')
+    samples = ring.snapshot(1) # consistent copy, oldest first
+    print(samples['watts'][-1])
+"""
+
+from __future__ import print_function
+import os
+import mmap
+import numpy as np
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from sinks import Sink, NO_STATE
+
+MAGIC = "RFRB"
+VERSION = 1
+DEFAULT_CAPACITY = 256 # samples per channel (about 25 minutes at one every 6 s)
+DEFAULT_FILENAME = "/dev/shm/rfm_ecomanager_logger.ring"
+MAX_RETRIES = 100
+
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u4'),
+                         ('n_channels', '<u4'), ('capacity', '<u4')])
+CHANNEL_DTYPE = np.dtype([('log_chan', '<u4'), ('label', 'S28')])
+CONTROL_DTYPE = np.dtype([('seq', '<u8'), ('count', '<u8')])
+SAMPLE_DTYPE = np.dtype([('timestamp', '<f8'), ('watts', '<f4'),
+                         ('state', 'i1')], align=True)
+
+
+class RingBufferError(Exception):
+    """For invalid ring buffer files."""
+
+
+class _Layout(object):
+    """Offsets and NumPy views onto a ring buffer mapping."""
+
+    def __init__(self, buf, n_channels, capacity):
+        offset = HEADER_DTYPE.itemsize
+        self.channels = np.frombuffer(buf, CHANNEL_DTYPE, n_channels, offset)
+        offset += CHANNEL_DTYPE.itemsize * n_channels
+        offset += -offset % 8
+        self.control = np.frombuffer(buf, CONTROL_DTYPE, n_channels, offset)
+        offset += CONTROL_DTYPE.itemsize * n_channels
+        self.samples = np.frombuffer(buf, SAMPLE_DTYPE, n_channels * capacity,
+                                     offset).reshape(n_channels, capacity)
+        self.size = offset + SAMPLE_DTYPE.itemsize * n_channels * capacity
+
+
+def _size(n_channels, capacity):
+    offset = HEADER_DTYPE.itemsize + CHANNEL_DTYPE.itemsize * n_channels
+    offset += -offset % 8
+    offset += CONTROL_DTYPE.itemsize * n_channels
+    return offset + SAMPLE_DTYPE.itemsize * n_channels * capacity
+
+
+class RingWriter(object):
+    """Creates (or replaces) a ring buffer file and writes samples to it."""
+
+    def __init__(self, filename, labels, capacity=DEFAULT_CAPACITY):
+        """
+        Args:
+            filename (str)
+            labels (dict): maps log_chan to label.  One slot per log_chan.
+            capacity (int): samples per channel
+        """
+        self.filename = filename
+        log_chans = sorted(labels)
+        n_channels = len(log_chans)
+        size = _size(n_channels, capacity)
+
+        # Write a new file and rename it into place so that readers with
+        # the old file mapped never see a half-initialised buffer.
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as ring_file:
+            ring_file.truncate(size)
+        self._file = open(tmp_filename, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        header = np.frombuffer(self._mmap, HEADER_DTYPE, 1)
+        header[0] = (MAGIC, VERSION, n_channels, capacity)
+        self._layout = _Layout(self._mmap, n_channels, capacity)
+        for i, log_chan in enumerate(log_chans):
+            self._layout.channels[i] = (log_chan, labels[log_chan][:28])
+        os.rename(tmp_filename, filename)
+
+        self.capacity = capacity
+        self._slots = dict((log_chan, i) for i, log_chan in enumerate(log_chans))
+
+    def write(self, timestamp, log_chan, watts, state=None):
+        i = self._slots.get(log_chan)
+        if i is None:
+            return
+        control = self._layout.control[i:i+1] # a view, not a copy
+        count = int(control['count'][0])
+        control['seq'] += 1 # odd: write in progress
+        self._layout.samples[i, count % self.capacity] = (
+            timestamp, watts, NO_STATE if state is None else state)
+        control['count'] = count + 1
+        control['seq'] += 1 # even: write complete
+
+    def close(self):
+        self._layout = None
+        self._mmap.close()
+        self._file.close()
+
+
+class RingReader(object):
+    """Lock-free reader for a ring buffer file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as ring_file:
+            self._mmap = mmap.mmap(ring_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._inode = os.stat(filename).st_ino
+        header = np.frombuffer(self._mmap, HEADER_DTYPE, 1)[0]
+        if header['magic'] != MAGIC or header['version'] != VERSION:
+            raise RingBufferError("{} is not a version {} ring buffer"
+                                  .format(filename, VERSION))
+        self.capacity = int(header['capacity'])
+        self._layout = _Layout(self._mmap, int(header['n_channels']),
+                               self.capacity)
+        self._slots = dict((int(log_chan), i) for i, log_chan in
+                           enumerate(self._layout.channels['log_chan']))
+
+    def is_stale(self):
+        """True if the logger has since replaced the file (e.g. after a
+        restart), in which case open a new RingReader."""
+        try:
+            return os.stat(self.filename).st_ino != self._inode
+        except OSError:
+            return True
+
+    def labels(self):
+        """Returns a dict mapping log_chan to label."""
+        return dict((int(c['log_chan']), c['label'])
+                    for c in self._layout.channels)
+
+    def views(self, log_chan):
+        """Zero-copy access to one channel.
+
+        Returns:
+            seq, older, newer: older and newer are NumPy views of the
+            channel's samples which, concatenated, run oldest to newest.
+            They are only consistent if seq_unchanged(log_chan, seq) is
+            True after you have finished reading them.
+        """
+        i = self._slots[log_chan]
+        for retry in range(MAX_RETRIES):
+            seq = int(self._layout.control['seq'][i])
+            if seq % 2 == 0:
+                break
+        else:
+            raise RingBufferError("Writer stuck mid-write on channel {}"
+                                  .format(log_chan))
+        count = int(self._layout.control['count'][i])
+        samples = self._layout.samples[i]
+        if count <= self.capacity:
+            return seq, samples[:count], samples[:0]
+        head = count % self.capacity
+        return seq, samples[head:], samples[:head]
+
+    def seq_unchanged(self, log_chan, seq):
+        return int(self._layout.control['seq'][self._slots[log_chan]]) == seq
+
+    def snapshot(self, log_chan):
+        """Returns a consistent copy of one channel's samples, oldest first,
+        as a structured array with fields timestamp, watts and state."""
+        for retry in range(MAX_RETRIES):
+            seq, older, newer = self.views(log_chan)
+            samples = np.concatenate([older, newer])
+            if self.seq_unchanged(log_chan, seq):
+                return samples
+        raise RingBufferError("Failed to get a consistent snapshot of channel {}"
+                              .format(log_chan))
+
+    def latest(self, log_chan):
+        """Returns the most recent sample, or None if there isn't one."""
+        samples = self.snapshot(log_chan)
+        return samples[-1] if len(samples) else None
+
+    def close(self):
+        self._layout = None
+        self._mmap.close()
+
+
+class RingSink(Sink):
+    """Writes every reading straight into a RingWriter (no buffering: the
+    write is just a few stores into shared memory)."""
+
+    NAME = "ring"
+
+    def __init__(self, filename, labels, **kwargs):
+        super(RingSink, self).__init__(**kwargs)
+        self.filename = filename
+        self._writer = RingWriter(filename, labels or {})
+
+    def submit(self, record):
+        self._writer.write(*record)
+
+    def set_labels(self, labels):
+        # The set of channels may have changed so replace the file.  Readers
+        # notice with RingReader.is_stale().  Don't close the old writer: a
+        # base unit thread may be part way through writing to it.  Its
+        # mapping is released when the last reference goes.
+        self._writer = RingWriter(self.filename, labels)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self._writer.close()
+
+    def write_batch(self, records):
+        for record in records:
+            self._writer.write(*record)
+
+
+def default_filename(data_directory):
+    if os.path.isdir(os.path.dirname(DEFAULT_FILENAME)):
+        return DEFAULT_FILENAME
+    return os.path.join(data_directory, "latest.ring")
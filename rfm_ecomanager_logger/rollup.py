@@ -0,0 +1,186 @@
+"""
+Incremental per-channel rollups computed as data are logged.
+
+For every channel we keep 1-minute, 1-hour and 1-day buckets.  Each
+closed bucket is appended as one fixed-size binary record to
+channel_<log_chan>_<resolution>.rollup in the data directory:
+
+    start (uint32)        UNIX time of the start of the bucket (UTC-aligned)
+    count (uint32)        number of samples in the bucket
+    mean (float32)        mean watts
+    energy (float64)      time-weighted energy in watt-hours
+    min, max (float32)    min and max watts
+
+Only the 1-minute bucket is touched for every sample; hour and day buckets
+are updated from each closed minute bucket.
+
+If the last record in a file describes the same bucket as the one being
+closed (e.g. flush() wrote a partial hour before a restart with --resume)
+then the two are combined, so each file has at most one record per bucket.
+"""
+
+from __future__ import print_function, division
+import os
+import struct
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+
+RESOLUTIONS = [("1min", 60), ("1hour", 60*60), ("1day", 60*60*24)]
+RECORD = struct.Struct("<IIfdff")
+
+# Don't integrate energy across gaps longer than this number of seconds
+# (e.g. while the logger was not running or the TX was out of range).
+MAX_GAP = 60
+
+def rollup_filename(data_directory, log_chan, resolution):
+    return os.path.join(data_directory, "channel_{:d}_{:s}.rollup"
+                                        .format(log_chan, resolution))
+
+
+class Bucket(object):
+    """Accumulator for a single time bucket."""
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.total = 0.0 # sum of watts
+        self.energy = 0.0 # watt-seconds
+        self.min = None
+        self.max = None
+
+    def merge(self, other):
+        """Fold another (finer-resolution) Bucket into this one."""
+        self.count += other.count
+        self.total += other.total
+        self.energy += other.energy
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def pack(self):
+        return RECORD.pack(self.start, self.count, self.total / self.count,
+                           self.energy / 3600, self.min, self.max)
+
+
+def unpack(record):
+    """Returns a Bucket from a packed record."""
+    start, count, mean, energy_wh, min_watts, max_watts = RECORD.unpack(record)
+    bucket = Bucket(start)
+    bucket.count = count
+    bucket.total = mean * count
+    bucket.energy = energy_wh * 3600
+    bucket.min = min_watts
+    bucket.max = max_watts
+    return bucket
+
+
+class ChannelRollups(object):
+    """Rollups at every resolution in RESOLUTIONS for a single channel."""
+
+    def __init__(self, data_directory, log_chan):
+        self.filenames = [rollup_filename(data_directory, log_chan, name)
+                          for name, _ in RESOLUTIONS]
+        self.periods = [period for _, period in RESOLUTIONS]
+        self.buckets = [None] * len(RESOLUTIONS)
+        self.last_timecode = None
+        self.last_watts = None
+
+    def add(self, timecode, watts):
+        minute = self.buckets[0]
+        if minute is None or timecode >= minute.start + self.periods[0]:
+            minute = self._roll(timecode)
+
+        if self.last_timecode is not None:
+            gap = timecode - self.last_timecode
+            if gap <= MAX_GAP:
+                # Sample-and-hold: the previous reading applies until now.
+                # If we've crossed into a new bucket then only count the part
+                # of the interval which falls inside the new bucket.
+                minute.energy += self.last_watts * min(gap, timecode - minute.start)
+
+        minute.count += 1
+        minute.total += watts
+        if minute.min is None or watts < minute.min:
+            minute.min = watts
+        if minute.max is None or watts > minute.max:
+            minute.max = watts
+        self.last_timecode = timecode
+        self.last_watts = watts
+
+    def _roll(self, timecode):
+        """Close the current minute bucket (and any hour or day bucket which
+        has ended) and return a new minute bucket for timecode."""
+        previous = self.buckets[0]
+        if previous is not None:
+            # Credit the energy up to the end of the previous bucket
+            if (self.last_timecode is not None and
+                timecode - self.last_timecode <= MAX_GAP):
+                previous.energy += self.last_watts * (
+                    previous.start + self.periods[0] - self.last_timecode)
+            self._close(0)
+            for i in range(1, len(self.buckets)):
+                bucket = self.buckets[i]
+                if bucket is None:
+                    bucket = self.buckets[i] = Bucket(previous.start -
+                                                      previous.start % self.periods[i])
+                bucket.merge(previous)
+                if timecode >= bucket.start + self.periods[i]:
+                    self._close(i)
+
+        self.buckets[0] = Bucket(timecode - timecode % self.periods[0])
+        return self.buckets[0]
+
+    def _close(self, i):
+        bucket = self.buckets[i]
+        self.buckets[i] = None
+        if bucket is None or bucket.count == 0:
+            return
+        append_bucket(self.filenames[i], bucket)
+
+    def flush(self):
+        """Write all open buckets to disk (e.g. on shutdown)."""
+        minute = self.buckets[0]
+        if minute is not None:
+            for i in range(1, len(self.buckets)):
+                if self.buckets[i] is None:
+                    self.buckets[i] = Bucket(minute.start -
+                                             minute.start % self.periods[i])
+                self.buckets[i].merge(minute)
+        for i in range(len(self.buckets)):
+            self._close(i)
+        self.last_timecode = None
+
+
+def append_bucket(filename, bucket):
+    """Append bucket to the rollup file filename, combining it with the
+    last record if that describes the same bucket."""
+    _append_records(filename, bucket.pack())
+
+
+def append_rollup_file(input_filename, output_filename):
+    """Append the rollup records in input_filename onto output_filename.
+    If the first input record and the last output record describe the same
+    bucket (e.g. the logger was restarted part way through an hour) then
+    they are combined into one record.
+    """
+    with open(input_filename, 'rb') as input_file:
+        records = input_file.read()
+    records = records[:len(records) - len(records) % RECORD.size]
+    if records:
+        _append_records(output_filename, records)
+
+
+def _append_records(output_filename, records):
+    with open(output_filename, 'ab+') as output_file:
+        output_file.seek(0, os.SEEK_END)
+        if output_file.tell() >= RECORD.size:
+            output_file.seek(-RECORD.size, os.SEEK_END)
+            last = unpack(output_file.read(RECORD.size))
+            first = unpack(records[:RECORD.size])
+            if last.start == first.start:
+                last.merge(first)
+                output_file.seek(-RECORD.size, os.SEEK_END)
+                output_file.truncate()
+                records = last.pack() + records[RECORD.size:]
+        output_file.write(records)
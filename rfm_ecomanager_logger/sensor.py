@@ -1,5 +1,8 @@
 from __future__ import print_function
 from input_with_cancel import input_with_cancel, input_int_with_cancel, yes_no_cancel
+from rollup import ChannelRollups
+from coverage_index import CoverageWriter, coverage_filename
+from events import ChannelEvents
 import logging
 log = logging.getLogger("rfm_ecomanager_logger")
 
@@ -12,6 +15,14 @@ MAX_POWER_FOR_IAM_CHAN =  4000 # 4000W = 17A x 230V
 # this number of seconds after previous recorded sample 
 MIN_SAMPLE_PERIOD = 3
 
+# Reasons returned by Sensor.log_data_to_disk for readings it rejects
+TOO_HIGH = "too_high"
+TOO_SOON = "too_soon"
+
+# Names which suggest a sensor measures the whole house
+AGGREGATE_NAMES = ["agg", "aggregate", "mains", "whole_house",
+                   "whole house", "wholehouse", "whole-house"]
+
 class Sensor(object):
     """Each Transmitter can have 1 to 3 Sensors."""
     
@@ -27,8 +38,7 @@ class Sensor(object):
         if new_name:
             self.name = new_name.strip()
         
-        if self.name.lower() in ["agg", "aggregate", "mains", "whole_house",
-                                 "whole house", "wholehouse", "whole-house"]:
+        if self.name.lower() in AGGREGATE_NAMES:
             self.agg_chan = True
         
         self.agg_chan = yes_no_cancel("  Is this an aggregate (whole-house) "
@@ -55,11 +65,49 @@ class Sensor(object):
     
         self.update_filename(tx)
     
+    def configure(self, tx, name, log_chan=None, agg_chan=None):
+        """Non-interactive version of update_name().
+
+        Args:
+            tx (Transmitter)
+            name (str)
+            log_chan (int): Optional. Defaults to the current log_chan or,
+                for a new sensor, the next free log_chan.
+            agg_chan (boolean): Optional. Defaults to guessing from name.
+
+        Raises:
+            ValueError if log_chan is already in use.
+        """
+        self.name = name.strip()
+        self.agg_chan = (self.name.lower() in AGGREGATE_NAMES
+                         if agg_chan is None else agg_chan)
+        if log_chan is None:
+            log_chan = self.log_chan or tx.manager.next_free_log_chan()
+        elif (log_chan != self.log_chan and
+              log_chan in tx.manager.get_log_chan_list()):
+            raise ValueError("Log chan {:d} is already in use.".format(log_chan))
+        if log_chan != self.log_chan or self.filename is None:
+            self.log_chan = log_chan
+            self.update_filename(tx)
+
     def update_filename(self, tx):
         self.filename = tx.manager.args.data_directory + \
                         "/channel_{:d}.dat".format(self.log_chan)
+        self.rollups = ChannelRollups(tx.manager.args.data_directory,
+                                      self.log_chan)
+        self.coverage = CoverageWriter(coverage_filename(self.filename))
+        args = tx.manager.args
+        self.events = ChannelEvents(
+            args.data_directory, self.log_chan,
+            on_watts=getattr(args, 'event_on_watts', None),
+            hysteresis=getattr(args, 'event_hysteresis', None),
+            step_watts=getattr(args, 'event_step_watts', None),
+            min_duration=getattr(args, 'event_min_duration', None))
+        self.sinks = tx.manager.sinks
                         
     def log_data_to_disk(self, timecode, watts, new_state=None):
+        """Returns TOO_HIGH or TOO_SOON if the reading is rejected by a
+        filter, else None."""
         log.debug("log_data_to_disk {} {} {} {}"
                   .format(self.filename, self.name, timecode, watts))
 
@@ -74,32 +122,41 @@ class Sensor(object):
                 log.debug("Not logging to disk because watts {} >"
                           " MAX_POWER_FOR_AGG_CHAN {}"
                           .format(watts, MAX_POWER_FOR_AGG_CHAN))
-                return
+                return TOO_HIGH
         else: # IAM channel
             if watts > MAX_POWER_FOR_IAM_CHAN:
                 log.debug("Not logging to disk because watts {} >"
                           " MAX_POWER_FOR_IAM_CHAN {}"
                           .format(watts, MAX_POWER_FOR_IAM_CHAN))
-                return
+                return TOO_HIGH
         
         # Ignore 2 samples in quick succession
         if self.last_logged_timecode > (timecode - MIN_SAMPLE_PERIOD):
             log.debug("Not logging to disk because sample arrived too soon"
                       " after last recorded sample")
-            return
+            return TOO_SOON
         
-        # If we get to here then write to disk
-        with open(self.filename, 'a') as data_file:            
-            data_file.write("{:d} {:d}".format(timecode, watts))
-            if new_state is None:
-                data_file.write("\n")
-            else:                                
-                data_file.write(" {:d}\n".format(new_state))
-            self.last_logged_timecode = timecode
-            # file will close when we leave "with" block        
+        # If we get to here then hand the reading to the output sinks
+        self.sinks.submit((timecode, self.log_chan, watts, new_state))
+        self.last_logged_timecode = timecode
+
+        self.rollups.add(timecode, watts)
+        self.coverage.add(timecode)
+        self.events.add(timecode, watts, new_state)
+
+    def flush_rollups(self):
+        """Write rollups and events which are still in memory."""
+        if getattr(self, 'rollups', None) is not None:
+            self.rollups.flush()
+        if getattr(self, 'events', None) is not None:
+            self.events.flush()
 
     def __getstate__(self):
         """Used by pickle()"""
         odict = self.__dict__.copy() # copy the dict since we change it
         del odict['filename']
+        odict.pop('rollups', None)
+        odict.pop('coverage', None)
+        odict.pop('events', None)
+        odict.pop('sinks', None)
         return odict
@@ -5,11 +5,15 @@ import signal
 class SigHandler(object):
     def __init__(self):
         self.objects_to_stop = []
+        self.objects_to_reload = []
         self._register()
     
     def add_objects_to_stop(self, objects):
         self.objects_to_stop.extend(objects)
     
+    def add_objects_to_reload(self, objects):
+        self.objects_to_reload.extend(objects)
+    
     def _signal_handler(self, signal_number, frame):
         """Handle SIGINT and SIGTERM.
         
@@ -25,7 +29,18 @@ class SigHandler(object):
         for obj in self.objects_to_stop:
             obj.abort = True
 
+    def _reload_handler(self, signal_number, frame):
+        """Handle SIGHUP.
+        
+        Sets `reload_requested` to True.  The objects do the actual
+        reloading outside the signal handler.
+        """
+        log.info("Signal SIGHUP received. Reloading configuration.")
+        for obj in self.objects_to_reload:
+            obj.reload_requested = True
+
     def _register(self):
         log.info("setting signal handlers")
         signal.signal(signal.SIGINT,  self._signal_handler)
-        signal.signal(signal.SIGTERM, self._signal_handler)
\ No newline at end of file
+        signal.signal(signal.SIGTERM, self._signal_handler)
+        signal.signal(signal.SIGHUP,  self._reload_handler)
@@ -0,0 +1,448 @@
+"""
+Output sinks.  Every accepted reading is submitted to a SinkDispatcher as a
+(timestamp, log_chan, watts, state) record.  The dispatcher appends the
+record to the buffer of every registered Sink and returns immediately.
+Each Sink has its own thread which periodically writes its buffer as a
+batch, so a slow or failing sink never blocks the serial loop: if a sink's
+buffer fills up then records are dropped according to its overflow policy.
+
+Sinks are selected on the command line with one or more --sink options:
+
+    redd                    channel_N.dat text files (the default)
+    binary                  channel_N.bin fixed-size binary records
+    sqlite[:FILENAME]       SQLite database (default: readings.sqlite)
+    socket:HOST:PORT        newline-delimited text over TCP
+    stream:ADDRESS          low-latency datagrams (see stream.py)
+    ring[:FILENAME]         shared-memory ring buffer (see ringbuffer.py)
+    ingest[:DIRECTORY]      one append-only log for all channels, split
+                            into channel_N.dat files later (see ingestlog.py)
+
+Each can be followed by comma-separated options, e.g.:
+
+    --sink socket:localhost:9000,flush=5,buffer=1000,overflow=drop_newest
+"""
+
+from __future__ import print_function
+import abc
+import os
+import collections
+import errno
+import fcntl
+import threading
+import socket
+import struct
+import time
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from sqlite_store import Store
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+NO_STATE = -1 # used by binary sinks when a record has no state
+OPTIONS = ['flush_interval', 'buffer_size', 'overflow']
+SINK_OPTIONS = {"ingest": ['segment', 'demux']} # options for one type of sink
+DATA_LOCK = "channels.lock" # see lock_data_directory()
+
+
+class SinkError(Exception):
+    """For errors configuring sinks."""
+
+
+def lock_data_directory(data_directory, exclusive=False, blocking=True):
+    """Take an advisory lock on data_directory's channel files.  Anything
+    which appends to them holds a shared lock while it has them open;
+    anything which rewrites them (e.g. scripts/check_data.py --repair)
+    must hold an exclusive lock.
+
+    Returns:
+        the open lock file (close it to release the lock), or None if not
+        blocking and the lock is held by someone else
+    """
+    lock = open(os.path.join(data_directory, DATA_LOCK), 'a')
+    flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(lock, flags)
+    except IOError as e:
+        lock.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock
+
+
+class Sink(object):
+    """Abstract base class for output sinks.
+
+    Subclasses must implement write_batch() and may override open()
+    and close().  open(), write_batch() and close() are only ever called
+    from the sink's own thread.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    NAME = None
+    FLUSH_INTERVAL = 1 # seconds
+    BUFFER_SIZE = 100000 # records
+    OVERFLOW = DROP_OLDEST
+    MAX_RETRY_INTERVAL = 60 # seconds
+
+    def __init__(self, flush_interval=None, buffer_size=None, overflow=None):
+        self.flush_interval = float(flush_interval or self.FLUSH_INTERVAL)
+        self.buffer_size = int(buffer_size or self.BUFFER_SIZE)
+        self.overflow = overflow or self.OVERFLOW
+        if self.overflow not in [DROP_OLDEST, DROP_NEWEST]:
+            raise SinkError("Unknown overflow policy '{}'".format(self.overflow))
+        self.dropped = 0
+        self.failures = 0
+        self.last_write_time = None
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = None
+
+    def __str__(self):
+        return self.NAME
+
+    def submit(self, record):
+        """Called from the ingest path.  Never blocks on I/O."""
+        with self._lock:
+            if len(self._buffer) >= self.buffer_size:
+                self.dropped += 1
+                if self.overflow == DROP_NEWEST:
+                    return
+                self._buffer.popleft()
+            self._buffer.append(record)
+
+    def queue_depth(self):
+        return len(self._buffer)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="sink-" + self.NAME)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Write any buffered records and stop the sink's thread."""
+        self._stop = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def open(self):
+        pass
+
+    @abc.abstractmethod
+    def write_batch(self, records):
+        """Write a list of (timestamp, log_chan, watts, state) records.
+
+        If it fails after writing some of the records, it should set the
+        `unwritten` attribute of the exception it raises to the list of
+        records which weren't written.  Otherwise the whole batch is
+        written again on the next attempt."""
+
+    def close(self):
+        pass
+
+    def set_labels(self, labels):
+        """Called when the configuration is reloaded.  Sinks which use
+        labels override this."""
+
+    def _take_batch(self):
+        with self._lock:
+            batch = list(self._buffer)
+            self._buffer.clear()
+        return batch
+
+    def _return_batch(self, batch):
+        """Put a batch which failed to write back at the front of the
+        buffer, dropping records if there isn't room."""
+        with self._lock:
+            room = self.buffer_size - len(self._buffer)
+            if room < len(batch):
+                self.dropped += len(batch) - room
+                if self.overflow == DROP_NEWEST:
+                    batch = batch[:room]
+                else:
+                    batch = batch[len(batch) - room:]
+            self._buffer.extendleft(reversed(batch))
+
+    def _run(self):
+        retry_interval = self.flush_interval
+        opened = False
+        while True:
+            self._wake.wait(retry_interval)
+            self._wake.clear()
+            stopping = self._stop
+            batch = self._take_batch()
+            try:
+                if not opened:
+                    self.open()
+                    opened = True
+                if batch:
+                    self.write_batch(batch)
+                    self.last_write_time = time.time()
+            except Exception as e:
+                self.failures += 1
+                batch = getattr(e, 'unwritten', batch)
+                log.exception("Sink {} failed to write {} records. Buffering."
+                              .format(self.NAME, len(batch)))
+                self._return_batch(batch)
+                retry_interval = min(retry_interval * 2, self.MAX_RETRY_INTERVAL)
+                if stopping:
+                    log.error("Sink {} stopped with {} unwritten records."
+                              .format(self.NAME, self.queue_depth()))
+                    break
+            else:
+                retry_interval = self.flush_interval
+                if stopping:
+                    break
+        if opened:
+            try:
+                self.close()
+            except Exception:
+                log.exception("Failed to close sink {}".format(self.NAME))
+        if self.dropped:
+            log.warn("Sink {} dropped {} records.".format(self.NAME, self.dropped))
+
+
+class ReddSink(Sink):
+    """channel_N.dat text files in the format used by MIT's REDD dataset.
+    Keeps one unbuffered append-mode file handle per channel open and
+    writes each channel's records in a batch with a single write(), so a
+    failure part way through a batch never writes a record twice."""
+
+    NAME = "redd"
+    MODE = 'a'
+
+    def __init__(self, data_directory, **kwargs):
+        super(ReddSink, self).__init__(**kwargs)
+        self.data_directory = data_directory
+        self._files = {}
+        self._data_lock = None
+
+    def open(self):
+        self._data_lock = lock_data_directory(self.data_directory)
+
+    def filename(self, log_chan):
+        return os.path.join(self.data_directory,
+                            "channel_{:d}.dat".format(log_chan))
+
+    def format(self, timestamp, watts, state):
+        if state is None:
+            return "{:d} {:d}\n".format(timestamp, watts)
+        return "{:d} {:d} {:d}\n".format(timestamp, watts, state)
+
+    def write_batch(self, records):
+        chunks = collections.OrderedDict()
+        for timestamp, log_chan, watts, state in records:
+            chunks.setdefault(log_chan, []).append(
+                self.format(timestamp, watts, state))
+        written = set()
+        for log_chan, chunk in chunks.iteritems():
+            try:
+                data_file = self._files.get(log_chan)
+                if data_file is None:
+                    data_file = self._files[log_chan] = open(
+                        self.filename(log_chan), self.MODE, 0)
+                data_file.write("".join(chunk))
+            except Exception as e:
+                e.unwritten = [record for record in records
+                               if record[1] not in written]
+                raise
+            written.add(log_chan)
+
+    def close(self):
+        for data_file in self._files.itervalues():
+            data_file.close()
+        self._files = {}
+        if self._data_lock is not None:
+            self._data_lock.close()
+            self._data_lock = None
+
+
+class BinarySink(ReddSink):
+    """channel_N.bin files of little-endian fixed-size records:
+    timestamp (uint32), watts (float32), state (int8, -1 if no state)."""
+
+    NAME = "binary"
+    MODE = 'ab'
+    RECORD = struct.Struct("<Ifb")
+
+    def filename(self, log_chan):
+        return os.path.join(self.data_directory,
+                            "channel_{:d}.bin".format(log_chan))
+
+    def format(self, timestamp, watts, state):
+        return self.RECORD.pack(timestamp, watts,
+                                NO_STATE if state is None else state)
+
+
+class SqliteSink(Sink):
+    """A sqlite_store.Store.  Each batch is inserted in a single
+    transaction."""
+
+    NAME = "sqlite"
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, filename, labels=None, **kwargs):
+        """
+        Args:
+            filename (str)
+            labels (dict): Optional. Maps log_chan to label.
+        """
+        super(SqliteSink, self).__init__(**kwargs)
+        self.filename = filename
+        self.labels = labels or {}
+        self._labels_changed = False
+        self._store = None
+
+    def open(self):
+        self._store = Store(self.filename)
+        self._write_labels()
+
+    def set_labels(self, labels):
+        self.labels = labels
+        self._labels_changed = True
+
+    def write_batch(self, records):
+        if self._labels_changed:
+            self._labels_changed = False
+            self._write_labels()
+        self._store.insert(records)
+
+    def _write_labels(self):
+        for log_chan, label in self.labels.iteritems():
+            self._store.set_label(log_chan, [label])
+
+    def close(self):
+        self._store.close()
+
+
+class SocketSink(Sink):
+    """Newline-delimited "timestamp log_chan watts [state]" text over TCP.
+    Reconnects on the next flush if the connection fails."""
+
+    NAME = "socket"
+    BUFFER_SIZE = 10000
+    TIMEOUT = 5 # seconds
+
+    def __init__(self, address, **kwargs):
+        super(SocketSink, self).__init__(**kwargs)
+        self.address = address
+        self._socket = None
+
+    def write_batch(self, records):
+        lines = []
+        for timestamp, log_chan, watts, state in records:
+            if state is None:
+                lines.append("{:d} {:d} {:d}\n".format(timestamp, log_chan, watts))
+            else:
+                lines.append("{:d} {:d} {:d} {:d}\n"
+                             .format(timestamp, log_chan, watts, state))
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, self.TIMEOUT)
+        data = "".join(lines)
+        sent = 0
+        try:
+            while sent < len(data):
+                sent += self._socket.send(data[sent:])
+        except socket.error as e:
+            self.close()
+            # Resend from the first line which wasn't sent completely
+            e.unwritten = records[data.count("\n", 0, sent):]
+            raise
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class SinkDispatcher(object):
+    """Fans records out to every registered Sink."""
+
+    def __init__(self):
+        self.sinks = []
+
+    def add(self, sink):
+        self.sinks.append(sink)
+
+    def submit(self, record):
+        for sink in self.sinks:
+            sink.submit(record)
+
+    def start(self):
+        for sink in self.sinks:
+            log.info("Starting sink {}".format(sink))
+            sink.start()
+
+    def stop(self):
+        for sink in self.sinks:
+            sink.stop()
+
+    def set_labels(self, labels):
+        for sink in self.sinks:
+            sink.set_labels(labels)
+
+    def queue_depth(self):
+        return max([sink.queue_depth() for sink in self.sinks] or [0])
+
+    def last_write_time(self):
+        times = [sink.last_write_time for sink in self.sinks
+                 if sink.last_write_time is not None]
+        return max(times) if times else None
+
+
+def create_sink(spec, data_directory, labels=None):
+    """
+    Args:
+        spec (str): e.g. "redd" or "sqlite:/tmp/x.sqlite,flush=10"
+        data_directory (str)
+        labels (dict): Optional. Maps log_chan to label.
+
+    Returns:
+        Sink
+
+    Raises:
+        SinkError if spec is not valid.
+    """
+    parts = spec.split(',')
+    name, _, arg = parts[0].partition(':')
+    kwargs = {}
+    for option in parts[1:]:
+        key, _, value = option.partition('=')
+        key = {'flush': 'flush_interval', 'buffer': 'buffer_size'}.get(key, key)
+        if key not in OPTIONS + SINK_OPTIONS.get(name, []):
+            raise SinkError("Unknown sink option '{}' in '{}'".format(option, spec))
+        kwargs[key] = value
+
+    if name == ReddSink.NAME:
+        return ReddSink(data_directory, **kwargs)
+    elif name == BinarySink.NAME:
+        return BinarySink(data_directory, **kwargs)
+    elif name == SqliteSink.NAME:
+        filename = arg or os.path.join(data_directory, "readings.sqlite")
+        return SqliteSink(filename, labels, **kwargs)
+    elif name == SocketSink.NAME:
+        host, _, port = arg.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            raise SinkError("Expected socket:HOST:PORT, got '{}'".format(spec))
+        return SocketSink((host or 'localhost', port), **kwargs)
+    elif name == "stream":
+        from stream import StreamSink # stream.py imports this module
+        return StreamSink(arg, labels, **kwargs)
+    elif name == "ring":
+        import ringbuffer # ringbuffer.py imports this module
+        filename = arg or ringbuffer.default_filename(data_directory)
+        return ringbuffer.RingSink(filename, labels, **kwargs)
+    elif name == "ingest":
+        import ingestlog # ingestlog.py imports this module
+        return ingestlog.IngestSink(data_directory, arg or None, **kwargs)
+    else:
+        raise SinkError("Unknown sink '{}'".format(name))
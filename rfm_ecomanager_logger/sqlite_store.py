@@ -0,0 +1,138 @@
+"""
+SQLite time-series store for readings, labels and IAM button presses.
+
+Readings are kept in a WITHOUT ROWID table whose primary key is
+(log_chan, timestamp), so rows are clustered by channel and time and a
+range query for one channel is a single B-tree range scan.
+
+Example:
+
+    import sqlite_store
+    store = sqlite_store.Store('/data/house_1.sqlite')
+    timestamps, watts = store.query('kettle', start=1360396444, end=1360400145)
+"""
+
+from __future__ import print_function
+import sqlite3
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    log_chan INTEGER PRIMARY KEY,
+    label TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS label_synonyms (
+    synonym TEXT PRIMARY KEY,
+    log_chan INTEGER NOT NULL REFERENCES channels(log_chan)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS readings (
+    log_chan INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    watts REAL NOT NULL,
+    PRIMARY KEY (log_chan, timestamp)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS button_presses (
+    log_chan INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    PRIMARY KEY (log_chan, timestamp)
+) WITHOUT ROWID;
+"""
+
+
+class StoreError(Exception):
+    """For errors from the SQLite store."""
+
+
+class Store(object):
+    """A connection to a readings database.  Like sqlite3 connections, a
+    Store must only be used from the thread which created it."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def set_label(self, log_chan, synonyms):
+        """
+        Args:
+            log_chan (int)
+            synonyms (list of strings): the first is the primary label
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO channels VALUES (?, ?)",
+                (log_chan, synonyms[0]))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO label_synonyms VALUES (?, ?)",
+                [(synonym, log_chan) for synonym in synonyms])
+
+    def labels(self):
+        """Returns a dict mapping log_chan to primary label."""
+        return dict(self.connection.execute(
+                        "SELECT log_chan, label FROM channels"))
+
+    def resolve(self, channel):
+        """
+        Args:
+            channel (int or str): log_chan or any synonym
+
+        Returns:
+            log_chan (int)
+        """
+        if isinstance(channel, (int, long)):
+            return channel
+        row = self.connection.execute(
+            "SELECT log_chan FROM label_synonyms WHERE synonym = ?",
+            (channel,)).fetchone()
+        if row is None:
+            raise StoreError("Unknown label '{}'".format(channel))
+        return row[0]
+
+    def insert(self, records):
+        """Insert a batch of (timestamp, log_chan, watts, state) records
+        in a single transaction.  Records with a state other than None are
+        also recorded as button presses."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO readings VALUES (?, ?, ?)",
+                [(log_chan, timestamp, watts)
+                 for timestamp, log_chan, watts, state in records])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO button_presses VALUES (?, ?, ?)",
+                [(log_chan, timestamp, state)
+                 for timestamp, log_chan, watts, state in records
+                 if state is not None])
+
+    def query(self, channel, start=None, end=None):
+        """
+        Args:
+            channel (int or str): log_chan or any synonym
+            start, end (int): Optional. Inclusive UNIX time range.
+
+        Returns:
+            timestamps, watts (lists)
+        """
+        rows = self._range("SELECT timestamp, watts FROM readings",
+                           channel, start, end)
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def button_presses(self, channel, start=None, end=None):
+        """Returns a list of (timestamp, state) tuples."""
+        return self._range("SELECT timestamp, state FROM button_presses",
+                           channel, start, end)
+
+    def _range(self, select, channel, start, end):
+        sql = select + " WHERE log_chan = ? AND timestamp BETWEEN ? AND ?" \
+                       " ORDER BY timestamp"
+        return self.connection.execute(
+            sql, (self.resolve(channel),
+                  -2**63 if start is None else start,
+                  2**63 - 1 if end is None else end)).fetchall()
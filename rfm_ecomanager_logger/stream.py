@@ -0,0 +1,213 @@
+"""
+Low-latency stream of accepted readings over local UDP or Unix datagram
+sockets.
+
+The logger publishes with a StreamSink, selected on the command line with:
+
+    --sink stream:udp:HOST:PORT
+    --sink stream:unix:/path/to/socket
+
+By default each reading is sent as soon as the Sensor accepts it.  Give
+a coalescing window in seconds with the flush option (e.g.
+"--sink stream:unix:/tmp/rfm.sock,flush=0.5") to batch readings into one
+datagram per window.  Sending never blocks: if a subscriber isn't running or
+its receive buffer is full then the datagram is dropped.
+
+Each datagram holds one or more messages.  Version 1 messages are:
+
+    magic (2 bytes)    "RF"
+    version (uint8)    1
+    timestamp (uint32) UNIX time
+    log_chan (uint16)
+    watts (float32)
+    state (int8)       IAM state, or -1 if the state did not change
+    label_len (uint8)
+    label              label_len bytes of UTF-8
+
+All integers are little-endian.  Subscribers use the Subscriber class:
+
+    import stream
+    for reading in stream.Subscriber('unix:/tmp/rfm.sock'):
+        print(reading.label, reading.watts)
+"""
+
+from __future__ import print_function
+import os
+import socket
+import struct
+import errno
+import time
+import collections
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from sinks import Sink, SinkError, NO_STATE
+
+MAGIC = "RF"
+VERSION = 1
+HEADER = struct.Struct("<2sBIHfbB")
+MAX_DATAGRAM = 1400 # bytes; fits in one Ethernet frame
+ERROR_LOG_INTERVAL = 60 # seconds between warnings about failed sends
+DROPPED_ERRNOS = [errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOENT,
+                  errno.ECONNREFUSED, errno.ENOBUFS]
+
+Reading = collections.namedtuple('Reading',
+                                 ['timestamp', 'log_chan', 'label', 'watts', 'state'])
+
+
+class StreamError(Exception):
+    """For malformed datagrams."""
+
+
+def parse_address(address):
+    """
+    Args:
+        address (str): "udp:HOST:PORT" or "unix:PATH"
+
+    Returns:
+        (socket family, address suitable for socket.sendto)
+    """
+    kind, _, rest = address.partition(':')
+    if kind == 'unix':
+        return socket.AF_UNIX, rest
+    elif kind == 'udp':
+        host, _, port = rest.rpartition(':')
+        try:
+            return socket.AF_INET, (host or 'localhost', int(port))
+        except ValueError:
+            pass
+    raise SinkError("Expected udp:HOST:PORT or unix:PATH, got '{}'"
+                    .format(address))
+
+
+def encode(timestamp, log_chan, watts, state, label):
+    label = label[:255]
+    return HEADER.pack(MAGIC, VERSION, timestamp, log_chan, watts,
+                       NO_STATE if state is None else state,
+                       len(label)) + label
+
+
+def decode(datagram):
+    """Returns a list of Readings."""
+    readings = []
+    offset = 0
+    while offset < len(datagram):
+        try:
+            magic, version, timestamp, log_chan, watts, state, label_len = \
+                HEADER.unpack_from(datagram, offset)
+        except struct.error:
+            raise StreamError("Truncated message")
+        if magic != MAGIC or version != VERSION:
+            raise StreamError("Unsupported message {!r} version {}"
+                              .format(magic, version))
+        offset += HEADER.size
+        label = datagram[offset:offset + label_len]
+        offset += label_len
+        readings.append(Reading(timestamp, log_chan, label, watts,
+                                None if state == NO_STATE else state))
+    return readings
+
+
+class StreamSink(Sink):
+    """Publishes readings to one subscriber address."""
+
+    NAME = "stream"
+    FLUSH_INTERVAL = 0 # no coalescing by default
+    BUFFER_SIZE = 10000
+
+    def __init__(self, address, labels=None, **kwargs):
+        super(StreamSink, self).__init__(**kwargs)
+        self.address = address
+        self.labels = labels or {}
+        family, self._sendto_address = parse_address(address)
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._last_error_log = None
+
+    def __str__(self):
+        return "stream to " + self.address
+
+    def set_labels(self, labels):
+        self.labels = labels
+
+    def submit(self, record):
+        if self.flush_interval:
+            super(StreamSink, self).submit(record)
+        else:
+            # On the ingest path, so no error may escape
+            try:
+                self._send(self._encode(record))
+            except socket.error as e:
+                self.dropped += 1
+                now = time.time()
+                if (self._last_error_log is None or
+                    now - self._last_error_log >= ERROR_LOG_INTERVAL):
+                    self._last_error_log = now
+                    log.warn("{} failed: {}. {} readings dropped so far."
+                             .format(self, e, self.dropped))
+
+    def start(self):
+        if self.flush_interval:
+            super(StreamSink, self).start()
+
+    def stop(self):
+        super(StreamSink, self).stop()
+        self._socket.close()
+
+    def write_batch(self, records):
+        datagram = ""
+        for record in records:
+            message = self._encode(record)
+            if len(datagram) + len(message) > MAX_DATAGRAM:
+                self._send(datagram)
+                datagram = ""
+            datagram += message
+        if datagram:
+            self._send(datagram)
+
+    def _encode(self, record):
+        timestamp, log_chan, watts, state = record
+        return encode(timestamp, log_chan, watts, state,
+                      self.labels.get(log_chan, ""))
+
+    def _send(self, datagram):
+        try:
+            self._socket.sendto(datagram, self._sendto_address)
+        except socket.error as e:
+            if e.errno not in DROPPED_ERRNOS:
+                raise
+            self.dropped += 1
+
+
+class Subscriber(object):
+    """Receives readings published by a StreamSink."""
+
+    def __init__(self, address):
+        family, self._address = parse_address(address)
+        self._family = family
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_UNIX and os.path.exists(self._address):
+            os.remove(self._address) # left behind by a previous subscriber
+        self._socket.bind(self._address)
+
+    def receive(self, timeout=None):
+        """
+        Returns:
+            list of Readings from the next datagram, or an empty list
+            if timeout (seconds) expires first.
+        """
+        self._socket.settimeout(timeout)
+        try:
+            datagram = self._socket.recv(65536)
+        except socket.timeout:
+            return []
+        return decode(datagram)
+
+    def __iter__(self):
+        while True:
+            for reading in self.receive():
+                yield reading
+
+    def close(self):
+        self._socket.close()
+        if self._family == socket.AF_UNIX and os.path.exists(self._address):
+            os.remove(self._address)
@@ -0,0 +1,407 @@
+#!/usr/bin/python
+"""
+Starts, stops and monitors rfm_ecomanager_logger.
+
+    supervisor.py start [-- LOGGER_ARGS...]
+    supervisor.py stop
+    supervisor.py status
+    supervisor.py reload                    (SIGHUP: reload the transmitters)
+    supervisor.py run [-- LOGGER_ARGS...]   (monitor in the foreground)
+
+`start` launches a background monitor process which runs the logger with
+--heartbeat and restarts it within a second or two if it exits or if its
+heartbeat stalls: either the heartbeat itself stops (the whole process is
+stuck) or a base unit's read loop stops going round (see heartbeat.py).
+If the logger keeps failing straight after starting then restarts back off
+up to MAX_RESTART_DELAY seconds.
+
+The monitor records its state in supervisor.json in the run directory, so
+`status` can answer immediately without asking the monitor anything.
+The logger's stdout and stderr go to rfm_ecomanager_logger.out.
+"""
+
+from __future__ import print_function, division
+import argparse
+import os
+import sys
+import signal
+import subprocess
+import time
+import errno
+import inspect
+import logging
+log = logging.getLogger("supervisor")
+from heartbeat import write_json_atomically, read_json
+
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+LOGGER_SCRIPT = os.path.realpath(os.path.join(FILE_PATH, "rfm_ecomanager_logger.py"))
+RUN_DIRECTORY = os.path.realpath(os.path.join(FILE_PATH, ".."))
+
+STATE_FILENAME = "supervisor.json"
+HEARTBEAT_FILENAME = "heartbeat.json"
+LOGGER_OUTPUT_FILENAME = "rfm_ecomanager_logger.out"
+SUPERVISOR_OUTPUT_FILENAME = "supervisor.out"
+
+
+def pid_is_running(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def stall_reason(heartbeat, pid, started, now, heartbeat_interval,
+                 stall_timeout, startup_timeout):
+    """Decides whether a running logger has stalled.
+
+    Args:
+        heartbeat (dict): the latest heartbeat, or None
+        pid (int): the logger's process ID (heartbeats from any other
+            process are ignored)
+        started (float): UNIX time the logger was started
+        now (float): UNIX time
+        heartbeat_interval, stall_timeout, startup_timeout (float): seconds
+
+    Returns:
+        None if the logger looks healthy, otherwise a string describing
+        why it has stalled.
+    """
+    if heartbeat is None or heartbeat.get('pid') != pid:
+        if now - started > startup_timeout:
+            return "no heartbeat {:.0f} s after starting".format(now - started)
+        return None
+
+    # Allow for a slow disk or a busy machine
+    max_heartbeat_age = max(3 * heartbeat_interval, 2)
+    age = now - heartbeat['time']
+    if age > max_heartbeat_age:
+        return "last heartbeat was {:.1f} s ago".format(age)
+
+    for port, counters in sorted(heartbeat.get('base_units', {}).iteritems()):
+        last_loop_time = counters.get('last_loop_time')
+        if last_loop_time is None:
+            if now - started > startup_timeout:
+                return ("read loop for {} didn't start within {:.0f} s"
+                        .format(port, startup_timeout))
+        elif now - last_loop_time > stall_timeout:
+            return ("read loop for {} has been stuck for {:.0f} s"
+                    .format(port, now - last_loop_time))
+    return None
+
+
+class Supervisor(object):
+    """Runs a logger command, restarting it if it exits or stalls.
+
+    Attributes:
+      - abort (boolean): set to stop the logger and return from run()
+      - restarts (int)
+    """
+
+    POLL_INTERVAL = 0.5 # seconds
+    MIN_UPTIME = 10 # seconds. Failing sooner than this triggers back off.
+    MAX_RESTART_DELAY = 60 # seconds
+    RESTART_KILL_TIMEOUT = 2 # seconds to wait for SIGTERM when restarting
+    STOP_TIMEOUT = 10 # seconds to wait for SIGTERM when stopping
+
+    def __init__(self, command, run_directory=RUN_DIRECTORY,
+                 heartbeat_interval=1, stall_timeout=30, startup_timeout=60):
+        """
+        Args:
+            command (list of str): logger command line.  --heartbeat and
+                --heartbeat-interval are appended.
+            run_directory (str): where the state, heartbeat and output
+                files are kept
+            heartbeat_interval (float): seconds
+            stall_timeout (float): seconds a read loop may go without
+                going round before the logger is restarted
+            startup_timeout (float): seconds the logger has to start
+                its read loops (the Nanodes have to initialise first)
+        """
+        self.run_directory = run_directory
+        self.heartbeat_filename = os.path.join(run_directory, HEARTBEAT_FILENAME)
+        self.state_filename = os.path.join(run_directory, STATE_FILENAME)
+        self.output_filename = os.path.join(run_directory, LOGGER_OUTPUT_FILENAME)
+        self.heartbeat_interval = heartbeat_interval
+        self.stall_timeout = stall_timeout
+        self.startup_timeout = startup_timeout
+        self.command = command + ['--heartbeat', self.heartbeat_filename,
+                                  '--heartbeat-interval', str(heartbeat_interval)]
+        self.abort = False
+        self.restarts = 0
+        self.last_restart_reason = None
+        self.last_restart_time = None
+        self._process = None
+        self._started = None
+        self._next_start_time = 0
+        self._restart_delay = 0
+
+    def run(self):
+        log.info("Supervising: {}".format(" ".join(self.command)))
+        while not self.abort:
+            now = time.time()
+            if self._process is None:
+                if now >= self._next_start_time:
+                    self._start_logger()
+            else:
+                reason = self._check_logger(now)
+                if reason:
+                    self._restart_logger(reason, now)
+            time.sleep(Supervisor.POLL_INTERVAL)
+        self._stop_logger(Supervisor.STOP_TIMEOUT)
+        self._write_state(running=False)
+        log.info("Stopped")
+
+    def _check_logger(self, now):
+        """Returns a reason to restart the logger, or None."""
+        return_code = self._process.poll()
+        if return_code is not None:
+            return "logger exited with code {}".format(return_code)
+        return stall_reason(read_json(self.heartbeat_filename),
+                            self._process.pid, self._started, now,
+                            self.heartbeat_interval, self.stall_timeout,
+                            self.startup_timeout)
+
+    def _start_logger(self):
+        with open(self.output_filename, 'a') as output:
+            self._process = subprocess.Popen(self.command, stdout=output,
+                                             stderr=subprocess.STDOUT,
+                                             close_fds=True)
+        self._started = time.time()
+        log.info("Started logger, pid {}".format(self._process.pid))
+        self._write_state()
+
+    def _restart_logger(self, reason, now):
+        log.error("Restarting logger: {}".format(reason))
+        self._stop_logger(Supervisor.RESTART_KILL_TIMEOUT)
+        if now - self._started < Supervisor.MIN_UPTIME:
+            self._restart_delay = min(max(self._restart_delay * 2, 1),
+                                      Supervisor.MAX_RESTART_DELAY)
+            log.info("Logger failed soon after starting. Waiting {} s."
+                     .format(self._restart_delay))
+        else:
+            self._restart_delay = 0
+        self._next_start_time = time.time() + self._restart_delay
+        self.restarts += 1
+        self.last_restart_reason = reason
+        self.last_restart_time = now
+        self._write_state()
+
+    def _stop_logger(self, timeout):
+        """SIGTERM the logger, then SIGKILL it if it's still running
+        after timeout seconds."""
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            self._process.terminate()
+            deadline = time.time() + timeout
+            while self._process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self._process.poll() is None:
+                log.error("Logger didn't stop within {} s. Killing it."
+                          .format(timeout))
+                self._process.kill()
+                self._process.wait()
+        self._process = None
+
+    def _write_state(self, running=True):
+        write_json_atomically(self.state_filename, {
+            'supervisor_pid': os.getpid() if running else None,
+            'logger_pid': self._process.pid if self._process else None,
+            'logger_start_time': self._started,
+            'restarts': self.restarts,
+            'last_restart_reason': self.last_restart_reason,
+            'last_restart_time': self.last_restart_time,
+            'command': self.command})
+
+
+def status(run_directory, stall_timeout=30):
+    """Prints the status of the logger.
+
+    Returns:
+        0 if the logger is running and healthy, otherwise 1
+    """
+    state = read_json(os.path.join(run_directory, STATE_FILENAME)) or {}
+    heartbeat = read_json(os.path.join(run_directory, HEARTBEAT_FILENAME))
+    now = time.time()
+
+    if not pid_is_running(state.get('supervisor_pid')):
+        print("Supervisor is not running.")
+        return 1
+    print("Supervisor is running (pid {}), {} restarts."
+          .format(state['supervisor_pid'], state['restarts']))
+    if state['last_restart_reason']:
+        print("Last restart {:.0f} s ago: {}"
+              .format(now - state['last_restart_time'],
+                      state['last_restart_reason']))
+
+    logger_pid = state.get('logger_pid')
+    if not pid_is_running(logger_pid):
+        print("Logger is not running (waiting to restart).")
+        return 1
+    print("Logger is running (pid {}) for {:.0f} s."
+          .format(logger_pid, now - state['logger_start_time']))
+    if heartbeat is None or heartbeat.get('pid') != logger_pid:
+        print("No heartbeat yet.")
+        return 1
+
+    def ago(t):
+        return "never" if t is None else "{:.1f} s ago".format(now - t)
+
+    print("Heartbeat {}, last packet {}, last write {}, queue depth {}."
+          .format(ago(heartbeat['time']), ago(heartbeat['last_packet_time']),
+                  ago(heartbeat['last_write_time']), heartbeat['queue_depth']))
+    for port, counters in sorted(heartbeat['base_units'].iteritems()):
+        print("  {}: {} packets, {} unknown, {} restarts, loop {}"
+              .format(port, counters['packets'], counters['unknown_tx'],
+                      counters['restarts'], ago(counters['last_loop_time'])))
+
+    reason = stall_reason(heartbeat, logger_pid, state['logger_start_time'],
+                          now, 1, stall_timeout, float('inf'))
+    if reason:
+        print("STALLED: {}".format(reason))
+        return 1
+    return 0
+
+
+def start(args):
+    """Launch a background monitor.  Returns an exit code."""
+    state_filename = os.path.join(args.run_directory, STATE_FILENAME)
+    state = read_json(state_filename) or {}
+    if pid_is_running(state.get('supervisor_pid')):
+        print("Already running (supervisor pid {}).".format(state['supervisor_pid']))
+        return 0
+
+    # Don't mistake a state file from a previous run for the new monitor's
+    if os.path.exists(state_filename):
+        os.remove(state_filename)
+    command = [sys.executable, os.path.realpath(__file__), 'run',
+               '--run-directory', args.run_directory,
+               '--heartbeat-interval', str(args.heartbeat_interval),
+               '--stall-timeout', str(args.stall_timeout),
+               '--startup-timeout', str(args.startup_timeout),
+               '--'] + args.logger_args
+    with open(os.path.join(args.run_directory, SUPERVISOR_OUTPUT_FILENAME), 'a') as output:
+        monitor = subprocess.Popen(command, stdout=output,
+                                   stderr=subprocess.STDOUT, close_fds=True,
+                                   preexec_fn=os.setsid)
+
+    # Wait for the monitor to launch the logger
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        state = read_json(state_filename) or {}
+        if pid_is_running(state.get('logger_pid')):
+            print("Started logger (pid {}) under supervisor (pid {})."
+                  .format(state['logger_pid'], monitor.pid))
+            return 0
+        if monitor.poll() is not None:
+            break
+        time.sleep(0.1)
+    print("ERROR: failed to start. See {}"
+          .format(os.path.join(args.run_directory, SUPERVISOR_OUTPUT_FILENAME)),
+          file=sys.stderr)
+    return 1
+
+
+def stop(args):
+    """Stop the monitor, which stops the logger.  Returns an exit code."""
+    state = read_json(os.path.join(args.run_directory, STATE_FILENAME)) or {}
+    pid = state.get('supervisor_pid')
+    if not pid_is_running(pid):
+        print("Supervisor is not running so no need to stop it.")
+        return 0
+    print("Stopping supervisor (pid {})...".format(pid))
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + Supervisor.STOP_TIMEOUT + 5
+    while pid_is_running(pid) and time.time() < deadline:
+        time.sleep(0.1)
+    if pid_is_running(pid):
+        print("ERROR: supervisor didn't stop. Killing it and the logger.",
+              file=sys.stderr)
+        os.kill(pid, signal.SIGKILL)
+        if pid_is_running(state.get('logger_pid')):
+            os.kill(state['logger_pid'], signal.SIGKILL)
+        return 1
+    print("Stopped.")
+    return 0
+
+
+def reload(args):
+    """Ask the logger to reload its configuration.  Returns an exit code."""
+    state = read_json(os.path.join(args.run_directory, STATE_FILENAME)) or {}
+    pid = state.get('logger_pid')
+    if not pid_is_running(pid):
+        print("ERROR: logger is not running.", file=sys.stderr)
+        return 1
+    os.kill(pid, signal.SIGHUP)
+    print("Sent SIGHUP to logger (pid {}).".format(pid))
+    return 0
+
+
+def run(args):
+    """Monitor in the foreground until SIGINT or SIGTERM."""
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    supervisor = Supervisor([sys.executable, LOGGER_SCRIPT] + args.logger_args,
+                            args.run_directory, args.heartbeat_interval,
+                            args.stall_timeout, args.startup_timeout)
+
+    def signal_handler(signal_number, frame):
+        log.info("Signal {} received.".format(signal_number))
+        supervisor.abort = True
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    supervisor.run()
+    return 0
+
+
+def setup_argparser():
+    parser = argparse.ArgumentParser(description="Start, stop and monitor"
+                                     " rfm_ecomanager_logger.  Arguments after"
+                                     " '--' are passed to the logger.")
+    parser.add_argument('command', choices=['start', 'stop', 'status', 'reload', 'run'])
+    parser.add_argument('--run-directory', dest='run_directory', type=str,
+                        default=RUN_DIRECTORY,
+                        help='directory for the state, heartbeat and output'
+                        ' files (default: {})'.format(RUN_DIRECTORY))
+    parser.add_argument('--heartbeat-interval', dest='heartbeat_interval',
+                        type=float, default=1,
+                        help='seconds between heartbeats (default: 1)')
+    parser.add_argument('--stall-timeout', dest='stall_timeout', type=float,
+                        default=30,
+                        help='restart the logger if a read loop is stuck for'
+                        ' this many seconds (default: 30)')
+    parser.add_argument('--startup-timeout', dest='startup_timeout', type=float,
+                        default=60,
+                        help='seconds the logger has to initialise its Nanodes'
+                        ' (default: 60)')
+    argv = sys.argv[1:]
+    logger_args = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, logger_args = argv[:i], argv[i+1:]
+    args = parser.parse_args(argv)
+    args.run_directory = os.path.realpath(args.run_directory)
+    args.logger_args = logger_args
+    return args
+
+
+def main():
+    args = setup_argparser()
+    if args.command == 'start':
+        return start(args)
+    elif args.command == 'stop':
+        return stop(args)
+    elif args.command == 'status':
+        return status(args.run_directory, args.stall_timeout)
+    elif args.command == 'reload':
+        return reload(args)
+    else:
+        return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Restores TRXs (IAMs) to their recorded state after a power cut.
+
+Every IAM boots in its off state, so when mains power returns all of them
+need switching back on at once.  Cc_trx.new_reading() asks the
+SwitchBackScheduler for a restoration instead of switching immediately.
+Each base unit's read loop calls service() between packets, which sends
+at most BATCH_SIZE switch commands every BATCH_INTERVAL seconds:
+
+  - repeated requests for the same TRX are merged
+  - TRXs which have had fewer attempts go first, then the longest waiting
+  - a restoration is confirmed by a later packet reporting the new state;
+    if none arrives within CONFIRM_TIMEOUT the switch is retried, backing
+    off exponentially, and abandoned after MAX_ATTEMPTS
+
+When the last pending restoration is confirmed or abandoned the scheduler
+logs how long the fleet took to converge.
+"""
+
+from __future__ import print_function
+import threading
+import time
+import logging
+log = logging.getLogger("rfm_ecomanager_logger")
+from nanode import NanodeError
+
+
+class Restoration(object):
+    """A pending switch of one TRX."""
+
+    def __init__(self, tx, state, now):
+        self.tx = tx
+        self.state = state
+        self.requested = now
+        self.attempts = 0
+        self.next_attempt = now
+
+
+class SwitchBackScheduler(object):
+
+    BATCH_SIZE = 4 # switch commands per batch
+    BATCH_INTERVAL = 1 # seconds between batches on each base unit
+    CONFIRM_TIMEOUT = 15 # seconds. IAMs transmit about every 6 seconds.
+    MAX_RETRY_INTERVAL = 120 # seconds
+    MAX_ATTEMPTS = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {} # tx.id: Restoration
+        self._last_batch = {} # port: time of last batch
+        self._wave = None # stats for the current set of restorations
+        self.last_convergence = None
+
+    def request(self, tx, state, now=None):
+        """Ask for tx to be switched to state."""
+        now = time.time() if now is None else now
+        with self._lock:
+            restoration = self._pending.get(tx.id)
+            if restoration is None:
+                log.info("Scheduling {} to be switched to {}"
+                         .format(tx.get_name(), state))
+                if self._wave is None:
+                    self._wave = {'start': now, 'restored': 0,
+                                  'abandoned': 0, 'switches': 0}
+                self._pending[tx.id] = Restoration(tx, state, now)
+            elif restoration.state != state:
+                restoration.state = state
+                restoration.next_attempt = now
+
+    def pending_state(self, tx):
+        """Returns the state tx is being restored to, or None."""
+        restoration = self._pending.get(tx.id)
+        return None if restoration is None else restoration.state
+
+    def confirm(self, tx, now=None):
+        """tx has reported the state it was being restored to."""
+        with self._lock:
+            restoration = self._pending.pop(tx.id, None)
+            if restoration is None:
+                return
+            log.info("{} restored to {} after {:.1f} s and {} attempts"
+                     .format(tx.get_name(), restoration.state,
+                             (time.time() if now is None else now) -
+                             restoration.requested, restoration.attempts))
+            self._wave['restored'] += 1
+            self._check_converged(now)
+
+    def cancel(self, tx, now=None):
+        """Forget about tx, e.g. because its button has been pressed."""
+        with self._lock:
+            if self._pending.pop(tx.id, None) is not None:
+                self._check_converged(now)
+
+    def pending(self):
+        return len(self._pending)
+
+    def service(self, nanode, now=None):
+        """Send the next batch of switch commands for nanode's base unit.
+        Called from that base unit's thread."""
+        now = time.time() if now is None else now
+        if now - self._last_batch.get(nanode.port, 0) < self.BATCH_INTERVAL:
+            return
+        with self._lock:
+            due = []
+            for tx_id, restoration in self._pending.items():
+                if (restoration.tx.base_unit != nanode.port or
+                    restoration.next_attempt > now):
+                    continue
+                if restoration.attempts >= self.MAX_ATTEMPTS:
+                    log.error("Giving up switching {} to {} after {} attempts"
+                              .format(restoration.tx.get_name(),
+                                      restoration.state, restoration.attempts))
+                    del self._pending[tx_id]
+                    self._wave['abandoned'] += 1
+                    continue
+                due.append(restoration)
+            due.sort(key=lambda r: (r.attempts, r.requested))
+            batch = due[:self.BATCH_SIZE]
+            for restoration in batch:
+                restoration.attempts += 1
+                restoration.next_attempt = now + min(
+                    self.CONFIRM_TIMEOUT * 2 ** (restoration.attempts - 1),
+                    self.MAX_RETRY_INTERVAL)
+            if self._wave is not None:
+                self._wave['switches'] += len(batch)
+            self._check_converged(now)
+        if not batch:
+            return
+
+        # Send outside the lock: other base units' threads may be confirming
+        self._last_batch[nanode.port] = now
+        for restoration in batch:
+            try:
+                restoration.tx.switch(restoration.state)
+            except NanodeError as e:
+                log.warn("Failed to switch {}: {}"
+                         .format(restoration.tx.get_name(), e))
+
+    def status(self):
+        return {'pending': self.pending(),
+                'last_convergence': self.last_convergence}
+
+    def _check_converged(self, now=None):
+        """Call with the lock held."""
+        if self._pending or self._wave is None:
+            return
+        now = time.time() if now is None else now
+        wave = self._wave
+        self._wave = None
+        wave['seconds'] = now - wave['start']
+        self.last_convergence = wave
+        log.info("TRX switch-back converged in {:.1f} s: {} restored, {} "
+                 "abandoned, {} switch commands"
+                 .format(wave['seconds'], wave['restored'], wave['abandoned'],
+                         wave['switches']))
@@ -22,6 +22,13 @@ class Transmitter(object):
     def __init__(self, rf_id, manager):
         self.id = rf_id
         self.manager = manager
+        self.base_unit = None # port of the Nanode which receives this TX
+
+    @property
+    def nanode(self):
+        """The Nanode for this transmitter's base unit, or None if that
+        base unit isn't open."""
+        return self.manager.nanodes.get(self.base_unit)
     
     @abc.abstractmethod
     def update_name(self, sensors=None):
@@ -29,11 +36,11 @@ class Transmitter(object):
 
     def accept_pair_request(self):
         print("Pairing with", self.id)
-        self.manager.nanode.send_command("p", self.id)
+        self.nanode.send_command("p", self.id)
         success = False
         DEADLINE = time.time() + 5
         while time.time() < DEADLINE and not success:
-            data = self.manager.nanode.read_sensor_data()
+            data = self.nanode.read_sensor_data()
             if data.tx_id == self.id:
                 if data.pair_ack:
                     print("Successfully paired with", self.id)
@@ -54,22 +61,46 @@ class Transmitter(object):
     
     def unpickle(self, manager):
         self.manager = manager
+        self.base_unit = self.__dict__.get('base_unit')
         for _, sensor in self.sensors.iteritems():
             sensor.update_filename(self)
             sensor.last_logged_timecode = 0
         
+    def update_sensors(self, sensors):
+        """Adopt sensor configuration reloaded from the pickle file.
+        Sensors whose log_chan is unchanged keep their runtime state.
+
+        Returns:
+            list of Sensors which have been replaced
+        """
+        updated = {}
+        for s_id, sensor in sensors.iteritems():
+            old_sensor = self.sensors.get(s_id)
+            if old_sensor is not None and old_sensor.log_chan == sensor.log_chan:
+                old_sensor.name = sensor.name
+                old_sensor.agg_chan = sensor.agg_chan
+                sensor = old_sensor
+            updated[s_id] = sensor
+        retired = [sensor for s_id, sensor in self.sensors.iteritems()
+                   if updated.get(s_id) is not sensor]
+        self.sensors = updated
+        return retired
+
     def add_to_nanode(self):
-        self.manager.nanode.send_command(self.ADD_COMMAND, self.id)
+        self.nanode.send_command(self.ADD_COMMAND, self.id)
         
     def delete_from_nanode(self):
-        self.manager.nanode.send_command(self.DEL_COMMAND, self.id)
+        self.nanode.send_command(self.DEL_COMMAND, self.id)
 
     def new_reading(self, data):
+        link_stats = self.manager.link_stats
+        link_stats.packet(self, data.timecode)
         for s_id, watts in data.sensors.iteritems():
             s_id = int(s_id)
             if s_id in self.sensors.keys():
-                self.sensors[s_id].log_data_to_disk(data.timecode, watts,
-                                                    self.get_power_state())
+                reason = self.sensors[s_id].log_data_to_disk(
+                    data.timecode, watts, self.get_power_state())
+                link_stats.reading(self, s_id, reason)
             else:
                 log.error("Transmitter {:d} reports a sensor is connected to "
                       "port {:d} but we don't have any info for that sensor id."
@@ -162,9 +193,23 @@ class Cc_trx(Transmitter):
             log.info("IAM " + self.get_name() + 
                      " state has changed to " + str(self.state))     
         
+        switch_back = self.manager.switch_back
+        restoring = (None if data.state is None
+                     else switch_back.pending_state(self))
+
         # Check if IAM has just changed state.  Either accept that state change
         # or reject it and switch the IAM to the previous state.
-        if data.state is not None:
+        if restoring is not None:
+            # We've scheduled this IAM to be switched back to its previous
+            # state.  Until it reports that state, an off packet is the IAM
+            # still waiting for the switch, not a button press (unless the
+            # IAM tells us it definitely was a button press).
+            if data.state == restoring:
+                switch_back.confirm(self)
+            elif data.reply_to_poll is not None and data.reply_to_poll == 0:
+                switch_back.cancel(self)
+                accept_state_change_and_log()
+        elif data.state is not None:
             if data.state != self.state:
                 if data.state == 1:
                     # IAM has just turned on. This can ONLY happen if the IAM's
@@ -205,8 +250,9 @@ class Cc_trx(Transmitter):
                         # We haven't heard from the IAM for at least
                         # SECONDS_OFF so let's assume it was unplugged and
                         # plugged in again, in which case we must switch it
-                        # to its previous state.
-                        self.switch(self.state)
+                        # to its previous state.  After a power cut every
+                        # IAM does this at once so leave it to the scheduler.
+                        switch_back.request(self, self.state)
 
         super(Cc_trx, self).new_reading(data)
         self.time_of_last_packet = data.timecode
@@ -230,7 +276,9 @@ class Cc_trx(Transmitter):
             state (boolean)
         """
         log.info("Switching {:s} to {:d}".format(self.get_name(), state))
-        self.manager.nanode.send_command("{:d}".format(state), self.id)
+        # Don't throw away readings waiting in the Nanode's buffer: this is
+        # called from the reading loop (e.g. by the switch-back scheduler)
+        self.nanode.send_command("{:d}".format(state), self.id, flush=False)
 
 class Cc_tx(Transmitter):
     
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Benchmark the CPU cost of reading the Nanode's output.
+
+    bench_reader.py [--packets N] [--baud BAUD] [PATH ...]
+
+A child process writes N JSON packet lines into a pseudo-terminal at the
+serial port's baud rate (or as fast as possible with --baud 0) and the
+parent reads them through pyserial with each PATH:
+
+    readline   serial.Serial.readline(), which calls read() once per byte
+               (how Nanode read lines before SerialReader)
+    bulk       nanode.SerialReader, which reads everything waiting at once
+
+For each path it prints the CPU time (user + system) used by the reader,
+the CPU time per 1000 packets and the reader's CPU load while keeping up
+with the line.  Linux and other POSIX systems only.
+"""
+
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import sys
+import inspect
+import time
+import tty
+import serial
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+from nanode import SerialReader
+
+PACKETS = 2000
+BAUD = 115200
+BITS_PER_BYTE = 10 # 8N1: start bit, 8 data bits, stop bit
+PATHS = ['readline', 'bulk']
+
+
+class Result(object):
+    def __init__(self, path, packets, cpu, wall):
+        self.path = path
+        self.packets = packets
+        self.cpu = cpu # seconds
+        self.wall = wall # seconds
+
+    def __str__(self):
+        return ("{:9s} {:d} packets: cpu={:.3f}s ({:.1f} ms per 1000 packets)"
+                " wall={:.2f}s load={:.1f}%"
+                .format(self.path, self.packets, self.cpu,
+                        self.cpu * 1000000 / self.packets, self.wall,
+                        100 * self.cpu / self.wall))
+
+
+def packet_line(i):
+    record = {"t": 2000 + i * 6, "id": 1000 + i % 20, "type": "tx",
+              "sensors": {"1": i % 3000}}
+    return (json.dumps(record, separators=(",", ":")) + "\r\n").encode('ascii')
+
+
+def _write_packets(fd, packets, baud):
+    start = time.time()
+    sent = 0
+    for i in range(packets):
+        line = packet_line(i)
+        os.write(fd, line)
+        sent += len(line)
+        if baud:
+            delay = start + sent * BITS_PER_BYTE / baud - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run(path, packets=PACKETS, baud=BAUD):
+    """Returns a Result."""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = serial.Serial(port=os.ttyname(slave), baudrate=115200, timeout=1)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _write_packets(master, packets, baud)
+            time.sleep(0.5) # don't close the pty before the reader finishes
+        finally:
+            os._exit(0)
+    os.close(master)
+    try:
+        read = (port.readline if path == 'readline' else
+                SerialReader(port).read)
+        received = 0
+        cpu, wall = _cpu_time(), time.time()
+        while received < packets:
+            line = read()
+            if not line:
+                break # timed out
+            if line.strip():
+                received += 1
+        cpu, wall = _cpu_time() - cpu, time.time() - wall
+    finally:
+        port.close()
+        os.close(slave)
+        os.waitpid(pid, 0)
+    if received < packets:
+        raise RuntimeError("{} only received {} of {} packets"
+                           .format(path, received, packets))
+    return Result(path, packets, cpu, wall)
+
+
+def setup_argparser():
+    parser = argparse.ArgumentParser(description="Compare the CPU cost of "
+                                     "reading Nanode output per line and "
+                                     "in bulk.")
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='one or more of {} (default: all)'
+                        .format(", ".join(PATHS)))
+    parser.add_argument('--packets', type=int, default=PACKETS,
+                        help='number of packets (default: {})'.format(PACKETS))
+    parser.add_argument('--baud', type=int, default=BAUD,
+                        help='line speed, or 0 for as fast as possible '
+                        '(default: {})'.format(BAUD))
+    args = parser.parse_args()
+    unknown = set(args.paths) - set(PATHS)
+    if unknown:
+        parser.error("unknown path(s): {}".format(", ".join(sorted(unknown))))
+    return args
+
+
+def main():
+    args = setup_argparser()
+    for path in args.paths or PATHS:
+        print(run(path, args.packets, args.baud))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
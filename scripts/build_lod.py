@@ -0,0 +1,57 @@
+#!/usr/bin/python
+"""
+Build or extend the LOD files (see rfm_ecomanager_logger/lod.py) for every
+channel in a tree of data directories:
+
+    build_lod.py BASE_DATA_DIR [--rebuild]
+
+Only the samples logged since the last run are read, so this is cheap
+enough to run from cron on a live data directory.  merge_datasets.py
+builds the LOD files for its output directory itself.
+"""
+
+from __future__ import print_function, division
+import argparse, os, sys, inspect, glob
+import logging
+log = logging.getLogger("build_lod")
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import reader, lod
+from merge_datasets import get_all_data_dirs
+
+
+def setup_argparser():
+    parser = argparse.ArgumentParser(description=
+        "Build or extend the level-of-detail files used to plot long time"
+        " ranges for every channel in every data directory under"
+        " <BASE_DATA_DIR>.")
+    parser.add_argument('base_data_dir')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='delete and rebuild the LOD files, e.g. after'
+                        ' editing channel_N.dat files')
+    args = parser.parse_args()
+    args.base_data_dir = os.path.expanduser(args.base_data_dir)
+    return args
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = setup_argparser()
+    for data_dir_name in get_all_data_dirs(args.base_data_dir):
+        data_dir = reader.DataDirectory(data_dir_name)
+        if args.rebuild:
+            for filename in glob.glob(os.path.join(data_dir.data_dir,
+                                                   'channel_*.lod')):
+                os.remove(filename)
+        log.info("Updating LOD files in " + data_dir.data_dir)
+        lod.update_data_dir(data_dir)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,441 @@
+#!/usr/bin/python
+"""
+Check (and optionally repair) every channel_N.dat file in a tree of data
+directories:
+
+    check_data.py BASE_DATA_DIR [--repair] [--processes N]
+
+Each file is checked by one worker process, which maps the file into
+memory and checks it a block at a time with NumPy.  Each defect is
+reported with the byte offset of the line:
+
+    truncated       the final line has no newline (e.g. after a power cut)
+    unparsable      not "<timestamp> <watts>[ <state>]"
+    bad_timestamp   before 2010 or in the future
+    out_of_range    negative watts, watts above the threshold used by
+                    merge_datasets.py, or a state other than 0 or 1
+    spike           a short run of lines (up to MAX_SPIKE_LINES) ahead of
+                    the lines which follow them (e.g. a time-correction
+                    glitch)
+    duplicate       the same timestamp as the previous good line
+    backwards       earlier than the previous good line (e.g. a restart
+                    which logged the same period twice)
+
+With --repair, files with defects are rewritten without the defective
+lines.  The fixed file is streamed to a temporary file in the same
+directory, fsynced and then renamed over the original, so a crash part way
+through leaves the original untouched.  Files in a data directory which a
+running logger is writing to are not repaired (see
+sinks.lock_data_directory()).
+
+The exit status is 1 if any defects were found, for running from cron.
+"""
+
+from __future__ import print_function, division
+import argparse, os, sys, inspect, mmap, time, warnings, multiprocessing
+import logging
+import numpy as np
+log = logging.getLogger("check_data")
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import reader
+from sinks import lock_data_directory
+from merge_datasets import (AGGREGATE_LABELS, THRESHOLD_FOR_IAMS,
+                            THRESHOLD_FOR_AGGREGATE, get_channel_from_filename)
+
+BLOCK_SIZE = 2**22 # bytes checked at a time
+MIN_TIMESTAMP = 1262304000 # 2010-01-01
+MAX_FUTURE = 60*60*24 # seconds
+MAX_OFFSETS = 20 # byte offsets reported for each kind of defect in a file
+MAX_SPIKE_LINES = 16 # longest run of lines which is treated as a spike
+DEFECTS = ['truncated', 'unparsable', 'bad_timestamp', 'out_of_range',
+           'spike', 'duplicate', 'backwards']
+NEWLINE = ord('\n')
+SPACE = ord(' ')
+
+
+def setup_argparser():
+    parser = argparse.ArgumentParser(description=
+        "Check every channel_N.dat file under <BASE_DATA_DIR> for truncated"
+        " lines, unparsable lines, bad timestamps, out-of-range values and"
+        " timestamps which are duplicated or out of order.")
+    parser.add_argument('base_data_dir')
+    parser.add_argument('--repair', action='store_true',
+                        help='rewrite files without their defective lines')
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes (default: the'
+                        ' number of CPUs)')
+    parser.add_argument('--max-offsets', type=int, default=MAX_OFFSETS,
+                        help='byte offsets to report for each kind of defect'
+                        ' in each file (default: {})'.format(MAX_OFFSETS))
+    args = parser.parse_args()
+    args.base_data_dir = os.path.expanduser(args.base_data_dir)
+    return args
+
+
+class Report(object):
+    """The defects found in one file.
+
+    Attributes:
+      - filename (str)
+      - n_lines (int)
+      - counts (dict): maps each kind of defect in DEFECTS to a count
+      - offsets (dict): maps each kind of defect to a list of the byte
+        offsets of the first max_offsets lines with that defect
+      - n_bytes_removed (int): if repaired
+      - not_repaired (str): why the file wasn't repaired, if it wasn't
+    """
+
+    def __init__(self, filename, max_offsets=MAX_OFFSETS):
+        self.filename = filename
+        self.max_offsets = max_offsets
+        self.n_lines = 0
+        self.counts = dict.fromkeys(DEFECTS, 0)
+        self.offsets = dict((defect, []) for defect in DEFECTS)
+        self.n_bytes_removed = 0
+        self.not_repaired = None
+        self.error = None
+
+    def add(self, defect, offsets):
+        self.counts[defect] += len(offsets)
+        room = self.max_offsets - len(self.offsets[defect])
+        if room > 0:
+            self.offsets[defect].extend(int(offset) for offset in offsets[:room])
+
+    def n_defects(self):
+        return sum(self.counts.values())
+
+    def __str__(self):
+        if self.error:
+            return "{}: failed: {}".format(self.filename, self.error)
+        if not self.n_defects():
+            return "{}: OK ({} lines)".format(self.filename, self.n_lines)
+        s = "{}: {} defects in {} lines".format(self.filename,
+                                                self.n_defects(), self.n_lines)
+        for defect in DEFECTS:
+            if self.counts[defect]:
+                more = self.counts[defect] > len(self.offsets[defect])
+                s += "\n  {:>13s} {:8d}  at {}{}".format(
+                    defect, self.counts[defect],
+                    " ".join(str(offset) for offset in self.offsets[defect]),
+                    " ..." if more else "")
+        if self.n_bytes_removed:
+            s += "\n  repaired: removed {} bytes".format(self.n_bytes_removed)
+        if self.not_repaired:
+            s += "\n  not repaired: " + self.not_repaired
+        return s
+
+
+def get_threshold(data_filename):
+    """Returns the largest sensible watts for data_filename, based on the
+    label given to its channel in labels.dat."""
+    labels_filename = os.path.join(os.path.dirname(data_filename), 'labels.dat')
+    try:
+        chan = get_channel_from_filename(os.path.basename(data_filename))
+        synonyms = reader.load_labels_file(labels_filename).get(chan, [])
+    except (IOError, ValueError):
+        synonyms = []
+    if any(synonym in AGGREGATE_LABELS for synonym in synonyms):
+        return THRESHOLD_FOR_AGGREGATE
+    return THRESHOLD_FOR_IAMS
+
+
+def _parse_block(block, starts, ends):
+    """Parse complete lines.
+
+    Returns:
+        timestamps, watts, states (np.ndarrays; states is -1 where there's
+        no state) and parsed, a boolean np.ndarray
+    """
+    n_lines = len(starts)
+    buf = np.frombuffer(block, dtype=np.uint8)
+    spaces = np.concatenate([[0], np.cumsum(buf == SPACE)])
+    n_fields = spaces[ends] - spaces[starts] + 1
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # NumPy warns about garbage
+        values = np.fromstring(block, sep=' ')
+    if (len(values) == n_fields.sum() and
+        np.all((n_fields == 2) | (n_fields == 3))):
+        # Fast path: every line is two or three numbers
+        first = np.cumsum(n_fields) - n_fields
+        has_state = n_fields == 3
+        states = np.full(n_lines, reader.NO_STATE, dtype=np.float64)
+        states[has_state] = values[first[has_state] + 2]
+        return (values[first], values[first + 1], states,
+                np.ones(n_lines, dtype=bool))
+
+    timestamps = np.zeros(n_lines)
+    watts = np.zeros(n_lines)
+    states = np.full(n_lines, reader.NO_STATE, dtype=np.float64)
+    parsed = np.zeros(n_lines, dtype=bool)
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        fields = block[start:end].split(' ')
+        if len(fields) not in (2, 3):
+            continue
+        try:
+            numbers = [float(field) for field in fields]
+        except ValueError:
+            continue
+        timestamps[i], watts[i] = numbers[:2]
+        if len(numbers) == 3:
+            states[i] = numbers[2]
+        parsed[i] = True
+    return timestamps, watts, states, parsed
+
+
+class _Checker(object):
+    """Checks one file block by block, carrying state between blocks."""
+
+    def __init__(self, report, threshold, max_timestamp):
+        self.report = report
+        self.threshold = threshold
+        self.max_timestamp = max_timestamp
+        self.last_good = -np.inf # timestamp of the last good line
+        self.history = np.zeros(0) # timestamps of the last valid lines
+
+    def check(self, block, offset, final=True):
+        """Check the complete lines in block, which starts at byte offset.
+        Unless final, the last MAX_SPIKE_LINES lines are only used to look
+        ahead (they start the next block).
+
+        Returns:
+            boolean np.ndarray, True for each good line, and the start and
+            end (excluding the newline) of each line checked
+        """
+        buf = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(buf == NEWLINE)
+        starts = np.concatenate([[0], ends[:-1] + 1])
+        timestamps, watts, states, parsed = _parse_block(block, starts, ends)
+
+        # Negated comparisons so that NaNs fail
+        with np.errstate(invalid='ignore'):
+            bad_timestamp = parsed & ~((timestamps >= MIN_TIMESTAMP) &
+                                       (timestamps <= self.max_timestamp))
+            out_of_range = (parsed & ~bad_timestamp &
+                            ~((watts >= 0) & (watts <= self.threshold) &
+                              ((states == reader.NO_STATE) | (states == 0) |
+                               (states == 1))))
+        valid = parsed & ~bad_timestamp & ~out_of_range
+
+        i = np.flatnonzero(valid)
+        spike = np.zeros(len(starts), dtype=bool)
+        spike[i] = self._find_spikes(timestamps[i])
+
+        n = len(starts) if final else len(starts) - MAX_SPIKE_LINES
+        starts, ends, timestamps = starts[:n], ends[:n], timestamps[:n]
+        parsed, bad_timestamp = parsed[:n], bad_timestamp[:n]
+        out_of_range, valid, spike = out_of_range[:n], valid[:n], spike[:n]
+        self.report.n_lines += n
+
+        # Compare each remaining line with the latest good line before it
+        candidates = valid & ~spike
+        latest = np.where(candidates, timestamps, -np.inf)
+        latest = np.maximum.accumulate(np.concatenate([[self.last_good], latest]))
+        previous = latest[:-1]
+        duplicate = candidates & (timestamps == previous)
+        backwards = candidates & (timestamps < previous)
+        self.last_good = latest[-1]
+        self.history = np.concatenate(
+            [self.history, timestamps[valid]])[-(MAX_SPIKE_LINES + 1):]
+
+        offsets = starts + offset
+        for defect, mask in [('unparsable', ~parsed),
+                             ('bad_timestamp', bad_timestamp),
+                             ('out_of_range', out_of_range),
+                             ('spike', spike), ('duplicate', duplicate),
+                             ('backwards', backwards)]:
+            if mask.any():
+                self.report.add(defect, offsets[mask])
+        return candidates & ~duplicate & ~backwards, starts, ends
+
+    def _find_spikes(self, t):
+        """A spike is a run of up to MAX_SPIKE_LINES valid lines which are
+        all ahead of the valid line after the run, while the valid line
+        before the run isn't.  A longer run, or one with nothing before it
+        to compare with, is left for the backwards check (e.g. a restart
+        which logged the same period twice).  The last valid lines of the
+        file can't be a spike.
+
+        Args:
+            t (np.ndarray): timestamps of the valid lines
+        Returns:
+            boolean np.ndarray, True for each spike
+        """
+        n_history = len(self.history)
+        t = np.concatenate([self.history, t])
+        # For each line, how many lines back is the latest line which
+        # isn't ahead of it?
+        lines_back = np.zeros(len(t), dtype=np.int64)
+        for distance in range(1, MAX_SPIKE_LINES + 2):
+            current = t[distance:]
+            found = ((lines_back[distance:] == 0) &
+                     (t[:-distance] <= current))
+            lines_back[distance:][found] = distance
+        # The lines in between are a spike
+        ends = np.flatnonzero(lines_back > 1)
+        depth = np.zeros(len(t) + 1, dtype=np.int64)
+        np.add.at(depth, ends - lines_back[ends] + 1, 1)
+        np.add.at(depth, ends, -1)
+        return np.cumsum(depth)[n_history:-1] > 0
+
+
+def _blocks(data, block_size):
+    """Yield (offset, block, final) for blocks of complete lines of data.
+    Blocks overlap by MAX_SPIKE_LINES lines: the last lines of each block
+    (except the final one) are only there to look ahead and start the next
+    block."""
+    position = 0
+    size = len(data)
+    while position < size:
+        end = min(position + block_size, size)
+        block = data[position:end]
+        if end == size:
+            block = block[:block.rfind('\n') + 1]
+            if block:
+                yield position, block, True
+            return
+        last_newline = block.rfind('\n')
+        lookahead = last_newline
+        for dummy in range(MAX_SPIKE_LINES):
+            lookahead = block.rfind('\n', 0, lookahead)
+            if lookahead < 0:
+                break
+        if lookahead < 0:
+            block_size *= 2 # too few lines to look ahead: read more
+            continue
+        yield position, block[:last_newline + 1], False
+        position += lookahead + 1
+
+
+def check_file(filename, repair=False, block_size=BLOCK_SIZE,
+               max_offsets=MAX_OFFSETS, now=None):
+    """Check filename and, if repair, rewrite it without its defective
+    lines if it has any.
+
+    Returns:
+        Report
+    """
+    report = Report(filename, max_offsets)
+    size = os.path.getsize(filename)
+    if size == 0:
+        return report
+    now = time.time() if now is None else now
+    checker = _Checker(report, get_threshold(filename), now + MAX_FUTURE)
+    data_lock = None
+    if repair:
+        # Hold the lock from before the file is read until it's replaced
+        data_lock = lock_data_directory(os.path.dirname(filename),
+                                        exclusive=True, blocking=False)
+    try:
+        with open(filename, 'rb') as data_file:
+            data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                complete_size = data.rfind('\n') + 1
+                if complete_size < len(data):
+                    report.add('truncated', [complete_size])
+                for offset, block, final in _blocks(data, block_size):
+                    checker.check(block, offset, final)
+                if repair and report.n_defects():
+                    if data_lock is None:
+                        report.not_repaired = "a logger is writing to it"
+                    else:
+                        _repair(filename, data, report, checker.threshold,
+                                checker.max_timestamp, block_size)
+            finally:
+                data.close()
+    finally:
+        if data_lock is not None:
+            data_lock.close()
+    return report
+
+
+def _repair(filename, data, report, threshold, max_timestamp, block_size):
+    """Stream the good lines of data to a temporary file, then rename it
+    over filename."""
+    checker = _Checker(Report(filename), threshold, max_timestamp)
+    tmp_filename = filename + '.repair'
+    n_bytes = 0
+    with open(tmp_filename, 'wb') as output:
+        for offset, block, final in _blocks(data, block_size):
+            good, starts, ends = checker.check(block, offset, final)
+            if not len(good):
+                continue
+            # Write each run of good lines in one go
+            edges = np.flatnonzero(np.diff(np.concatenate([[0], good, [0]])))
+            for first, last in zip(edges[::2].tolist(), edges[1::2].tolist()):
+                run = block[starts[first]:ends[last - 1] + 1]
+                output.write(run)
+                n_bytes += len(run)
+        output.flush()
+        os.fsync(output.fileno())
+    os.rename(tmp_filename, filename)
+    report.n_bytes_removed = len(data) - n_bytes
+
+
+def find_data_files(base_data_dir):
+    """Returns a sorted list of every channel_N.dat file under base_data_dir."""
+    filenames = []
+    for directory, dummy, files in os.walk(base_data_dir):
+        filenames.extend(os.path.join(directory, f) for f in files
+                         if f.startswith('channel_') and f.endswith('.dat'))
+    return sorted(filenames)
+
+
+def _check_file_star(args):
+    """For multiprocessing.Pool, which can only pass one argument."""
+    filename = args[0]
+    try:
+        return check_file(*args)
+    except Exception as e:
+        report = Report(filename)
+        report.error = "{}: {}".format(type(e).__name__, e)
+        return report
+
+
+def check_files(filenames, repair=False, processes=None,
+                max_offsets=MAX_OFFSETS):
+    """Check filenames in parallel, one file per worker process.
+
+    Returns:
+        list of Reports, in the order they finished
+    """
+    tasks = [(filename, repair, BLOCK_SIZE, max_offsets)
+             for filename in filenames]
+    if len(tasks) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            return list(pool.imap_unordered(_check_file_star, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    return [_check_file_star(task) for task in tasks]
+
+
+def main():
+    args = setup_argparser()
+    logging.basicConfig(level=logging.INFO)
+    start = time.time()
+    filenames = find_data_files(args.base_data_dir)
+    n_bytes = sum(os.path.getsize(filename) for filename in filenames)
+    n_defective = 0
+    for report in check_files(filenames, args.repair, args.processes,
+                              args.max_offsets):
+        if report.n_defects() or report.error:
+            n_defective += 1
+            print(report)
+    duration = time.time() - start
+    print("Checked {} files ({:.1f} MB) in {:.1f} s: {} with defects{}"
+          .format(len(filenames), n_bytes / 1E6, duration, n_defective,
+                  " (repaired)" if args.repair and n_defective else ""))
+    return 1 if n_defective else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+from __future__ import print_function, division
+import argparse, os, sys, inspect
+import logging
+log = logging.getLogger("import_sqlite")
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import reader, sqlite_store
+from merge_datasets import get_all_data_dirs
+
+BATCH_SIZE = 100000 # rows per transaction
+
+def setup_argparser():
+    parser = argparse.ArgumentParser(description=
+        "Import rfm_ecomanager_logger data directories (or the output of"
+        " merge_datasets.py) into a SQLite database.  <BASE_DATA_DIR> is"
+        " searched recursively for directories containing a labels.dat file."
+        " Channels are matched across data directories by label, so the same"
+        " appliance always gets the same log_chan in the database.")
+
+    parser.add_argument('base_data_dir')
+    parser.add_argument('database')
+    parser.add_argument('--template-labels-filename', type=str,
+                        help='Optional labels.dat file, which may contain'
+                        ' synonyms separated by "/", used to number channels.')
+    args = parser.parse_args()
+    args.base_data_dir = os.path.expanduser(args.base_data_dir)
+    args.database = os.path.expanduser(args.database)
+    if args.template_labels_filename:
+        args.template_labels_filename = os.path.expanduser(args.template_labels_filename)
+    return args
+
+
+class ChannelMap(object):
+    """Maps labels (and their synonyms) to log_chans in the store."""
+
+    def __init__(self, store):
+        self.store = store
+        self.synonym_to_chan = dict(store.connection.execute(
+                                    "SELECT synonym, log_chan FROM label_synonyms"))
+
+    def add_labels(self, labels):
+        """
+        Args:
+            labels (dict): maps chan to list of synonyms, as returned by
+                reader.load_labels_file()
+        """
+        for chan, synonyms in sorted(labels.iteritems()):
+            self.get_log_chan(chan, synonyms)
+
+    def get_log_chan(self, chan, synonyms):
+        """Returns the log_chan in the store for a channel numbered chan
+        in its source directory, adding a new channel if necessary."""
+        for synonym in synonyms:
+            if synonym in self.synonym_to_chan:
+                log_chan = self.synonym_to_chan[synonym]
+                break
+        else:
+            used = set(self.synonym_to_chan.values())
+            log_chan = chan if chan not in used else max(used) + 1
+            log.info("Adding channel {} '{}'".format(log_chan, synonyms[0]))
+            self.store.set_label(log_chan, synonyms)
+
+        new_synonyms = [s for s in synonyms if s not in self.synonym_to_chan]
+        if new_synonyms:
+            with self.store.connection:
+                self.store.connection.executemany(
+                    "INSERT OR REPLACE INTO label_synonyms VALUES (?, ?)",
+                    [(synonym, log_chan) for synonym in new_synonyms])
+        for synonym in synonyms:
+            self.synonym_to_chan[synonym] = log_chan
+        return log_chan
+
+
+def import_data_dir(data_dir, store, channel_map):
+    data_directory = reader.DataDirectory(data_dir)
+    for chan in data_directory.channels():
+        log_chan = channel_map.get_log_chan(chan, data_directory.labels[chan])
+        channel = data_directory.load(chan)
+        log.info("Importing {} rows from {} as channel {}"
+                 .format(len(channel), data_directory.filename(chan), log_chan))
+        timestamps = channel.timestamps.astype(int).tolist()
+        watts = channel.watts.tolist()
+        states = channel.states.tolist()
+        for i in range(0, len(timestamps), BATCH_SIZE):
+            j = i + BATCH_SIZE
+            store.insert([(t, log_chan, w, None if s == reader.NO_STATE else s)
+                          for t, w, s in zip(timestamps[i:j], watts[i:j],
+                                             states[i:j])])
+        reader.clear_cache() # don't keep every channel in memory
+
+
+def main():
+    args = setup_argparser()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    store = sqlite_store.Store(args.database)
+    channel_map = ChannelMap(store)
+    if args.template_labels_filename:
+        channel_map.add_labels(reader.load_labels_file(args.template_labels_filename))
+
+    for data_dir in sorted(get_all_data_dirs(args.base_data_dir)):
+        import_data_dir(data_dir, store, channel_map)
+
+    log.info("Analysing database")
+    store.connection.execute("ANALYZE")
+    store.close()
+
+if __name__=="__main__":
+    main()
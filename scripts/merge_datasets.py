@@ -1,14 +1,33 @@
 #!/usr/bin/python
 from __future__ import print_function, division
-import argparse, os, sys, datetime, pytz, ConfigParser, shutil
+import argparse, os, sys, datetime, pytz, ConfigParser, shutil, inspect
 import logging.handlers
+import numpy as np
 log = logging.getLogger("merge_datasets")
 
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import reader
+import rollup
+import align
+import coverage_index
+import events
+import lod
+
 DATE_FMT = '%d/%m/%Y %H:%M:%S %Z'
 MIN_VOLTAGE = 200 # minimum acceptable voltage for mains voltage recorded using snd_card_power_meter
 AGGREGATE_LABELS = ['agg','aggregate','mains','whole-house', 'wholehouse', 'whole house']
 THRESHOLD_FOR_IAMS = 4090 # watts.  4096 (2^{12}) is a common anomalous number 
 THRESHOLD_FOR_AGGREGATE = 20000 # watts
+SCAN_BLOCK_SIZE = 2**22 # bytes read at a time by find_dirty_regions()
+COPY_CHUNK_SIZE = 2**20 # bytes copied at a time by copy_range()
+MIN_GAP_TO_REPORT = 10 # minutes
 
 def setup_argparser():
     # Process command line _args
@@ -51,6 +70,8 @@ Run merge_datasets as follows:
     --output-dir <OUTPUT_DIRECTORY>
     [--dry-run]
     [--scpm-data-dir] <SCPM_DATA_DIRECTORY>
+    [--aligned <FILENAME> [--aligned-period <SECONDS>]
+     [--aligned-method ffill|mean] [--aligned-max-gap <SECONDS>]]
 
 <BASE_DATA_DIR> 
   Will be searched recursively for input data directories containing valid
@@ -73,8 +94,15 @@ Run merge_datasets as follows:
     target labels.dat file then those channels will be appended to the end
     of the target labels.
   - a merge_datasets.log file
+  - merged channel_??_<resolution>.rollup files, if the input datasets have
+    rollups (these are concatenated, not recomputed from the raw data)
+  - channel_??_lod<exponent>.lod files: min, max, mean and count of each
+    merged channel over buckets of 2**exponent seconds, for plotting long
+    time ranges (see rfm_ecomanager_logger/lod.py)
   
-  All channel_*.dat files and merge_datasets.log in <OUTPUT_DIRECTORY> will be
+  All channel_*.dat, channel_*.rollup, channel_*.lod files and
+  merge_datasets.log in
+  <OUTPUT_DIRECTORY> will be
   deleted when merge_datasets.py starts, to make way for the new files.
   
 --dry-run
@@ -87,6 +115,24 @@ Run merge_datasets as follows:
   Optionally provide a base directory for data recorded using the
   Sound Card Power Meter project.  These .dat files will be merged into one
   large mains.dat file.
+
+--aligned
+  Optionally also write the merged channels as a single table with one row
+  per tick of a common time grid and one column per label (in labels.dat
+  order), to <OUTPUT_DIRECTORY>/<FILENAME>.  The first column is the UNIX
+  timestamp of the tick.  If FILENAME ends in .npy the table is a float64
+  NumPy array (load it with numpy.load); otherwise it is CSV with a header
+  row.  Missing values are NaN.
+  
+--aligned-period
+  Seconds between grid ticks (default 6).  Ticks are multiples of the
+  period in UNIX time.
+  
+--aligned-method
+  ffill (default): each tick takes the most recent sample, unless it is
+  more than --aligned-max-gap seconds old (default 60).
+  mean: each tick takes the mean of the samples from that tick up to the
+  next one.
     
 """                                     )
  
@@ -101,6 +147,17 @@ Run merge_datasets as follows:
     parser.add_argument('--scpm-data-dir', type=str)
     
     parser.add_argument('--dry-run', action='store_true')
+    
+    parser.add_argument('--aligned', type=str, metavar='FILENAME')
+    
+    parser.add_argument('--aligned-period', type=float,
+                        default=align.DEFAULT_PERIOD)
+    
+    parser.add_argument('--aligned-method', choices=align.METHODS,
+                        default=align.FFILL)
+    
+    parser.add_argument('--aligned-max-gap', type=float,
+                        default=align.DEFAULT_MAX_GAP)
         
     args = parser.parse_args()
 
@@ -193,24 +250,16 @@ class Dataset(object):
             with open(full_filename) as fh:
                 first_line = fh.readline()
                 file_first_timestamp = get_timestamp_from_line(first_line)
-                
-                if file_size > MIN_FILESIZE*2:
-                    # If the file is sufficiently large then
-                    # seek to the end of the file minus two lines
-                    fh.seek(-MIN_FILESIZE*2, 2)
-                    
-                last_lines = fh.readlines()
-                if last_lines: 
-                    last_line = last_lines[-1]
-                else:
-                    last_line = first_line
-
-                try:
-                    file_last_timestamp = get_timestamp_from_line(last_line)
-                except:
-                    print("Failed to read last line of file '{:s}'. Last line='{:s}'"
-                          .format(full_filename, last_line), file=sys.stderr)
-                    raise
+
+            # Skips a truncated final line (e.g. after a power cut)
+            # and any other unparsable lines at the end of the file
+            file_last_timestamp, complete_size = reader.read_tail(full_filename)
+            if complete_size < file_size:
+                log.warn("{} ends with a truncated line. Run check_data.py"
+                         " --repair to remove it.".format(full_filename))
+            if file_last_timestamp is None:
+                log.warn("no parsable lines in " + full_filename)
+                continue
             
             if first_timestamp is None or file_first_timestamp < first_timestamp:
                 first_timestamp = file_first_timestamp
@@ -333,14 +382,21 @@ class TemplateLabels(object):
             
         return source_to_template
     
-    def write_to_disk(self, data_dir):
+    def get_chan_to_label(self):
         """
-        Write a labels.dat file to data_dir.
+        Returns:
+            dict mapping chan number to primary label
         """
-        # Assemble a dict mapping chan number to label
         chan_to_label = {}
         for label, chan in self.label_to_chan.iteritems():
             chan_to_label[chan] = self.synonym_to_primary.get(label, label)
+        return chan_to_label
+    
+    def write_to_disk(self, data_dir):
+        """
+        Write a labels.dat file to data_dir.
+        """
+        chan_to_label = self.get_chan_to_label()
         
         with open(os.path.join(data_dir, 'labels.dat'), 'w') as fh:
             for chan in sorted(chan_to_label.iterkeys()):
@@ -394,9 +450,112 @@ def process_high_freq_line(data):
     return data
 
 
+def _line_is_clean(line, threshold, move_button_press_data):
+    """True if append_files would copy line unchanged."""
+    if not line.endswith('\n') or not line.strip():
+        return False
+    columns = line.split(' ')
+    if len(columns) == 3 and move_button_press_data:
+        return False
+    try:
+        return float(columns[1]) <= threshold
+    except (IndexError, ValueError):
+        return False
+
+
+def _dirty_lines(text, threshold, move_button_press_data):
+    """
+    Args:
+        text (str): complete lines
+
+    Returns:
+        line_ends (np.ndarray): offset just after each line's newline
+        dirty (np.ndarray of bools): one per line
+    """
+    chars = np.frombuffer(text, dtype=np.uint8)
+    line_ends = np.flatnonzero(chars == ord('\n')) + 1
+    n_lines = len(line_ends)
+    spaces = np.flatnonzero(chars == ord(' '))
+    spaces_per_line = np.bincount(np.searchsorted(line_ends, spaces,
+                                                  side='right'),
+                                  minlength=n_lines)[:n_lines]
+    if (spaces_per_line == 1).all():
+        # Fast path: every line is "<timestamp> <watts>"
+        values = np.fromstring(text, sep=' ')
+        if len(values) == n_lines * 2:
+            return line_ends, values[1::2] > threshold
+
+    # Slow path: some lines have a third (button press) column,
+    # or the text is malformed.
+    line_starts = np.concatenate([[0], line_ends[:-1]])
+    dirty = np.array([not _line_is_clean(text[start:end], threshold,
+                                         move_button_press_data)
+                      for start, end in zip(line_starts, line_ends)],
+                     dtype=bool)
+    return line_ends, dirty
+
+
+def find_dirty_regions(input_filename, threshold, move_button_press_data,
+                       block_size=SCAN_BLOCK_SIZE):
+    """
+    Find the parts of input_filename which append_files() would change
+    (values above threshold, button press columns to move and malformed,
+    blank or truncated lines).  The file is scanned in blocks with NumPy.
+
+    Returns:
+        list of (start, end) byte offsets of dirty regions, in order.
+        Everything outside them can be copied verbatim.
+    """
+    regions = []
+    block_start = 0
+    remainder = ''
+    with open(input_filename, 'rb') as input_file:
+        while True:
+            block = input_file.read(block_size)
+            text = remainder + block
+            end = text.rfind('\n') + 1
+            if not block:
+                end = len(text) # a truncated final line is dirty
+            text, remainder = text[:end], text[end:]
+            if text:
+                line_ends, dirty = _dirty_lines(text, threshold,
+                                                move_button_press_data)
+                if len(text) > (line_ends[-1] if len(line_ends) else 0):
+                    line_ends = np.append(line_ends, len(text))
+                    dirty = np.append(dirty, True)
+                # Merge runs of dirty lines into regions
+                edges = np.flatnonzero(np.diff(np.concatenate(
+                    [[0], dirty.astype(np.int8), [0]])))
+                line_starts = np.concatenate([[0], line_ends[:-1]])
+                for first, last in zip(edges[::2], edges[1::2]):
+                    start = block_start + int(line_starts[first])
+                    stop = block_start + int(line_ends[last - 1])
+                    if regions and regions[-1][1] == start:
+                        regions[-1] = (regions[-1][0], stop)
+                    else:
+                        regions.append((start, stop))
+                block_start += len(text)
+            if not block:
+                return regions
+
+
+def copy_range(input_file, output_file, start, end):
+    """Copy bytes [start, end) of input_file onto the end of output_file
+    in COPY_CHUNK_SIZE chunks, without parsing them."""
+    input_file.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = input_file.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        output_file.write(chunk)
+        remaining -= len(chunk)
+
+
 def append_files(input_filename, output_filename, 
                  line_processing_func=lambda x: x,
-                 move_button_press_data=False):
+                 move_button_press_data=False,
+                 dirty_regions=None):
     """
     Appends input_filename onto the end of output_filename.
     
@@ -404,15 +563,43 @@ def append_files(input_filename, output_filename,
         input_filename, output_filename (str): full paths to files
         line_processing_func (function): Optional. A suitable function must 
             take a single line as input and return a processed line or None.
+        dirty_regions (list of (start, end)): Optional. From
+            find_dirty_regions().  If given, only these byte ranges go
+            through line_processing_func and the rest is copied verbatim.
     """
-    input_file = open(input_filename, 'r')    
-    output_file = open(output_filename, 'a')
+    if dirty_regions is not None:
+        with open(input_filename, 'rb') as input_file:
+            with open(output_filename, 'ab') as output_file:
+                position = 0
+                for start, end in dirty_regions:
+                    copy_range(input_file, output_file, position, start)
+                    input_file.seek(start)
+                    if not _append_lines(
+                            input_file.read(end - start).splitlines(True),
+                            output_file, input_filename, output_filename,
+                            line_processing_func, move_button_press_data):
+                        return
+                    position = end
+                copy_range(input_file, output_file, position,
+                           os.path.getsize(input_filename))
+        return
+
+    with open(input_filename, 'r') as input_file:
+        with open(output_filename, 'a') as output_file:
+            _append_lines(input_file, output_file, input_filename,
+                          output_filename, line_processing_func,
+                          move_button_press_data)
+
+
+def _append_lines(lines, output_file, input_filename, output_filename,
+                  line_processing_func, move_button_press_data):
+    """Returns False if it stopped at a blank line, which (as always) ends
+    the input file."""
     if move_button_press_data:
         button_press_filename = os.path.splitext(output_filename)[0]
         button_press_filename += "_button_press.dat"
 
-    while True:
-        data = input_file.readline()
+    for data in lines:
         if data and data.strip():
             try:
                 data = line_processing_func(data)
@@ -432,9 +619,85 @@ def append_files(input_filename, output_filename,
                                 button_press_fh.write(button_press_line)
                     output_file.write(data)
         else:
-            break
-    input_file.close()
-    output_file.close()
+            return False
+    return True
+
+
+def append_rollups(input_dir, input_channel, output_dir, output_channel):
+    """Append any rollup files for input_channel onto the rollup files
+    for output_channel."""
+    for resolution, dummy in rollup.RESOLUTIONS:
+        input_filename = rollup.rollup_filename(input_dir, input_channel,
+                                                resolution)
+        if os.path.exists(input_filename):
+            output_filename = rollup.rollup_filename(output_dir,
+                                                     output_channel, resolution)
+            log.debug("appending " + input_filename + 
+                      " to end of " + output_filename)
+            rollup.append_rollup_file(input_filename, output_filename)
+
+
+def append_events(input_dir, input_channel, output_dir, output_channel):
+    """Append the events file for input_channel, if there is one, onto
+    the events file for output_channel."""
+    input_filename = events.events_filename(input_dir, input_channel)
+    if os.path.exists(input_filename):
+        output_filename = events.events_filename(output_dir, output_channel)
+        log.debug("appending " + input_filename +
+                  " to end of " + output_filename)
+        events.append_events_file(input_filename, output_filename)
+
+
+def report_coverage(coverages, chan_to_label, tz=pytz.utc):
+    """Log the uptime of each output channel and of the whole house (the
+    aggregate channels, or every channel if there are none) over the
+    whole span of the data, and the whole house's gaps.
+
+    Args:
+        coverages (dict): maps output channel to coverage_index.Coverage
+        chan_to_label (dict): maps output channel to label
+        tz (pytz timezone): for reporting the times of gaps
+
+    Returns:
+        coverage_index.Coverage of the whole house
+    """
+    everything = coverage_index.Coverage()
+    house = coverage_index.Coverage()
+    for chan, coverage in coverages.iteritems():
+        everything |= coverage
+        if chan_to_label.get(chan) in AGGREGATE_LABELS:
+            house |= coverage
+    if not house.n_minutes():
+        house = everything
+    span = everything.span()
+    if span is None:
+        log.info("No data, so no uptime to report")
+        return house
+    start, end = span
+
+    def describe(coverage):
+        return "{} ({:.1%})".format(
+            datetime.timedelta(minutes=coverage.n_minutes()),
+            coverage.uptime(start, end))
+
+    lines = ["Uptime (minutes with at least one sample) over {}:"
+             .format(datetime.timedelta(minutes=end - start)),
+             "  {:>20s} = {}".format('whole house', describe(house))]
+    for chan, coverage in sorted(coverages.iteritems()):
+        lines.append("  {:>20s} = {}".format(
+            "{} {}".format(chan, chan_to_label.get(chan, '?')),
+            describe(coverage)))
+    log.info("\n".join(lines))
+    gaps = house.gaps(MIN_GAP_TO_REPORT, start * coverage_index.MINUTE,
+                      end * coverage_index.MINUTE)
+    log.info("Whole house has {} gaps of at least {} minutes{}"
+             .format(len(gaps), MIN_GAP_TO_REPORT, ":" if gaps else ""))
+    for gap_start, gap_end in gaps:
+        log.info("  {} - {} ({})".format(
+            datetime.datetime.fromtimestamp(gap_start, tz).strftime(DATE_FMT),
+            datetime.datetime.fromtimestamp(gap_end, tz).strftime(DATE_FMT),
+            datetime.timedelta(seconds=gap_end - gap_start)))
+    return house
 
 
 def get_all_data_dirs(base_data_dir):
@@ -551,10 +814,8 @@ def main():
     datasets.sort(key=lambda dataset: dataset.first_timestamp)
         
     log.info("Proposed order :")
-    total_uptime = datetime.timedelta()
     for dataset in datasets:
         log.info(str(dataset))
-        total_uptime += dataset.timedelta
     
     check_not_overlapping(datasets)
     log.info("Good: datasets are not overlapping")
@@ -563,15 +824,15 @@ def main():
     log.info("For whole dataset: \n"
              "  start time = " + datasets[0].start_datetime.strftime(DATE_FMT) + "\n"
              "    end time = " + datasets[-1].last_datetime.strftime(DATE_FMT) + "\n"
-             "    timespan = {}\n".format(timespan) + 
-             "      uptime = {}\n".format(total_uptime) + 
-             "    % uptime = {:.1%}\n".format(total_uptime.total_seconds() / 
-                                        timespan.total_seconds()))
+             "    timespan = {}\n".format(timespan))
     
     if not args.dry_run:
         # Remove all the old files in the output dir        
         files_to_delete = [f for f in os.listdir(args.output_dir) 
-                           if f.startswith('channel_') and f.endswith('.dat')] 
+                           if f.startswith('channel_') and 
+                           (f.endswith('.dat') or f.endswith('.rollup') or
+                            f.endswith('.cov') or f.endswith('.events') or
+                            f.endswith('.lod'))] 
         files_to_delete.append('labels.dat')
         files_to_delete.append('mains.dat')
         log.info("Deleting {} old files in {}"
@@ -595,6 +856,7 @@ def main():
                 log.info(fname + " does not exist so will not copy it!")
     
     output_metadata_parser = ConfigParser.RawConfigParser()
+    coverages = {} # maps output channel to coverage_index.Coverage
     
     # Now merge the datasets
     if not args.dry_run:
@@ -612,20 +874,45 @@ def main():
                                            .format(output_channel))
             log.debug("appending " + input_filename + 
                      " to end of " + output_filename)
+            coverages[output_channel] = (
+                coverages.get(output_channel, coverage_index.Coverage()) |
+                coverage_index.load_or_build(input_filename))
             if not args.dry_run:
                 label = dataset.labels[input_channel]
                 is_iam = label not in AGGREGATE_LABELS
                 threshold = THRESHOLD_FOR_IAMS if is_iam else THRESHOLD_FOR_AGGREGATE
                 line_proc_f = lambda line: remove_values_above(threshold, line)
+                dirty_regions = find_dirty_regions(input_filename, threshold,
+                                                   is_iam)
+                log.debug("{} has {} dirty bytes".format(
+                    input_filename, sum(end - start
+                                        for start, end in dirty_regions)))
                 append_files(input_filename, output_filename, 
                              line_processing_func=line_proc_f,
-                             move_button_press_data=is_iam)
+                             move_button_press_data=is_iam,
+                             dirty_regions=dirty_regions)
+                append_rollups(dataset.data_dir, input_channel,
+                               args.output_dir, output_channel)
+                append_events(dataset.data_dir, input_channel,
+                              args.output_dir, output_channel)
                 
         # Handle metadata
         output_metadata_parser = merge_metadata(output_metadata_parser,
                                                 dataset.metadata_parser)
 
+    report_coverage(coverages, template_labels.get_chan_to_label(),
+                    datasets[0].tz)
+
     if not args.dry_run:
+        for output_channel, coverage in coverages.iteritems():
+            coverage.save(coverage_index.coverage_filename(os.path.join(
+                args.output_dir, 'channel_{:d}.dat'.format(output_channel))))
+
+        log.info("Building LOD files")
+        for output_channel in sorted(coverages):
+            lod.update(os.path.join(args.output_dir,
+                                    'channel_{:d}.dat'.format(output_channel)))
+
         log.info("Writing new labels file to disk")
         template_labels.write_to_disk(args.output_dir)
         
@@ -640,6 +927,18 @@ def main():
         # Write metadata to file
         # with open(os.path.join(args.output_dir, 'metadata.dat'), 'wb') as f:
         #     output_metadata_parser.write(f)
+        
+        if args.aligned:
+            aligned_filename = os.path.join(args.output_dir, args.aligned)
+            log.info("Writing aligned table to " + aligned_filename)
+            chan_to_label = template_labels.get_chan_to_label()
+            align.align_data_dir(args.output_dir, aligned_filename,
+                                 sorted(chan_to_label.iteritems()),
+                                 datasets[0].first_timestamp,
+                                 datasets[-1].last_timestamp,
+                                 period=args.aligned_period,
+                                 method=args.aligned_method,
+                                 max_gap=args.aligned_max_gap)
             
     # Process Sound Card Power Meter data if scpm-data-dir is set
     if args.scpm_data_dir:
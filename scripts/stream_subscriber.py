@@ -0,0 +1,43 @@
+#!/usr/bin/python
+"""Print readings streamed live by rfm_ecomanager_logger.
+
+Start the logger with e.g. "--sink stream:unix:/tmp/rfm_ecomanager_logger.sock"
+and then run:
+
+    ./stream_subscriber.py unix:/tmp/rfm_ecomanager_logger.sock
+"""
+from __future__ import print_function
+import argparse, os, sys, inspect, time
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import stream
+
+def main():
+    parser = argparse.ArgumentParser(description="Print live readings from"
+                                     " rfm_ecomanager_logger.")
+    parser.add_argument('address', help='udp:HOST:PORT or unix:PATH')
+    args = parser.parse_args()
+
+    subscriber = stream.Subscriber(args.address)
+    try:
+        for reading in subscriber:
+            latency = time.time() - reading.timestamp
+            print("{:d} {:>3d} {:>20s} {:>7.1f}W {:>4s} (latency {:.1f}s)"
+                  .format(reading.timestamp, reading.log_chan, reading.label,
+                          reading.watts,
+                          "" if reading.state is None else str(reading.state),
+                          latency))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+
+if __name__ == "__main__":
+    main()
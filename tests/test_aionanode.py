@@ -0,0 +1,120 @@
+import unittest, os, inspect, sys, time
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import emulator
+from protocol import NanodeError, NanodeRestart
+try:
+    import asyncio
+    import aionanode
+except ImportError: # Python 2
+    asyncio = None
+
+PORT = 'emulator:test_aionanode'
+
+@unittest.skipIf(asyncio is None, "aionanode needs Python 3")
+class TestAsyncNanode(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.device = emulator.get_device(PORT)
+        self.device.binary_supported = True
+        self.device.millis_offset = 0
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_until(self, future, timeout=5):
+        return self.loop.run_until_complete(asyncio.wait_for(future, timeout))
+
+    def open(self, binary=False):
+        nanode = self.run_until(aionanode.open_nanode(PORT, binary=binary,
+                                                      loop=self.loop))
+        self.addCleanup(nanode.close)
+        return nanode
+
+    def transmit_soon(self, *args, **kwargs):
+        self.loop.call_later(0.05, lambda: self.device.transmit(*args, **kwargs))
+
+    def test_commands_and_packets(self):
+        for binary in [False, True]:
+            nanode = self.open(binary)
+            self.assertEqual(nanode._parser.binary, binary)
+            self.run_until(nanode.send_command('n', 99))
+            self.run_until(nanode.pair(55))
+            self.assertEqual(self.device.txs, set([99]))
+            self.assertEqual(self.device.trxs, set([55]))
+            ack = self.run_until(nanode.__anext__())
+            self.assertTrue(ack.pair_ack)
+            self.assertEqual(ack.tx_id, 55)
+            self.run_until(nanode.switch(55, 0))
+            self.assertEqual(self.device.trx_states, {55: 0})
+
+            self.transmit_soon(99, 'tx', {1: 300})
+            data = self.run_until(nanode.__anext__())
+            self.assertEqual((data.tx_id, data.sensors), (99, {'1': 300}))
+            self.assertAlmostEqual(data.timecode, time.time(), delta=1.5)
+            nanode.close()
+
+    def test_packets_during_command_are_kept(self):
+        nanode = self.open()
+        self.run_until(nanode.send_command('n', 99))
+        self.device.transmit(99, 'tx', {1: 1})
+        self.run_until(nanode.send_command('n', 98))
+        self.device.transmit(98, 'tx', {1: 2})
+        self.assertEqual(self.run_until(nanode.__anext__()).sensors, {'1': 1})
+        self.assertEqual(self.run_until(nanode.__anext__()).sensors, {'1': 2})
+
+    def test_nak_timeout_and_cancel(self):
+        nanode = self.open()
+        self.assertRaises(NanodeError, self.run_until, nanode.send_command('x'))
+        self.device.stall()
+        self.assertRaises(asyncio.TimeoutError, self.run_until,
+                          nanode.send_command('n', 1, timeout=0.2))
+        future = nanode.send_command('n', 2)
+        future.cancel()
+        self.run_until(asyncio.sleep(0.05))
+        self.assertIsNone(nanode._command)
+
+    def test_restart(self):
+        nanode = self.open()
+        restarted = self.loop.create_future()
+        nanode.on_restart = restarted.set_result
+        self.device.hold(0.2) # the banner arrives while 'n' is in flight
+        pending = nanode.send_command('n', 99)
+        self.run_until(asyncio.sleep(0.05)) # let 'n' reach the device
+        self.device.reset(banner=True)
+        self.assertRaises(NanodeRestart, self.run_until, pending)
+        self.assertIs(self.run_until(restarted), nanode)
+        self.run_until(nanode.send_command('n', 99))
+        self.transmit_soon(99, 'tx', {1: 3})
+        self.assertEqual(self.run_until(nanode.__anext__()).sensors, {'1': 3})
+
+    def test_close_ends_iteration(self):
+        nanode = self.open()
+        received = []
+
+        def consume():
+            def next_packet(future=None):
+                if future is not None:
+                    if future.exception() is not None:
+                        done.set_result(type(future.exception()))
+                        return
+                    received.append(future.result())
+                nanode.__anext__().add_done_callback(next_packet)
+            next_packet()
+
+        done = self.loop.create_future()
+        consume()
+        self.loop.call_later(0.1, nanode.close)
+        self.assertIs(self.run_until(done), StopAsyncIteration)
+        self.assertEqual(received, [])
+
+if __name__ == '__main__':
+    unittest.main()
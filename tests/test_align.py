@@ -0,0 +1,84 @@
+import unittest, os, inspect, sys, shutil, tempfile
+import numpy as np
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import align
+
+NAN = np.nan
+
+class TestAlign(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.write_channel(1, [(100, 10), (103, 20), (107, 30), (200, 40)])
+        self.write_channel(2, [(101, 1), (102, 3), (111, 5)])
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def write_channel(self, channel, samples):
+        filename = os.path.join(self.data_dir, 'channel_{}.dat'.format(channel))
+        with open(filename, 'w') as fh:
+            for t, watts in samples:
+                fh.write('{} {}\n'.format(t, watts))
+            fh.write('300 1') # truncated final line
+
+    def streams(self, channels=(1, 2, 3)):
+        # Tiny blocks to exercise lines split across blocks
+        return [align.ChannelStream(os.path.join(self.data_dir,
+                                                 'channel_{}.dat'.format(c)),
+                                    block_size=7)
+                for c in channels]
+
+    def run_align(self, method, chunk_ticks, max_gap=align.DEFAULT_MAX_GAP):
+        chunks = list(align.align(self.streams(), 100, 130, period=5,
+                                  method=method, max_gap=max_gap,
+                                  chunk_ticks=chunk_ticks))
+        return (np.concatenate([grid for grid, matrix in chunks]),
+                np.concatenate([matrix for grid, matrix in chunks]))
+
+    def test_ffill(self):
+        for chunk_ticks in [1, 2, 100]:
+            grid, matrix = self.run_align(align.FFILL, chunk_ticks, max_gap=8)
+            np.testing.assert_array_equal(grid, [100, 105, 110, 115, 120, 125, 130])
+            np.testing.assert_array_equal(matrix, [[10, NAN, NAN],
+                                                   [20, 3, NAN],
+                                                   [30, 3, NAN],
+                                                   [30, 5, NAN],
+                                                   [NAN, NAN, NAN],
+                                                   [NAN, NAN, NAN],
+                                                   [NAN, NAN, NAN]])
+
+    def test_mean(self):
+        for chunk_ticks in [1, 3, 100]:
+            grid, matrix = self.run_align(align.MEAN, chunk_ticks)
+            np.testing.assert_array_equal(matrix[:3], [[15, 2, NAN],
+                                                       [30, NAN, NAN],
+                                                       [NAN, 5, NAN]])
+            self.assertTrue(np.isnan(matrix[3:]).all())
+
+    def test_align_data_dir(self):
+        channels = [(1, 'aggregate'), (2, 'kettle')]
+        csv_filename = os.path.join(self.data_dir, 'aligned.csv')
+        npy_filename = os.path.join(self.data_dir, 'aligned.npy')
+        for filename in [csv_filename, npy_filename]:
+            align.align_data_dir(self.data_dir, filename, channels, 102, 200,
+                                 period=50)
+        with open(csv_filename) as fh:
+            self.assertEqual(fh.read().splitlines(),
+                             ['timestamp,aggregate,kettle',
+                              '100.000,10,nan',
+                              '150.000,30,5',
+                              '200.000,40,nan'])
+        np.testing.assert_array_equal(np.load(npy_filename),
+                                      [[100, 10, NAN], [150, 30, 5], [200, 40, NAN]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest, os, sys, inspect, shutil, tempfile
+
+# Hack to allow us to import ../scripts/check_data.py
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+SCRIPTS_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH, '..', 'scripts'))
+if SCRIPTS_SUBFOLDER not in sys.path:
+    sys.path.insert(0, SCRIPTS_SUBFOLDER)
+import check_data as cd
+import sinks
+
+NOW = 1360400000
+
+LINES = ['1360396444 100\n',
+         '1360396450 120 1\n',
+         '1360396456 5000\n',      # out_of_range for an IAM
+         '1360396456 130\n',
+         '1360396456 130\n',       # duplicate
+         '1360399999 140\n',       # spike
+         '1360396462 150\n',
+         'garbage\n',              # unparsable
+         '1360396468 160 7\n',     # out_of_range: bad state
+         '1360396400 170\n',       # backwards
+         '99 180\n',               # bad_timestamp
+         '1360396474 nan\n',       # out_of_range
+         '1360396480 190\n',
+         '13603964']               # truncated
+GOOD = [0, 1, 3, 6, 12]
+
+class TestCheckData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp_dir, 'labels.dat'), 'w') as fh:
+            fh.write("1 aggregate\n2 kettle\n")
+        self.filename = os.path.join(self.tmp_dir, 'channel_2.dat')
+        with open(self.filename, 'w') as fh:
+            fh.write(''.join(LINES))
+        self.offsets = [sum(len(line) for line in LINES[:i])
+                        for i in range(len(LINES))]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_check(self):
+        expected = {'truncated': [13], 'unparsable': [7],
+                    'bad_timestamp': [10], 'out_of_range': [2, 8, 11],
+                    'spike': [5], 'duplicate': [4], 'backwards': [9]}
+        for block_size in [20, 40, cd.BLOCK_SIZE]:
+            report = cd.check_file(self.filename, block_size=block_size, now=NOW)
+            self.assertEqual(report.n_lines, len(LINES) - 1)
+            for defect in cd.DEFECTS:
+                self.assertEqual(report.offsets[defect],
+                                 [self.offsets[i] for i in expected[defect]],
+                                 defect)
+            self.assertEqual(report.n_defects(), 9)
+
+        # 5000 W is fine for an aggregate channel
+        aggregate = os.path.join(self.tmp_dir, 'channel_1.dat')
+        shutil.copy(self.filename, aggregate)
+        self.assertEqual(cd.check_file(aggregate, now=NOW).counts['out_of_range'], 2)
+
+    def test_repair(self):
+        for block_size in [20, cd.BLOCK_SIZE]:
+            shutil.copy(self.filename, self.filename + '.orig')
+            report = cd.check_file(self.filename, repair=True,
+                                   block_size=block_size, now=NOW)
+            with open(self.filename) as fh:
+                self.assertEqual(fh.read(), ''.join(LINES[i] for i in GOOD))
+            self.assertEqual(report.n_bytes_removed,
+                             sum(len(line) for line in LINES) -
+                             sum(len(LINES[i]) for i in GOOD))
+            self.assertEqual(cd.check_file(self.filename, now=NOW).n_defects(), 0)
+            shutil.move(self.filename + '.orig', self.filename)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['channel_2.dat', 'channels.lock', 'labels.dat'])
+
+    def test_multi_line_spike(self):
+        # A glitch two lines long, then a run too long to be a spike
+        lines = ['{:d} 100\n'.format(1360396444 + 6 * i) for i in range(40)]
+        glitch = ['{:d} 100\n'.format(1360396444 + 43200 + i) for i in range(2)]
+        relogged = lines[10:30]
+        all_lines = lines[:10] + glitch + lines[10:30] + relogged
+        with open(self.filename, 'w') as fh:
+            fh.write(''.join(all_lines))
+        for block_size in [20, 100, cd.BLOCK_SIZE]:
+            report = cd.check_file(self.filename, block_size=block_size,
+                                   now=NOW + 43200)
+            self.assertEqual(report.counts['spike'], 2)
+            self.assertEqual(report.counts['duplicate'], 1)
+            self.assertEqual(report.counts['backwards'], 19)
+            self.assertEqual(report.n_defects(), 22)
+        cd.check_file(self.filename, repair=True, now=NOW + 43200)
+        with open(self.filename) as fh:
+            self.assertEqual(fh.read(), ''.join(lines[:30]))
+
+    def test_no_repair_while_logging(self):
+        sink = sinks.ReddSink(self.tmp_dir)
+        sink.open()
+        try:
+            report = cd.check_file(self.filename, repair=True, now=NOW)
+        finally:
+            sink.close()
+        self.assertEqual(report.n_defects(), 9)
+        self.assertEqual(report.n_bytes_removed, 0)
+        self.assertTrue(report.not_repaired)
+        self.assertIn("not repaired", str(report))
+        with open(self.filename) as fh:
+            self.assertEqual(fh.read(), ''.join(LINES))
+        report = cd.check_file(self.filename, repair=True, now=NOW)
+        self.assertTrue(report.n_bytes_removed)
+
+    def test_check_files(self):
+        shutil.copy(self.filename, os.path.join(self.tmp_dir, 'channel_1.dat'))
+        filenames = cd.find_data_files(self.tmp_dir)
+        self.assertEqual([os.path.basename(f) for f in filenames],
+                         ['channel_1.dat', 'channel_2.dat'])
+        reports = cd.check_files(filenames, processes=2)
+        self.assertEqual(sorted(report.filename for report in reports), filenames)
+        self.assertTrue(all(report.n_defects() for report in reports))
+
+if __name__ == '__main__':
+    unittest.main()
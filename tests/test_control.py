@@ -0,0 +1,165 @@
+import unittest, os, inspect, sys, shutil, tempfile, threading, socket
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import control
+import events
+from manager import Manager
+from nanode import Data
+
+class Args(object):
+    def __init__(self, data_directory):
+        self.data_directory = data_directory
+        self.pickle_file = os.path.join(data_directory, 'radioIDs.pkl')
+
+class FakeNanode(object):
+    def __init__(self, port):
+        self.port = port
+        self.commands = []
+        self.manager = None
+
+    def send_command(self, cmd, param=None, flush=True):
+        self.commands.append((cmd, param))
+        if cmd == 'p':
+            # The IAM acknowledges straight away
+            data = Data()
+            data.pair_ack = True
+            data.tx_id = param
+            data.tx_type = 'trx'
+            self.manager._notify_listeners(self, data)
+
+class TestControl(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.nanode = FakeNanode('/dev/ttyUSB0')
+        self.m = Manager([self.nanode], Args(self.tmp_dir))
+        self.m.transmitters = {}
+        self.nanode.manager = self.m
+        self.controller = control.Controller(self.m)
+
+        # Stand in for the base unit's read loop
+        self.stopping = threading.Event()
+        def base_unit():
+            while not self.stopping.wait(0.01):
+                self.m._run_base_unit_queue(self.nanode)
+        self.thread = threading.Thread(target=base_unit)
+        self.thread.start()
+
+    def tearDown(self):
+        self.stopping.set()
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def execute(self, **request):
+        response = self.controller.execute(request)
+        self.assertTrue(response['ok'], response.get('error'))
+        return response['result']
+
+    def labels(self):
+        with open(os.path.join(self.tmp_dir, 'labels.dat')) as fh:
+            return fh.read()
+
+    def test_editing_commands(self):
+        self.execute(command='add', tx_type='TX', rf_id=100,
+                     sensors={'1': 'aggregate', '2': 'lighting'})
+        self.execute(command='pair', rf_id=200, name='kettle')
+        self.assertEqual(self.nanode.commands, [('n', 100), ('p', 200)])
+        self.assertEqual(self.labels(), "1 aggregate\n2 lighting\n3 kettle\n")
+        transmitters = self.execute(command='list')
+        self.assertEqual([tx['id'] for tx in transmitters], [100, 200])
+        self.assertTrue(transmitters[0]['sensors'][0]['agg_chan'])
+
+        self.execute(command='rename', log_chan=3, name='toaster', new_log_chan=5)
+        self.assertEqual(self.m.transmitters[200].sensors[1].log_chan, 5)
+        self.execute(command='switch', log_chan=5, state='off')
+        self.assertEqual(self.m.transmitters[200].state, 0)
+        self.execute(command='delete', log_chan=1)
+        self.assertEqual(self.labels(), "5 toaster\n")
+        self.assertEqual(self.nanode.commands[2:], [('0', 200), ('r', 100)])
+
+        # The registry was pickled
+        self.m.transmitters = {}
+        self.m.reload()
+        self.assertEqual(sorted(self.m.transmitters), [200])
+
+    def test_errors(self):
+        self.execute(command='pair', rf_id=200, name='kettle')
+        for request in [dict(command='frobnicate'),
+                        dict(command='pair', rf_id=200, name='kettle'),
+                        dict(command='switch', log_chan=9, state='on'),
+                        dict(command='add', tx_type='TRX', rf_id=300,
+                             sensors={'1': 'tv'}, base_unit='/dev/ttyUSB9'),
+                        dict(command='list', unexpected=1)]:
+            self.assertFalse(self.controller.execute(request)['ok'])
+
+    def test_rename_flushes_events(self):
+        self.execute(command='pair', rf_id=200, name='kettle')
+        sensor = self.m.transmitters[200].sensors[1]
+        sensor.events.add(1360396444, 0)
+        # A button press while the kettle might be turning on is held back
+        sensor.events.add(1360396450, 2000, 1)
+        self.execute(command='rename', log_chan=1, name='kettle', new_log_chan=4)
+        events_filename = os.path.join(self.tmp_dir, 'channel_1.events')
+        self.assertEqual(os.path.getsize(events_filename), events.RECORD.size)
+
+    def test_io_error(self):
+        self.execute(command='pair', rf_id=200, name='kettle')
+        def save_registry(transmitters):
+            raise IOError(28, 'No space left on device')
+        self.m.save_registry = save_registry
+        response = self.controller.execute(dict(command='rename', log_chan=1,
+                                                name='toaster'))
+        self.assertFalse(response['ok'])
+        self.assertIn('No space left', response['error'])
+
+    def test_socket(self):
+        path = os.path.join(self.tmp_dir, 'control.sock')
+        server = control.ControlServer(path, self.controller)
+        server.start()
+        self.assertEqual(control.send({'command': 'list'}, path, timeout=5),
+                         {'ok': True, 'result': []})
+        server.stop()
+        self.assertFalse(os.path.exists(path))
+
+    def test_socket_in_use(self):
+        path = os.path.join(self.tmp_dir, 'control.sock')
+        server = control.ControlServer(path, self.controller)
+        server.start()
+        try:
+            self.assertRaises(control.ControlError, control.ControlServer,
+                              path, self.controller)
+            self.assertEqual(control.send({'command': 'list'}, path,
+                                          timeout=5)['ok'], True)
+        finally:
+            server.stop()
+
+        # A socket left behind by a logger which crashed is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        server = control.ControlServer(path, self.controller)
+        server.stop()
+
+    def test_unexpected_error(self):
+        def execute(request):
+            raise RuntimeError("oops")
+        self.controller.execute = execute
+        path = os.path.join(self.tmp_dir, 'control.sock')
+        server = control.ControlServer(path, self.controller)
+        server.start()
+        try:
+            response = control.send({'command': 'list'}, path, timeout=5)
+        finally:
+            server.stop()
+        self.assertFalse(response['ok'])
+        self.assertIn('oops', response['error'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest, os, inspect, sys, shutil, tempfile
+import numpy as np
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import coverage_index as ci
+
+START = 1360396440 # a whole minute
+
+class TestCoverage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_minutes_uptime_and_gaps(self):
+        # Minutes 0-9 and 20-29, sampled every 6 seconds
+        timestamps = [START + s for s in range(0, 600, 6) + range(1200, 1800, 6)]
+        coverage = ci.Coverage.from_timestamps(timestamps)
+        self.assertEqual(coverage.origin % 8, 0)
+        self.assertEqual(coverage.n_minutes(), 20)
+        self.assertEqual(coverage.span(), (START // 60, START // 60 + 30))
+        self.assertAlmostEqual(coverage.uptime(), 20 / 30.0)
+        gap = (START + 600, START + 1200)
+        self.assertEqual(coverage.gaps(), [gap])
+        self.assertEqual(coverage.gaps(min_minutes=11), [])
+        self.assertEqual(coverage.gaps(end=START + 2400),
+                         [gap, (START + 1800, START + 2400)])
+        self.assertEqual(coverage.gaps(start=START + 900),
+                         [(START + 900, START + 1200)])
+
+        incremental = ci.Coverage()
+        for timestamp in reversed(timestamps):
+            incremental.add(timestamp)
+        np.testing.assert_array_equal(incremental.minutes(), coverage.minutes())
+
+    def test_or(self):
+        a = ci.Coverage.from_timestamps([START, START + 60])
+        b = ci.Coverage.from_timestamps([START + 60, START + 86400])
+        merged = a | b
+        self.assertEqual(list(merged.minutes() - START // 60), [0, 1, 1440])
+        self.assertEqual(list((merged | ci.Coverage()).minutes()),
+                         list(merged.minutes()))
+
+    def test_build_save_load(self):
+        data_filename = os.path.join(self.tmp_dir, 'channel_1.dat')
+        with open(data_filename, 'w') as fh:
+            fh.write("".join("{:d} {:d}\n".format(START + s, s)
+                             for s in range(0, 3600, 7) if s < 600 or s > 900))
+        for block_size in [10, ci.BLOCK_SIZE]:
+            coverage = ci.build(data_filename, block_size=block_size)
+            self.assertEqual(coverage.n_minutes(), 60 - 5)
+        filename = ci.coverage_filename(data_filename)
+        self.assertEqual(filename, os.path.join(self.tmp_dir, 'channel_1.cov'))
+        coverage.save(filename)
+        loaded = ci.load(filename)
+        self.assertEqual(loaded.origin, coverage.origin)
+        np.testing.assert_array_equal(loaded.minutes(), coverage.minutes())
+        self.assertEqual(ci.load_or_build(data_filename).n_minutes(), 55)
+
+        with open(filename, 'wb') as fh:
+            fh.write(b"junk")
+        self.assertRaises(ci.CoverageError, ci.load, filename)
+
+    def test_writer(self):
+        filename = os.path.join(self.tmp_dir, 'channel_2.cov')
+        writer = ci.CoverageWriter(filename)
+        for timestamp in [START + 6, START + 12, START + 300, START - 3600]:
+            writer.add(timestamp)
+        minutes = [START // 60 - 60, START // 60, START // 60 + 5]
+        self.assertEqual(list(ci.load(filename).minutes()), minutes)
+
+        # A new writer (e.g. after a restart) carries on from the file
+        writer = ci.CoverageWriter(filename)
+        writer.add(START + 3600)
+        self.assertEqual(list(ci.load(filename).minutes()),
+                         minutes + [START // 60 + 60])
+
+if __name__ == '__main__':
+    unittest.main()
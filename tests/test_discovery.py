@@ -0,0 +1,96 @@
+import unittest, os, inspect, sys, shutil, tempfile, time
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import discovery
+from manager import Manager
+from nanode import Data, NanodeTooManyRetries
+
+def make_data(tx_id, tx_type, sensors=None, pairing=False, pair_ack=False):
+    data = Data()
+    data.tx_id = tx_id
+    data.tx_type = tx_type
+    data.pair_ack = pair_ack
+    data.is_pairing_request = pairing
+    data.sensors = sensors
+    return data
+
+class FakeNanode(object):
+    def __init__(self, port, packets):
+        self.port = port
+        self.abort = False
+        self.packets = list(packets)
+        self.commands = []
+
+    def send_command(self, cmd, param=None, flush=True):
+        self.commands.append((cmd, param))
+        if cmd == 'p' and param != 666: # 666 never acknowledges
+            self.packets.append(make_data(param, 'trx', pair_ack=True))
+
+    def read_sensor_data(self, retries):
+        if not self.packets:
+            time.sleep(0.01)
+            raise NanodeTooManyRetries()
+        return self.packets.pop(0)
+
+class Args(object):
+    def __init__(self, data_directory):
+        self.data_directory = data_directory
+        self.pickle_file = os.path.join(data_directory, 'radioIDs.pkl')
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'candidates.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_scan_and_accept(self):
+        nanode = FakeNanode('/dev/ttyUSB0', [
+            make_data(100, 'tx', {'1': 300, '2': 20}),
+            make_data(100, 'tx', {'1': 500, '2': 40}),
+            make_data(200, 'trx', pairing=True),
+            make_data(300, 'trx', {'1': 5}),
+            make_data(5, 'trx', {'1': 5})]) # already known
+        candidates = discovery.scan_all([nanode], 0.2, known_ids=[5])
+        self.assertEqual(nanode.commands, [('u', None), ('k', None)])
+        self.assertEqual(sorted(candidates), [100, 200, 300])
+        self.assertEqual(candidates[100].packets, 2)
+        self.assertEqual(candidates[100].mean_watts(), {1: 400, 2: 30})
+        self.assertEqual(candidates[200].pair_requests, 1)
+
+        discovery.write_candidates(self.filename, candidates)
+        self.assertRaises(discovery.DiscoveryError,
+                          discovery.read_candidates, self.filename) # no names
+        with open(self.filename) as fh:
+            lines = fh.read().splitlines()
+        names = {'100': '1=aggregate;2=lighting', '200': 'kettle', '300': 'tv'}
+        with open(self.filename, 'w') as fh:
+            fh.write(lines[0] + '\n')
+            for line in lines[1:]:
+                fh.write(line + names[line.split(',')[0]] + '\n')
+            fh.write('666,TRX,/dev/ttyUSB0,0,3,,toaster\n')
+
+        manager = Manager([FakeNanode('/dev/ttyUSB0', [])], Args(self.tmp_dir))
+        manager.transmitters = {}
+        failed = discovery.accept(manager, discovery.read_candidates(self.filename))
+        self.assertEqual(failed, [666])
+        commands = manager.nanode.commands
+        self.assertEqual(commands[:2], [('p', 200), ('p', 666)])
+        self.assertEqual(commands[-2:], [('n', 100), ('N', 300)])
+        self.assertEqual(sorted((s.log_chan, s.name)
+                                for tx in manager.transmitters.values()
+                                for s in tx.sensors.values()),
+                         [(1, 'aggregate'), (2, 'lighting'), (3, 'kettle'), (4, 'tv')])
+        self.assertTrue(os.path.exists(manager.args.pickle_file))
+
+if __name__ == "__main__":
+    unittest.main()
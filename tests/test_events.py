@@ -0,0 +1,95 @@
+import unittest, os, inspect, sys, shutil, tempfile
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import events
+from events import ON, OFF, STEP, STATE
+import reader
+
+START = 1360396444
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def feed(self, channel_events, samples):
+        """samples is a list of (watts, state); one sample every 6 s."""
+        for i, (watts, state) in enumerate(samples):
+            channel_events.add(START + 6 * i, watts, state)
+        channel_events.flush()
+
+    def test_detector(self):
+        channel_events = events.ChannelEvents(self.tmp_dir, 2)
+        samples = ([(1, None)] * 3 +
+                   [(2000, 1)] +        # on, with a button press
+                   [(2000, None)] * 2 +
+                   [(3, None)] +        # blip: too short to be an event
+                   [(2010, None)] * 2 +
+                   [(1500, None)] * 3 + # step down
+                   [(8, None)] * 2 +    # above on - hysteresis: not off yet
+                   [(2, None)] * 3 +    # off
+                   [(50, 0)])           # too short, but the press is kept
+        self.feed(channel_events, samples)
+
+        data_dir = reader.DataDirectory(self.write_labels())
+        records = data_dir.load_events('kettle')
+        self.assertEqual([(t - START, kind, state) for t, kind, state, watts, delta
+                          in records.tolist()],
+                         [(18, ON, -1), (18, STATE, 1), (54, STEP, -1),
+                          (84, OFF, -1), (102, STATE, 0)])
+        self.assertAlmostEqual(records['delta'][0], 1999)
+        self.assertAlmostEqual(records['watts'][2], 1500)
+
+        # Time range and kind queries
+        on_off = data_dir.load_events(2, start=START + 20, kinds=[ON, OFF])
+        self.assertEqual(on_off['timestamp'].tolist(), [START + 84])
+        self.assertEqual(len(data_dir.load_events(2, end=START + 17)), 0)
+        self.assertEqual(len(data_dir.load_events(2, start=START + 18,
+                                                  end=START + 54)), 3)
+        self.assertEqual(len(data_dir.load_events('lamp')), 0)
+
+    def test_min_duration_and_append(self):
+        channel_events = events.ChannelEvents(self.tmp_dir, 2, on_watts=100,
+                                              min_duration=0)
+        self.feed(channel_events, [(0, None), (150, None), (0, None)])
+        self.assertEqual(os.path.getsize(events.events_filename(self.tmp_dir, 2)),
+                         2 * events.RECORD.size)
+        output_dir = os.path.join(self.tmp_dir, 'merged')
+        os.mkdir(output_dir)
+        for dummy in range(2):
+            events.append_events_file(events.events_filename(self.tmp_dir, 2),
+                                      events.events_filename(output_dir, 5))
+        self.assertEqual(os.path.getsize(events.events_filename(output_dir, 5)),
+                         4 * events.RECORD.size)
+
+    def test_resume_carries_on(self):
+        self.feed(events.ChannelEvents(self.tmp_dir, 2),
+                  [(1, None)] + [(2000, None)] * 3)
+        # A resumed run carries on while the kettle is still on...
+        channel_events = events.ChannelEvents(self.tmp_dir, 2)
+        self.assertTrue(channel_events.on)
+        self.assertEqual(channel_events.level, 2000)
+        channel_events.add(START + 100, 2000)
+        # ...and sees it turn off
+        channel_events.add(START + 106, 1)
+        channel_events.add(START + 118, 1)
+        records = reader.DataDirectory(self.write_labels()).load_events(2)
+        self.assertEqual(records['kind'].tolist(), [ON, OFF])
+
+    def write_labels(self):
+        with open(os.path.join(self.tmp_dir, 'labels.dat'), 'w') as fh:
+            fh.write("2 kettle\n3 lamp\n")
+        return self.tmp_dir
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest, os, inspect, sys
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import faults
+
+class TestFaults(unittest.TestCase):
+
+    def check(self, scenario, binary=False):
+        result = faults.Harness(scenario, binary).run()
+        self.assertEqual(result.failures(), [], str(result))
+        self.assertTrue(result.logged > 0)
+
+    def test_scenarios(self):
+        for scenario in faults.SCENARIOS:
+            self.check(scenario)
+
+    def test_binary_garbage(self):
+        self.check(faults.Garbage(), binary=True)
+
+    def test_scenario_is_abstract(self):
+        self.assertRaises(TypeError, faults.Scenario)
+
+if __name__ == "__main__":
+    unittest.main()
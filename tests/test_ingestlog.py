@@ -0,0 +1,107 @@
+import unittest, os, inspect, sys, shutil, tempfile
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import sinks
+import ingestlog
+
+RECORDS = [(100, 1, 250, None), (101, 2, 30, 1), (106, 1, 260, None),
+           (107, 2, 0, 0)]
+CHANNEL_1 = '100 250\n106 260\n'
+CHANNEL_2 = '101 30 1\n107 0 0\n'
+
+class TestIngestLog(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.ingest_dir = ingestlog.ingest_directory(self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def read_channel(self, log_chan):
+        with open(os.path.join(self.data_dir,
+                               'channel_{:d}.dat'.format(log_chan))) as fh:
+            return fh.read()
+
+    def write(self, spec, batches):
+        sink = sinks.create_sink(spec, self.data_dir)
+        sink.open()
+        for batch in batches:
+            sink.write_batch(batch)
+        sink.close()
+        return sink
+
+    def test_sink_and_demux(self):
+        self.write('ingest', [RECORDS[:2], RECORDS[2:]])
+        self.assertEqual(self.read_channel(1), CHANNEL_1)
+        self.assertEqual(self.read_channel(2), CHANNEL_2)
+        self.assertEqual(ingestlog.list_segments(self.ingest_dir), [])
+
+    def test_rotation_and_on_demand_demux(self):
+        block = len(ingestlog.encode_block(RECORDS[:1]))
+        self.write('ingest,segment={:d},demux=0'.format(block),
+                   [[record] for record in RECORDS])
+        segments = ingestlog.list_segments(self.ingest_dir)
+        self.assertEqual([number for number, dummy in segments], [1, 2, 3, 4])
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir,
+                                                     'channel_1.dat')))
+        demuxer = ingestlog.Demuxer(self.data_dir)
+        self.assertEqual(demuxer.run(), (4, 4))
+        self.assertEqual(self.read_channel(1), CHANNEL_1)
+        self.assertEqual(self.read_channel(2), CHANNEL_2)
+
+    def test_torn_segment(self):
+        os.makedirs(self.ingest_dir)
+        data = (ingestlog.encode_block(RECORDS[:2]) +
+                ingestlog.encode_block(RECORDS[2:])[:-3]) # crashed mid-write
+        active = ingestlog.segment_filename(self.ingest_dir, 7, ingestlog.ACTIVE)
+        with open(active, 'wb') as fh:
+            fh.write(data)
+        self.write('ingest', [RECORDS[3:]]) # closes the crashed segment first
+        self.assertEqual(self.read_channel(1), '100 250\n')
+        self.assertEqual(self.read_channel(2), CHANNEL_2)
+        records, n_bad_bytes = ingestlog.decode_segment(data)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(n_bad_bytes, len(ingestlog.encode_block(RECORDS[2:])) - 3)
+
+    def test_retried_block_after_torn_block(self):
+        # A write which failed part way, then the whole batch again
+        torn = ingestlog.encode_block(RECORDS[2:])[:-3]
+        data = (ingestlog.encode_block(RECORDS[:2]) + torn +
+                ingestlog.encode_block(RECORDS[2:]) +
+                ingestlog.encode_block(RECORDS[3:]))
+        records, n_bad_bytes = ingestlog.decode_segment(data)
+        self.assertEqual(len(records), len(RECORDS) + 1)
+        self.assertEqual(n_bad_bytes, len(torn))
+        self.assertEqual(records['timestamp'].tolist()[2:],
+                         [record[0] for record in RECORDS[2:] + RECORDS[3:]])
+
+    def test_interrupted_demux(self):
+        self.write('ingest,demux=0', [RECORDS])
+        demuxer = ingestlog.Demuxer(self.data_dir)
+        # A demux which crashed after writing channel 1 but not channel 2
+        with open(os.path.join(self.data_dir, 'channel_1.dat'), 'w') as fh:
+            fh.write('1 1\n')
+        segment = ingestlog.list_segments(self.ingest_dir)[0][1]
+        demuxer._write_journal({'segment': os.path.basename(segment),
+                                'sizes': {1: 4, 2: 0}})
+        with open(os.path.join(self.data_dir, 'channel_1.dat'), 'a') as fh:
+            fh.write(CHANNEL_1)
+        self.assertEqual(demuxer.run(), (1, 4))
+        self.assertEqual(self.read_channel(1), '1 1\n' + CHANNEL_1)
+        self.assertEqual(self.read_channel(2), CHANNEL_2)
+        self.assertEqual(os.listdir(self.ingest_dir), [ingestlog.LOCK])
+
+    def test_bad_option(self):
+        self.assertRaises(sinks.SinkError, sinks.create_sink,
+                          'redd,segment=10', self.data_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest, os, inspect, sys, json, shutil, tempfile
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+from linkstats import LinkStats
+from sensor import TOO_HIGH, TOO_SOON
+
+class FakeTx(object):
+    TYPE = "TX"
+    def __init__(self, rf_id):
+        self.id = rf_id
+
+class TestLinkStats(unittest.TestCase):
+
+    def test_loss_gaps_and_rejects(self):
+        stats = LinkStats()
+        tx = FakeTx(99)
+        # Every 6 s, but packets 5, 6 and 7 are missed, 10 is duplicated
+        # and 20 arrives a little late
+        times = [1000 + 6 * i for i in range(20) if i not in (5, 6, 7)]
+        times += [1000 + 6 * 10 + 0.5, 1000 + 6 * 20 + 1]
+        for timecode in sorted(times):
+            stats.packet(tx, timecode)
+            stats.reading(tx, 1, TOO_SOON if (timecode - 1000) % 6 else None)
+        stats.reading(tx, 2, TOO_HIGH)
+
+        status = stats.status(now=1000 + 6 * 20 + 4)['99']
+        self.assertAlmostEqual(status['period'], 6, delta=0.1)
+        self.assertEqual(status['received'], 18)
+        self.assertEqual(status['expected'], 21)
+        self.assertEqual(status['duplicates'], 1)
+        self.assertEqual(status['longest_gap'], 24)
+        self.assertEqual(status['gap'], 3)
+        self.assertEqual(status['sensors'], {'1': {'readings': 19, 'too_soon': 2},
+                                             '2': {'readings': 1, 'too_high': 1}})
+
+    def test_silence_alerts(self):
+        stats = LinkStats(silence_multiple=5)
+        tx = FakeTx(7)
+        self.assertEqual(stats.check_silence(now=10000), [])
+        for i in range(10):
+            stats.packet(tx, 1000 + 6 * i)
+        self.assertEqual(stats.check_silence(now=1054 + 29), [])
+        self.assertEqual(stats.check_silence(now=1054 + 31), [7])
+        self.assertEqual(stats.check_silence(now=1054 + 60), []) # only once
+        self.assertTrue(stats.status(now=1100)['7']['silent'])
+        stats.packet(tx, 1200)
+        status = stats.status(now=1200)['7']
+        self.assertFalse(status['silent'])
+        self.assertEqual(status['alerts'], 1)
+        self.assertEqual(status['expected'], 34)
+        self.assertAlmostEqual(status['period'], 6)
+
+    def test_write(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'link_stats.json')
+            stats = LinkStats()
+            stats.packet(FakeTx(3), 1000)
+            stats.write(filename, now=1010)
+            with open(filename) as fh:
+                status = json.load(fh)
+            self.assertEqual(status['3']['received'], 1)
+            self.assertEqual(status['3']['gap'], 10)
+            self.assertEqual(os.listdir(tmp_dir), ['link_stats.json'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest, os, inspect, sys, shutil, tempfile
+import numpy as np
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import lod
+
+START = 1360396444
+DAY = 60 * 60 * 24
+
+class TestLod(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp_dir, 'labels.dat'), 'w') as fh:
+            fh.write("1 aggregate\n")
+        # Two days, every 6 seconds, with a three hour gap
+        rng = np.random.RandomState(42)
+        timestamps = np.arange(START, START + 2 * DAY, 6)
+        timestamps = timestamps[(timestamps < START + 30000) |
+                                (timestamps > START + 40800)]
+        self.timestamps = timestamps
+        self.watts = rng.randint(0, 3000, len(timestamps)).astype(float)
+        self.lines = ["{:d} {:g}{}\n".format(t, w, " 1" if i % 100 == 0 else "")
+                      for i, (t, w) in enumerate(zip(timestamps, self.watts))]
+        self.filename = os.path.join(self.tmp_dir, 'channel_1.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, lines, mode='w'):
+        with open(self.filename, mode) as fh:
+            fh.write(''.join(lines))
+
+    def assertLevelsEqual(self, a, b):
+        for field in ['start', 'count', 'min', 'max']:
+            np.testing.assert_array_equal(a[field], b[field])
+        np.testing.assert_allclose(a['mean'], b['mean'], rtol=1E-6)
+
+    def test_update(self):
+        self.write(self.lines)
+        lod.update(self.filename)
+        for exponent in lod.LEVELS:
+            seconds = 2**exponent
+            starts = self.timestamps // seconds * seconds
+            unique, first, counts = np.unique(starts, return_index=True,
+                                              return_counts=True)
+            expected = np.zeros(len(unique), dtype=lod.DTYPE)
+            expected['start'] = unique
+            expected['count'] = counts
+            expected['mean'] = np.add.reduceat(self.watts, first) / counts
+            expected['min'] = np.minimum.reduceat(self.watts, first)
+            expected['max'] = np.maximum.reduceat(self.watts, first)
+            self.assertLevelsEqual(lod._load(lod.lod_filename(self.filename,
+                                                              exponent)),
+                                   expected)
+
+    def test_incremental_update(self):
+        n = len(self.lines) * 2 // 3
+        self.write(self.lines[:n] + [self.lines[n][:8]]) # truncated line
+        lod.update(self.filename, block_size=10000)
+        self.write([self.lines[n][8:]] + self.lines[n + 1:], mode='a')
+        lod.update(self.filename, block_size=10000)
+        lod.update(self.filename) # nothing new
+        incremental = [np.array(lod._load(lod.lod_filename(self.filename, e)))
+                       for e in lod.LEVELS]
+
+        self.write(self.lines)
+        for exponent in lod.LEVELS:
+            os.remove(lod.lod_filename(self.filename, exponent))
+        lod.update(self.filename)
+        for exponent, records in zip(lod.LEVELS, incremental):
+            self.assertLevelsEqual(
+                records, lod._load(lod.lod_filename(self.filename, exponent)))
+
+    def test_query(self):
+        self.write(self.lines)
+        lod.update(self.filename)
+        self.assertEqual(lod.choose_level(2 * DAY, 100), 10)
+        self.assertEqual(lod.choose_level(100, 1000), lod.LEVELS[0])
+        self.assertEqual(lod.choose_level(365 * DAY, 1), lod.LEVELS[-1])
+
+        seconds, buckets = lod.query(self.tmp_dir, 'aggregate', width=100)
+        self.assertEqual(seconds, 2**10)
+        self.assertEqual(buckets['count'].sum(), len(self.timestamps))
+        self.assertEqual(buckets['max'].max(), self.watts.max())
+
+        start, end = START + 20000, START + 21000
+        seconds, buckets = lod.query(self.tmp_dir, 1, start, end, width=20)
+        self.assertEqual(seconds, 2**4)
+        self.assertTrue(buckets['start'][0] <= start < buckets['start'][0] + 16)
+        self.assertTrue(buckets['start'][-1] <= end)
+        self.assertEqual(len(lod.query(self.tmp_dir, 1, START + 31000,
+                                       START + 32000)[1]), 0) # in the gap
+
+if __name__ == '__main__':
+    unittest.main()
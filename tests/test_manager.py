@@ -1,4 +1,4 @@
-import unittest, os, inspect, ConfigParser, sys
+import unittest, os, inspect, ConfigParser, sys, pickle, shutil, tempfile
 
 # Hack to allow us to import ../rfm_ecomanager_logger
 # Take from http://stackoverflow.com/a/6098238/732596
@@ -9,6 +9,10 @@ RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
 if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
     sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
 import rfm_ecomanager_logger as rfm
+from sensor import Sensor
+import rollup, reader
+from transmitter import Cc_trx
+from nanode import NanodeRestart
 
 TEMP_OUTPUT_PATH = os.path.join(FILE_PATH, 'temp_output')
 
@@ -18,6 +22,21 @@ class Args(object):
         if not os.path.exists(TEMP_OUTPUT_PATH):
             os.mkdir(TEMP_OUTPUT_PATH)
 
+class FakeNanode(object):
+    def __init__(self, port):
+        self.port = port
+        self.commands = []
+        self.restart_on = None # command which makes the Nanode restart
+
+    def send_command(self, cmd, param=None, flush=True):
+        self.commands.append((cmd, param))
+        if cmd == self.restart_on:
+            self.restart_on = None
+            raise NanodeRestart()
+
+    def init_nanode(self):
+        self.commands.append(('init', None))
+
 class TestManager(unittest.TestCase):
     def setUp(self):
         self.m = rfm.Manager(None, Args())
@@ -31,5 +50,154 @@ class TestManager(unittest.TestCase):
         self.assertEqual(tz, 'Europe/London')
         os.remove(metadata_filename)
 
+    def test_multiple_base_units(self):
+        nanodes = [FakeNanode('/dev/ttyUSB0'), FakeNanode('/dev/ttyUSB1')]
+        m = rfm.Manager(nanodes, Args())
+        self.assertTrue(m.nanode is nanodes[0])
+        m.transmitters = {}
+        m._add_transmitter(10, 'TX')
+        m._add_transmitter(11, 'TRX')
+        m.transmitters[11].base_unit = '/dev/ttyUSB1'
+        self.assertTrue(m.transmitters[11].nanode is nanodes[1])
+
+        m._tell_nanode_about_transmitters(nanodes[1])
+        self.assertEqual(nanodes[1].commands,
+                         [('d', None), ('D', None), ('S', 1), ('N', 11)])
+
+    def test_reload(self):
+        nanode = FakeNanode('/dev/ttyUSB0')
+        m = rfm.Manager([nanode], Args())
+        m.args.data_directory = tempfile.mkdtemp()
+        m.args.pickle_file = os.path.join(m.args.data_directory, 'radioIDs.pkl')
+        m.transmitters = {}
+        for tx_id, tx_type, log_chan, name in [(10, 'TX', 1, 'aggregate'),
+                                               (11, 'TRX', 2, 'kettle')]:
+            m._add_transmitter(tx_id, tx_type)
+            tx = m.transmitters[tx_id]
+            tx.sensors[1] = Sensor()
+            tx.sensors[1].name = name
+            tx.sensors[1].log_chan = log_chan
+            tx.sensors[1].update_filename(tx)
+        m._pickle()
+        kettle = m.transmitters[11].sensors[1]
+        kettle.last_logged_timecode = 1360396444
+
+        # Edit the registry as the editing mode would
+        with open(m.args.pickle_file, 'rb') as fh:
+            edited = pickle.load(fh)
+        for tx in edited.itervalues():
+            tx.unpickle(m)
+        del edited[10]
+        edited[11].sensors[1].name = 'toaster'
+        edited[12] = Cc_trx(12, m)
+        edited[12].base_unit = '/dev/ttyUSB0'
+        edited[12].sensors[1].name = 'lamp'
+        edited[12].sensors[1].log_chan = 3
+        with open(m.args.pickle_file, 'wb') as fh:
+            pickle.dump(edited, fh)
+
+        m.reload()
+        self.assertEqual(sorted(m.transmitters), [11, 12])
+        self.assertTrue(m.transmitters[11].sensors[1] is kettle)
+        self.assertEqual(kettle.name, 'toaster')
+        self.assertEqual(kettle.last_logged_timecode, 1360396444)
+        with open(os.path.join(m.args.data_directory, 'labels.dat')) as fh:
+            self.assertEqual(fh.read(), "2 toaster\n3 lamp\n")
+
+        # Nanode commands are sent from the base unit's thread
+        self.assertEqual(nanode.commands, [])
+        m._run_base_unit_queue(nanode)
+        self.assertEqual(nanode.commands, [('r', 10), ('N', 12)])
+
+        # A failing function doesn't stop the queue or the base unit thread
+        def fail(nanode):
+            raise ValueError("oops")
+        m.run_on_base_unit(nanode.port, fail)
+        m.run_on_base_unit(nanode.port, lambda nanode: nanode.send_command('x'))
+        m._run_base_unit_queue(nanode)
+        self.assertEqual(nanode.commands[-1], ('x', None))
+
+        # The Nanode restarts part way through an update, so it's
+        # initialised and told about every transmitter
+        nanode.commands = []
+        nanode.restart_on = 'R'
+        m.run_on_base_unit(nanode.port, m._update_base_unit_func(
+            [m.transmitters[12]], [], []))
+        m._run_base_unit_queue(nanode)
+        self.assertEqual(nanode.commands,
+                         [('R', 12), ('init', None), ('d', None), ('D', None),
+                          ('S', 2), ('N', 11), ('N', 12)])
+        shutil.rmtree(m.args.data_directory)
+
+    def test_resume(self):
+        base_dir = tempfile.mkdtemp()
+        old_data_dir = os.environ.get('DATA_DIR')
+        os.environ['DATA_DIR'] = base_dir
+        try:
+            for subdir, labels in [('000', "1 aggregate\n"),
+                                   ('001', "1 aggregate\n2 kettle\n")]:
+                os.mkdir(os.path.join(base_dir, subdir))
+                with open(os.path.join(base_dir, subdir, 'labels.dat'), 'w') as fh:
+                    fh.write(labels)
+            latest = os.path.join(base_dir, '001')
+            with open(os.path.join(latest, 'channel_2.dat'), 'w') as fh:
+                fh.write("1360396444 100\n1360396450 120 1\n136039") # power cut
+
+            m = rfm.Manager([FakeNanode('/dev/ttyUSB0')], Args())
+            m.args.resume = True
+            m.transmitters = {}
+            for tx_id, tx_type, log_chan, name in [(10, 'TX', 1, 'aggregate'),
+                                                   (11, 'TRX', 2, 'kettle'),
+                                                   (12, 'TRX', 3, 'lamp')]:
+                m._add_transmitter(tx_id, tx_type)
+                tx = m.transmitters[tx_id]
+                tx.sensors[1] = Sensor()
+                tx.sensors[1].name = name
+                tx.sensors[1].log_chan = log_chan
+            m._pre_process_data_directory()
+            self.assertEqual(m.args.data_directory, latest)
+            self.assertTrue(m.resuming)
+            for tx in m.transmitters.itervalues():
+                tx.unpickle(m)
+            m._resume()
+            kettle = m.transmitters[11].sensors[1]
+            self.assertEqual(kettle.last_logged_timecode, 1360396450)
+            self.assertEqual(m.transmitters[12].sensors[1].last_logged_timecode, 0)
+            with open(kettle.filename) as fh:
+                self.assertEqual(fh.read(), "1360396444 100\n1360396450 120 1\n")
+
+            # The previous run flushed partial buckets, which the resumed
+            # run carries on
+            old_rollups = rollup.ChannelRollups(latest, 2)
+            for timecode in [1360396444, 1360396450]:
+                old_rollups.add(timecode, 100)
+            old_rollups.flush()
+            kettle = m.transmitters[11].sensors[1]
+            kettle.update_filename(m.transmitters[11])
+            for timecode in [1360396456, 1360396462, 1360396520]:
+                kettle.rollups.add(timecode, 200)
+            kettle.flush_rollups()
+            data_dir = reader.DataDirectory(latest)
+            for resolution, counts in [('1min', [4, 1]), ('1hour', [5]),
+                                       ('1day', [5])]:
+                buckets = data_dir.load_rollup(2, resolution)
+                self.assertEqual(buckets['count'].tolist(), counts)
+                self.assertEqual(len(set(buckets['start'])), len(buckets))
+
+            # A channel has been renamed, so start a new data directory
+            m.transmitters[11].sensors[1].name = 'toaster'
+            m.args.data_directory = ""
+            m.resuming = False
+            m._pre_process_data_directory()
+            self.assertEqual(m.args.data_directory,
+                             os.path.join(base_dir, '002'))
+            self.assertFalse(m.resuming)
+        finally:
+            if old_data_dir is None:
+                del os.environ['DATA_DIR']
+            else:
+                os.environ['DATA_DIR'] = old_data_dir
+            shutil.rmtree(base_dir)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,4 +1,5 @@
-import unittest, os, sys, inspect, shutil, ConfigParser
+import unittest, os, sys, inspect, shutil, tempfile, ConfigParser, logging
+import pytz
 
 # Hack to allow us to import ../scripts/merge_datasets.py
 # Take from http://stackoverflow.com/a/6098238/732596
@@ -108,6 +109,46 @@ class TestMergeDatasets(unittest.TestCase):
         shutil.move(os.path.join(DIR, 'apendee_backup.dat'),
                     os.path.join(DIR, 'apendee.dat'))
         
+    def test_append_dirty_regions(self):
+        lines = ['1 100\n', '2 5000\n', '3 200 1\n', '4 300\n', '\n',
+                 '5 garbage\n', '6 400\n', '7 50']
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            input_filename = os.path.join(tmp_dir, 'input.dat')
+            with open(input_filename, 'w') as fh:
+                fh.write(''.join(lines))
+            filtered = lambda line: md.remove_values_above(4090, line)
+            for block_size in [7, 1000]:
+                regions = md.find_dirty_regions(input_filename, 4090, True,
+                                                block_size=block_size)
+                offsets = [sum(len(line) for line in lines[:i])
+                           for i in range(len(lines) + 1)]
+                self.assertEqual(regions, [(offsets[1], offsets[3]),
+                                           (offsets[4], offsets[6]),
+                                           (offsets[7], offsets[8])])
+            self.assertEqual(md.find_dirty_regions(input_filename, 10**6, False),
+                             [(offsets[4], offsets[6]), (offsets[7], offsets[8])])
+
+            outputs = []
+            for dirty_regions in [None, regions]:
+                output_filename = os.path.join(tmp_dir, 'channel_1.dat')
+                md.append_files(input_filename, output_filename, filtered,
+                                move_button_press_data=True,
+                                dirty_regions=dirty_regions)
+                with open(output_filename) as fh:
+                    outputs.append(fh.read())
+                with open(os.path.join(tmp_dir, 'channel_1_button_press.dat')) as fh:
+                    outputs.append(fh.read())
+                for filename in os.listdir(tmp_dir):
+                    if filename.startswith('channel_1'):
+                        os.remove(os.path.join(tmp_dir, filename))
+            # A blank line ends the input file
+            self.assertEqual(outputs[0], '1 100\n3 200\n4 300\n')
+            self.assertEqual(outputs[1], '3 1\n')
+            self.assertEqual(outputs[:2], outputs[2:])
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_get_timestamp_range(self):
         DIR = os.path.join(BASE_TEST_DATA_DIR, '001')
         dataset = md.Dataset(DIR)
@@ -150,5 +191,25 @@ class TestMergeDatasets(unittest.TestCase):
         dst = md.merge_metadata(dst, src)
         self.assertEqual(dst.get('datetime', 'timezone'), 'TEST_CHANGE')
 
+    def test_report_coverage(self):
+        # One hour gap in the aggregate channel
+        timestamps = (range(1360396440, 1360400040, 6) +
+                      range(1360403640, 1360407240, 6))
+        coverages = {1: md.coverage_index.Coverage.from_timestamps(timestamps)}
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        level = md.log.level
+        md.log.addHandler(handler)
+        md.log.setLevel(logging.INFO)
+        try:
+            md.report_coverage(coverages, {1: 'aggregate'},
+                               pytz.timezone('Europe/London'))
+        finally:
+            md.log.removeHandler(handler)
+            md.log.setLevel(level)
+        self.assertIn("  09/02/2013 08:54:00 GMT - 09/02/2013 09:54:00 GMT"
+                      " (1:00:00)", messages)
+
 if __name__ == "__main__":
     unittest.main()
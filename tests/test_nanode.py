@@ -0,0 +1,184 @@
+import unittest, os, inspect, sys, time
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import emulator
+import framing
+import discovery
+from nanode import Nanode, SerialReader
+
+class Args(object):
+    def __init__(self, binary):
+        self.binary = binary
+        self.time_correction = True
+
+def reader(data):
+    """Returns a function like serial.Serial.read which reads from data."""
+    remaining = [data]
+    def read(n):
+        chunk, remaining[0] = remaining[0][:n], remaining[0][n:]
+        return chunk
+    return read
+
+class TestFraming(unittest.TestCase):
+
+    def test_round_trip(self):
+        records = [{'t': 12345, 'id': 99, 'type': 'tx',
+                    'sensors': {'1': 300, '2': 0, '3': 65535}},
+                   {'t': 2**32 - 1, 'id': 7, 'type': 'trx',
+                    'sensors': {'1': 50}, 'state': 0},
+                   {'pr': {'id': 8, 'type': 'trx'}},
+                   {'pw': {'id': 8, 'type': 'trx'}}]
+        for record in records:
+            frame = framing.encode(record)
+            self.assertEqual(frame[:1], framing.SYNC)
+            self.assertEqual(framing.read_frame(reader(frame[1:])), record)
+
+    def test_corrupt(self):
+        frame = bytearray(framing.encode({'t': 1, 'id': 2, 'sensors': {'1': 3}}))
+        frame[5] ^= 0xFF
+        self.assertRaises(framing.FrameError, framing.read_frame,
+                          reader(bytes(frame[1:])))
+        self.assertRaises(framing.FrameError, framing.read_frame,
+                          reader(bytes(frame[1:-3]))) # truncated
+        self.assertRaises(framing.FrameError, framing.encode,
+                          {'t': 1, 'id': 2, 'sensors': {'1': 70000}})
+
+class TestNanode(unittest.TestCase):
+
+    def read_packets(self, binary, binary_supported=True):
+        device = emulator.get_device('test_nanode')
+        device.binary_supported = binary_supported
+        nanode = Nanode(Args(binary), 'emulator:test_nanode')
+        try:
+            # send_command() flushes the input, so send commands first
+            nanode.send_command('n', 99)
+            nanode.send_command('N', 7)
+            nanode.send_command('0', 7)
+            nanode.send_command('p', 8) # acknowledgement goes to the backlog
+            device.transmit(99, 'tx', {1: 300, 2: 40})
+            device.transmit(123, 'tx', {1: 10}) # unknown so not printed
+            device.transmit(7, 'trx', {1: 0}) # reports the state it was switched to
+            device.transmit(7, 'trx', {1: 50}, state=1)
+            data = [nanode.read_sensor_data() for i in range(4)]
+            return nanode.binary, data
+        finally:
+            nanode.close()
+
+    def check_packets(self, data):
+        now = time.time()
+        pair_ack, tx, trx_off, trx = data
+        self.assertEqual((tx.tx_id, tx.tx_type, tx.sensors),
+                         (99, 'tx', {'1': 300, '2': 40}))
+        self.assertTrue(abs(tx.timecode - now) <= 2)
+        self.assertEqual((trx.tx_id, trx.state, trx.sensors), (7, 1, {'1': 50}))
+        self.assertEqual((trx_off.tx_id, trx_off.state), (7, 0))
+        self.assertTrue(pair_ack.pair_ack)
+        self.assertEqual(pair_ack.tx_id, 8)
+
+    def test_json(self):
+        binary, data = self.read_packets(binary=False)
+        self.assertFalse(binary)
+        self.check_packets(data)
+
+    def test_binary(self):
+        binary, data = self.read_packets(binary=True)
+        self.assertTrue(binary)
+        self.check_packets(data)
+
+    def test_binary_not_supported(self):
+        binary, data = self.read_packets(binary=True, binary_supported=False)
+        self.assertFalse(binary)
+        self.check_packets(data)
+
+    def test_corrupt_frame_skipped(self):
+        device = emulator.get_device('test_corrupt')
+        nanode = Nanode(Args(True), 'emulator:test_corrupt')
+        try:
+            nanode.send_command('n', 99)
+            frame = bytearray(framing.encode({'t': 1, 'id': 99, 'type': 'tx',
+                                              'sensors': {'1': 1}}))
+            frame[-1] ^= 0xFF
+            device.inject(bytes(frame))
+            device.transmit(99, 'tx', {1: 2})
+            self.assertEqual(nanode.read_sensor_data().sensors, {'1': 2})
+        finally:
+            nanode.close()
+
+    def test_backlog_is_returned_in_order(self):
+        device = emulator.get_device('test_backlog')
+        nanode = Nanode(Args(False), 'emulator:test_backlog')
+        try:
+            nanode.send_command('N', 7)
+            # A packet arrives during a command (e.g. a switch-back) and
+            # goes to the backlog...
+            device.transmit(7, 'trx', {1: 10})
+            nanode.send_command('1', 7, flush=False)
+            # ...and then another arrives just before the reply to 't'
+            time.sleep(0.02)
+            device.hold(0.02)
+            device.transmit(7, 'trx', {1: 20})
+            nanode._deadline_to_update_time_offset = 0
+            first, second = [nanode.read_sensor_data() for i in range(2)]
+            self.assertEqual([first.sensors, second.sensors],
+                             [{'1': 10}, {'1': 20}])
+            now = time.time()
+            for data in first, second:
+                self.assertTrue(abs(data.timecode - now) <= 2)
+        finally:
+            nanode.close()
+
+    def test_pair_acks_are_kept(self):
+        nanode = Nanode(Args(False), 'emulator:test_pair')
+        try:
+            # Each ack arrives after its command's ACK, so it's waiting
+            # when the next pair command is sent
+            self.assertEqual(discovery.pair_all(nanode, [8, 9, 10], timeout=1,
+                                                rounds=1),
+                             {8: 'TRX', 9: 'TRX', 10: 'TRX'})
+        finally:
+            nanode.close()
+
+class CountingSerial(emulator.FakeSerial):
+    def __init__(self, device, timeout):
+        super(CountingSerial, self).__init__(device, 'emulator:test_reader',
+                                             timeout)
+        self.reads = 0
+
+    def read(self, size=1):
+        self.reads += 1
+        return super(CountingSerial, self).read(size)
+
+class TestSerialReader(unittest.TestCase):
+
+    def test_bulk_reads(self):
+        device = emulator.get_device('test_reader')
+        port = CountingSerial(device, timeout=0.2)
+        reader = SerialReader(port)
+        device.inject(b'ACK\r\n{"t":1,"id":2}\r\n{"t":2,')
+        self.assertEqual(reader.read(), 'ACK')
+        self.assertEqual(reader.read(), '{"t":1,"id":2}')
+        self.assertEqual(port.reads, 1)
+        self.assertTrue(reader.data_waiting()) # the partial line
+
+        start = time.time()
+        self.assertEqual(reader.read(), '') # timed out
+        self.assertTrue(0.2 <= time.time() - start < 1)
+        device.inject(b'"id":3}\r\n')
+        self.assertEqual(reader.read(), '{"t":2,"id":3}')
+        self.assertFalse(reader.data_waiting())
+
+        device.inject(b'{"t":3,"i')
+        reader.read()
+        reader.flush()
+        device.inject(b'NAK\r\n')
+        self.assertEqual(reader.read(), 'NAK')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest, os, inspect, sys, shutil, tempfile
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import reader
+
+BASE_TEST_DATA_DIR = os.path.join(FILE_PATH, 'test_data')
+
+class TestReader(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        for chan in [1, 2, 13]:
+            shutil.copy(os.path.join(BASE_TEST_DATA_DIR, '002',
+                                     'channel_{:d}.dat'.format(chan)),
+                        self.data_dir)
+        with open(os.path.join(self.data_dir, 'labels.dat'), 'w') as fh:
+            fh.write('1 aggregate / agg\n2 boiler\n13 microwave\n')
+        reader.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_resolve(self):
+        dd = reader.DataDirectory(self.data_dir)
+        self.assertEqual(dd.resolve('aggregate'), 1)
+        self.assertEqual(dd.resolve('agg'), 1)
+        self.assertEqual(dd.resolve(13), 13)
+        self.assertRaises(reader.ReaderError, dd.resolve, 'kettle')
+
+    def test_missing_data_file(self):
+        with open(os.path.join(self.data_dir, 'labels.dat'), 'a') as fh:
+            fh.write('3 kettle\n')
+        dd = reader.DataDirectory(self.data_dir)
+        self.assertRaises(reader.ReaderError, dd.load, 'kettle')
+
+    def test_load(self):
+        dd = reader.DataDirectory(self.data_dir)
+        agg = dd.load('agg')
+        with open(dd.filename(1)) as fh:
+            lines = fh.readlines()
+        self.assertEqual(len(agg), len(lines))
+        self.assertEqual(agg.timestamps[0], float(lines[0].split()[0]))
+        self.assertEqual(agg.watts[-1], float(lines[-1].split()[1]))
+        self.assertEqual(agg.label, 'aggregate')
+        self.assertTrue(dd.load(1) is agg) # cached
+
+    def test_load_with_button_presses(self):
+        with open(os.path.join(self.data_dir, 'channel_2.dat'), 'w') as fh:
+            fh.write('10 5\n16 0 0\n22 0\n28 7 1\n34 8')
+        boiler = reader.DataDirectory(self.data_dir).load('boiler')
+        self.assertEqual(list(boiler.timestamps), [10, 16, 22, 28])
+        self.assertEqual(list(boiler.states), [-1, 0, -1, 1])
+
+    def test_index_range(self):
+        dd = reader.DataDirectory(self.data_dir)
+        full = dd.load(13)
+        start, end = full.timestamps[100], full.timestamps[2000]
+        expected = dd.load(13, start, end)
+        reader.clear_cache()
+        reader.build_index(dd.filename(13), stride=64)
+        self.assertEqual(reader._byte_range(dd.filename(13),
+                                            os.path.getsize(dd.filename(13)),
+                                            start, end)[0] > 0, True)
+        indexed = dd.load(13, start, end)
+        self.assertEqual(list(indexed.timestamps), list(expected.timestamps))
+        self.assertEqual(indexed.timestamps[0], start)
+        self.assertEqual(indexed.timestamps[-1], end)
+
+    def test_load_many(self):
+        dd = reader.DataDirectory(self.data_dir)
+        channels = dd.load_many(processes=2)
+        self.assertEqual(sorted(channels.keys()), [1, 2, 13])
+        self.assertEqual(len(channels[2]), len(dd.load('boiler')))
+
+if __name__ == "__main__":
+    unittest.main()
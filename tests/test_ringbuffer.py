@@ -0,0 +1,61 @@
+import unittest, os, inspect, sys, shutil, tempfile
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import ringbuffer
+
+class TestRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.ring')
+        self.writer = ringbuffer.RingWriter(self.filename,
+                                            {1: 'aggregate', 5: 'kettle'},
+                                            capacity=4)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_and_snapshot(self):
+        reader = ringbuffer.RingReader(self.filename)
+        self.assertEqual(reader.labels(), {1: 'aggregate', 5: 'kettle'})
+        self.assertEqual(len(reader.snapshot(5)), 0)
+        self.assertEqual(reader.latest(5), None)
+
+        for t in range(6):
+            self.writer.write(100 + t, 5, 10 * t, 1 if t == 3 else None)
+        self.writer.write(100, 99, 1) # unknown channel is ignored
+
+        samples = reader.snapshot(5)
+        self.assertEqual(list(samples['timestamp']), [102, 103, 104, 105])
+        self.assertEqual(list(samples['state']), [-1, 1, -1, -1])
+        self.assertEqual(reader.latest(5)['watts'], 50)
+        self.assertEqual(len(reader.snapshot(1)), 0)
+        reader.close()
+
+    def test_views_are_zero_copy_and_seqlocked(self):
+        reader = ringbuffer.RingReader(self.filename)
+        self.writer.write(100, 1, 250)
+        seq, older, newer = reader.views(1)
+        self.assertEqual(older['watts'][0], 250)
+        self.assertTrue(reader.seq_unchanged(1, seq))
+        self.writer.write(106, 1, 260)
+        self.assertFalse(reader.seq_unchanged(1, seq))
+        reader.close()
+
+    def test_replaced_file_is_stale(self):
+        reader = ringbuffer.RingReader(self.filename)
+        self.assertFalse(reader.is_stale())
+        ringbuffer.RingWriter(self.filename, {1: 'aggregate'}).close()
+        self.assertTrue(reader.is_stale())
+        reader.close()
+
+if __name__ == "__main__":
+    unittest.main()
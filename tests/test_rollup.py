@@ -0,0 +1,73 @@
+import unittest, os, inspect, sys, shutil, tempfile
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import rollup
+
+def read_records(filename):
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    return [rollup.unpack(data[i:i+rollup.RECORD.size])
+            for i in range(0, len(data), rollup.RECORD.size)]
+
+class TestRollup(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_minute_and_hour_buckets(self):
+        r = rollup.ChannelRollups(self.data_dir, 1)
+        # 100 W for the whole of the first hour, sampled every 6 seconds
+        for t in range(3600, 7200, 6):
+            r.add(t, 100)
+        r.add(7200, 200) # closes the first hour
+        r.flush()
+
+        minutes = read_records(rollup.rollup_filename(self.data_dir, 1, '1min'))
+        self.assertEqual(len(minutes), 61)
+        self.assertEqual(minutes[0].start, 3600)
+        self.assertEqual(minutes[0].count, 10)
+        self.assertAlmostEqual(minutes[0].energy, 100 * 60)
+
+        hours = read_records(rollup.rollup_filename(self.data_dir, 1, '1hour'))
+        self.assertEqual([h.start for h in hours], [3600, 7200])
+        self.assertEqual(hours[0].count, 600)
+        self.assertAlmostEqual(hours[0].energy / 3600, 100) # 100 Wh
+        self.assertEqual(hours[1].min, 200)
+
+        days = read_records(rollup.rollup_filename(self.data_dir, 1, '1day'))
+        self.assertEqual(len(days), 1)
+        self.assertEqual(days[0].count, 601)
+
+    def test_append_rollup_file_combines_same_bucket(self):
+        first = rollup.ChannelRollups(self.data_dir, 1)
+        for t in range(0, 30, 6):
+            first.add(t, 10)
+        first.flush()
+        second = rollup.ChannelRollups(self.data_dir, 2)
+        for t in range(30, 130, 6):
+            second.add(t, 20)
+        second.flush()
+
+        output = os.path.join(self.data_dir, 'out.rollup')
+        rollup.append_rollup_file(rollup.rollup_filename(self.data_dir, 1, '1min'),
+                                  output)
+        rollup.append_rollup_file(rollup.rollup_filename(self.data_dir, 2, '1min'),
+                                  output)
+        records = read_records(output)
+        self.assertEqual([r.start for r in records], [0, 60, 120])
+        self.assertEqual(records[0].count, 10)
+        self.assertEqual(records[0].min, 10)
+        self.assertEqual(records[0].max, 20)
+
+if __name__ == "__main__":
+    unittest.main()
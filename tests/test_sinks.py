@@ -0,0 +1,127 @@
+import unittest, os, inspect, sys, shutil, tempfile, sqlite3, socket, errno, time
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import sinks
+
+RECORDS = [(100, 1, 250, None), (101, 2, 30, 1), (106, 1, 260, None)]
+
+class FailingSink(sinks.Sink):
+    NAME = "failing"
+
+    def write_batch(self, records):
+        raise IOError("disk on fire")
+
+class FlakyReddSink(sinks.ReddSink):
+    """Fails to open channel 2's file the first time."""
+    failed = False
+
+    def filename(self, log_chan):
+        if log_chan == 2 and not self.failed:
+            self.failed = True
+            raise IOError("disk on fire")
+        return super(FlakyReddSink, self).filename(log_chan)
+
+class PartialSocket(object):
+    """Sends the first n_bytes and then fails."""
+    def __init__(self, n_bytes):
+        self.n_bytes = n_bytes
+        self.sent = ""
+
+    def send(self, data):
+        if len(self.sent) >= self.n_bytes:
+            raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+        data = data[:self.n_bytes - len(self.sent)]
+        self.sent += data
+        return len(data)
+
+    def close(self):
+        pass
+
+class TestSinks(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def run_sinks(self, *sink_list):
+        dispatcher = sinks.SinkDispatcher()
+        for sink in sink_list:
+            dispatcher.add(sink)
+        dispatcher.start()
+        for record in RECORDS:
+            dispatcher.submit(record)
+        dispatcher.stop()
+
+    def test_redd_sink(self):
+        self.run_sinks(sinks.create_sink('redd', self.data_dir))
+        with open(os.path.join(self.data_dir, 'channel_1.dat')) as fh:
+            self.assertEqual(fh.read(), '100 250\n106 260\n')
+        with open(os.path.join(self.data_dir, 'channel_2.dat')) as fh:
+            self.assertEqual(fh.read(), '101 30 1\n')
+
+    def test_sqlite_sink(self):
+        sink = sinks.create_sink('sqlite,flush=0.1', self.data_dir)
+        self.assertEqual(sink.flush_interval, 0.1)
+        self.run_sinks(sink)
+        connection = sqlite3.connect(os.path.join(self.data_dir, 'readings.sqlite'))
+        rows = connection.execute("SELECT * FROM readings ORDER BY timestamp").fetchall()
+        self.assertEqual(rows, [(1, 100, 250), (2, 101, 30), (1, 106, 260)])
+        rows = connection.execute("SELECT * FROM button_presses").fetchall()
+        self.assertEqual(rows, [(2, 101, 1)])
+
+    def test_failing_sink_is_isolated(self):
+        failing = FailingSink(buffer_size=2)
+        redd = sinks.ReddSink(self.data_dir)
+        self.run_sinks(failing, redd)
+        self.assertEqual(failing.queue_depth(), 2)
+        self.assertEqual(failing.dropped, 1)
+        self.assertTrue(os.path.exists(redd.filename(1)))
+
+    def test_partial_failure_is_not_written_twice(self):
+        sink = FlakyReddSink(self.data_dir, flush_interval=0.01)
+        sink.start()
+        for record in RECORDS:
+            sink.submit(record)
+        deadline = time.time() + 5
+        while (sink.queue_depth() or not sink.last_write_time) and \
+              time.time() < deadline:
+            time.sleep(0.01)
+        sink.stop()
+        self.assertEqual(sink.failures, 1)
+        with open(sink.filename(1)) as fh:
+            self.assertEqual(fh.read(), '100 250\n106 260\n')
+        with open(sink.filename(2)) as fh:
+            self.assertEqual(fh.read(), '101 30 1\n')
+
+    def test_socket_sink_resends_unsent_lines(self):
+        sink = sinks.SocketSink(('localhost', 9))
+        sink._socket = PartialSocket(n_bytes=len('100 1 250\n101 2'))
+        try:
+            sink.write_batch(RECORDS)
+        except socket.error as e:
+            self.assertEqual(e.unwritten, RECORDS[1:])
+        else:
+            self.fail("expected socket.error")
+        self.assertIsNone(sink._socket)
+
+    def test_overflow_policies(self):
+        newest = FailingSink(buffer_size=2, overflow=sinks.DROP_NEWEST)
+        oldest = FailingSink(buffer_size=2)
+        for record in RECORDS:
+            newest.submit(record)
+            oldest.submit(record)
+        self.assertEqual(list(newest._buffer), RECORDS[:2])
+        self.assertEqual(list(oldest._buffer), RECORDS[1:])
+        self.assertRaises(sinks.SinkError, sinks.create_sink, 'ftp', self.data_dir)
+
+if __name__ == "__main__":
+    unittest.main()
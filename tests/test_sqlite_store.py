@@ -0,0 +1,53 @@
+import unittest, os, inspect, sys, shutil, tempfile
+
+# Hack to allow us to import ../scripts/import_sqlite.py
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+SCRIPTS_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH, '..', 'scripts'))
+if SCRIPTS_SUBFOLDER not in sys.path:
+    sys.path.insert(0, SCRIPTS_SUBFOLDER)
+import import_sqlite
+import sqlite_store
+
+BASE_TEST_DATA_DIR = os.path.join(FILE_PATH, 'test_data')
+TARGET_LABELS_FILENAME = os.path.join(FILE_PATH, 'target_labels', 'labels.dat')
+
+class TestSqliteStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = sqlite_store.Store(os.path.join(self.tmp_dir, 'test.sqlite'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_insert_and_query(self):
+        self.store.set_label(7, ['tv', 'television'])
+        self.store.insert([(100, 7, 50, None), (106, 7, 55, 1), (112, 7, 0, 0)])
+        self.assertEqual(self.store.resolve('television'), 7)
+        self.assertEqual(self.store.query('tv', 101, 112), ([106, 112], [55, 0]))
+        self.assertEqual(self.store.button_presses(7), [(106, 1), (112, 0)])
+        self.assertRaises(sqlite_store.StoreError, self.store.resolve, 'kettle')
+
+    def test_import_data_dirs(self):
+        channel_map = import_sqlite.ChannelMap(self.store)
+        channel_map.add_labels(import_sqlite.reader.load_labels_file(
+                                   TARGET_LABELS_FILENAME))
+        for data_dir in ['001', '002']:
+            import_sqlite.import_data_dir(os.path.join(BASE_TEST_DATA_DIR, data_dir),
+                                          self.store, channel_map)
+        # breadmaker is channel 16 in 001 and 002 but 15 in the template
+        self.assertEqual(self.store.resolve('breadmaker'), 15)
+        # amp_livingroom and adsl_router aren't in the template
+        # so they are given the next free channels
+        self.assertEqual(self.store.resolve('amp_livingroom'), 18)
+        self.assertEqual(self.store.resolve('adsl_router'), 19)
+        timestamps, watts = self.store.query('aggregate')
+        with open(os.path.join(BASE_TEST_DATA_DIR, '001', 'channel_1.dat')) as fh:
+            first_line = fh.readline().split()
+        self.assertEqual(timestamps[0], int(first_line[0]))
+        self.assertEqual(watts[0], float(first_line[1]))
+
+if __name__ == "__main__":
+    unittest.main()
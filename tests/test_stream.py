@@ -0,0 +1,69 @@
+import unittest, os, inspect, sys, shutil, tempfile, time, socket, errno
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import stream, sinks
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.address = 'unix:' + os.path.join(self.tmp_dir, 'stream.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_encode_decode(self):
+        datagram = (stream.encode(1360396444, 3, 1500, None, 'kettle') +
+                    stream.encode(1360396445, 4, 20, 1, 'tv'))
+        readings = stream.decode(datagram)
+        self.assertEqual(readings[0], (1360396444, 3, 'kettle', 1500, None))
+        self.assertEqual(readings[1].state, 1)
+        self.assertRaises(stream.StreamError, stream.decode, datagram[:-10])
+
+    def test_publish_immediately(self):
+        subscriber = stream.Subscriber(self.address)
+        sink = sinks.create_sink('stream:' + self.address, self.tmp_dir,
+                                 {3: 'kettle'})
+        sink.start()
+        sink.submit((1360396444, 3, 1500, None))
+        self.assertEqual(subscriber.receive(timeout=1),
+                         [(1360396444, 3, 'kettle', 1500, None)])
+        sink.stop()
+        subscriber.close()
+
+    def test_coalesce_and_no_subscriber(self):
+        sink = stream.StreamSink(self.address, flush_interval=0.05)
+        sink.start()
+        sink.submit((1, 1, 1, None)) # nobody is listening
+        time.sleep(0.2)
+        self.assertEqual(sink.dropped, 1)
+        subscriber = stream.Subscriber(self.address)
+        for i in range(3):
+            sink.submit((i, 1, 1, None))
+        self.assertEqual(len(subscriber.receive(timeout=1)), 3)
+        sink.stop()
+        subscriber.close()
+
+    def test_send_errors_are_dropped(self):
+        class FailingSocket(object):
+            def sendto(self, datagram, address):
+                raise socket.error(errno.EACCES, 'Permission denied')
+            def close(self):
+                pass
+        sink = stream.StreamSink(self.address)
+        sink._socket = FailingSocket()
+        sink.start()
+        for i in range(3):
+            sink.submit((i, 1, 1, None))
+        self.assertEqual(sink.dropped, 3)
+        sink.stop()
+
+if __name__ == "__main__":
+    unittest.main()
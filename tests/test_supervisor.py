@@ -0,0 +1,90 @@
+import unittest, os, inspect, sys, shutil, tempfile, threading, time
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+import supervisor, heartbeat, metrics, sinks, switchback
+
+# Writes one heartbeat which is already 100 s old and then hangs
+HUNG_LOGGER = """
+import sys, os, time, json
+filename = sys.argv[sys.argv.index('--heartbeat') + 1]
+with open(filename, 'w') as fh:
+    json.dump({'pid': os.getpid(), 'time': time.time() - 100}, fh)
+time.sleep(60)
+"""
+
+class FakeManager(object):
+    def __init__(self):
+        self.metrics = metrics.Metrics()
+        self.metrics.add_base_unit('/dev/ttyUSB0')
+        self.sinks = sinks.SinkDispatcher()
+        self.switch_back = switchback.SwitchBackScheduler()
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_heartbeat(self):
+        manager = FakeManager()
+        manager.metrics.loop_iteration('/dev/ttyUSB0')
+        manager.metrics.packet_received('/dev/ttyUSB0', 1360396444)
+        filename = os.path.join(self.run_dir, 'heartbeat.json')
+        heartbeat.Heartbeat(filename, manager).beat()
+        state = heartbeat.read_json(filename)
+        self.assertEqual(state['pid'], os.getpid())
+        self.assertEqual(state['last_packet_time'], 1360396444)
+        self.assertEqual(state['queue_depth'], 0)
+        self.assertEqual(state['base_units']['/dev/ttyUSB0']['packets'], 1)
+        self.assertEqual(heartbeat.read_json(filename + '.missing'), None)
+
+    def test_stall_reason(self):
+        now = 1000.
+        def reason(hb, started=900.):
+            return supervisor.stall_reason(hb, 42, started, now, 1, 30, 60)
+        healthy = {'pid': 42, 'time': now - 0.5,
+                   'base_units': {'/dev/ttyUSB0': {'last_loop_time': now - 5}}}
+        self.assertEqual(reason(healthy), None)
+        self.assertEqual(reason(None, started=990.), None)
+        self.assertIn("no heartbeat", reason(None))
+        self.assertIn("no heartbeat", reason(dict(healthy, pid=7)))
+        self.assertIn("last heartbeat", reason(dict(healthy, time=now - 10)))
+        stuck = {'/dev/ttyUSB0': {'last_loop_time': now - 40}}
+        self.assertIn("stuck", reason(dict(healthy, base_units=stuck)))
+
+    def run_supervisor(self, command, until):
+        sup = supervisor.Supervisor(command, self.run_dir, heartbeat_interval=0.5,
+                                    startup_timeout=5)
+        thread = threading.Thread(target=sup.run)
+        thread.start()
+        deadline = time.time() + 10
+        while not until(sup) and time.time() < deadline:
+            time.sleep(0.1)
+        sup.abort = True
+        thread.join()
+        return sup
+
+    def test_restarts_crashed_logger(self):
+        sup = self.run_supervisor([sys.executable, '-c', 'import sys; sys.exit(3)'],
+                                  lambda sup: sup.restarts >= 1)
+        self.assertEqual(sup.last_restart_reason, "logger exited with code 3")
+        state = heartbeat.read_json(os.path.join(self.run_dir, 'supervisor.json'))
+        self.assertEqual(state['supervisor_pid'], None)
+        self.assertEqual(state['restarts'], sup.restarts)
+
+    def test_restarts_stalled_logger(self):
+        sup = self.run_supervisor([sys.executable, '-c', HUNG_LOGGER],
+                                  lambda sup: sup.restarts >= 1)
+        self.assertIn("last heartbeat", sup.last_restart_reason)
+
+if __name__ == "__main__":
+    unittest.main()
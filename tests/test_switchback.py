@@ -0,0 +1,136 @@
+import unittest, os, inspect, sys
+
+# Hack to allow us to import ../rfm_ecomanager_logger
+# Take from http://stackoverflow.com/a/6098238/732596
+FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
+RFM_ECOMANAGER_LOGGER_SUBFOLDER = os.path.realpath(os.path.join(FILE_PATH,
+                                                                '..',
+                                                                'rfm_ecomanager_logger'))
+if RFM_ECOMANAGER_LOGGER_SUBFOLDER not in sys.path:
+    sys.path.insert(0, RFM_ECOMANAGER_LOGGER_SUBFOLDER)
+from switchback import SwitchBackScheduler
+from linkstats import LinkStats
+from transmitter import Cc_trx
+from nanode import Data
+
+PORT = '/dev/ttyUSB0'
+
+class FakeNanode(object):
+    def __init__(self):
+        self.port = PORT
+        self.commands = []
+        self.flushes = []
+
+    def send_command(self, cmd, param=None, flush=True):
+        self.commands.append((cmd, param))
+        self.flushes.append(flush)
+
+class FakeArgs(object):
+    switch = True
+
+class FakeManager(object):
+    def __init__(self):
+        self.args = FakeArgs()
+        self.nanode = FakeNanode()
+        self.nanodes = {PORT: self.nanode}
+        self.switch_back = SwitchBackScheduler()
+        self.link_stats = LinkStats()
+
+class FakeSensor(object):
+    name = "kettle"
+    def log_data_to_disk(self, timecode, watts, state):
+        pass
+
+def make_trx(manager, rf_id):
+    trx = Cc_trx(rf_id, manager)
+    trx.base_unit = PORT
+    trx.sensors = {1: FakeSensor()}
+    return trx
+
+def packet(timecode, state, reply_to_poll=None):
+    data = Data()
+    data.timecode = timecode
+    data.state = state
+    data.reply_to_poll = reply_to_poll
+    data.sensors = {'1': 0}
+    return data
+
+class TestSwitchBack(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = FakeManager()
+        self.scheduler = self.manager.switch_back
+        self.nanode = self.manager.nanode
+
+    def test_batches_dedupe_and_retry(self):
+        trxs = [make_trx(self.manager, rf_id) for rf_id in range(1, 7)]
+        for trx in trxs:
+            self.scheduler.request(trx, 1, now=0)
+        self.scheduler.request(trxs[0], 1, now=0) # duplicate
+        self.assertEqual(self.scheduler.pending(), 6)
+
+        self.scheduler.service(self.nanode, now=1)
+        self.assertEqual(self.nanode.commands, [('1', i) for i in range(1, 5)])
+        self.assertFalse(any(self.nanode.flushes))
+        self.scheduler.service(self.nanode, now=1.5) # too soon
+        self.assertEqual(len(self.nanode.commands), 4)
+        self.scheduler.service(self.nanode, now=2)
+        self.assertEqual(self.nanode.commands[4:], [('1', 5), ('1', 6)])
+
+        for trx in trxs[1:]:
+            self.scheduler.confirm(trx, now=10)
+        # trxs[0] didn't respond so is retried after CONFIRM_TIMEOUT...
+        self.scheduler.service(self.nanode, now=15)
+        self.assertEqual(len(self.nanode.commands), 6)
+        self.scheduler.service(self.nanode, now=16)
+        self.assertEqual(self.nanode.commands[-1], ('1', 1))
+        # ...and then backs off
+        self.scheduler.service(self.nanode, now=40)
+        self.assertEqual(len(self.nanode.commands), 7)
+        self.scheduler.service(self.nanode, now=46)
+        self.assertEqual(len(self.nanode.commands), 8)
+
+        self.scheduler.confirm(trxs[0], now=50)
+        self.assertEqual(self.scheduler.pending(), 0)
+        convergence = self.scheduler.last_convergence
+        self.assertEqual(convergence['seconds'], 50)
+        self.assertEqual(convergence['restored'], 6)
+        self.assertEqual(convergence['switches'], 8)
+
+    def test_give_up(self):
+        trx = make_trx(self.manager, 1)
+        self.scheduler.request(trx, 1, now=0)
+        now = 0
+        for i in range(SwitchBackScheduler.MAX_ATTEMPTS + 1):
+            now += SwitchBackScheduler.MAX_RETRY_INTERVAL
+            self.scheduler.service(self.nanode, now=now)
+        self.assertEqual(len(self.nanode.commands), SwitchBackScheduler.MAX_ATTEMPTS)
+        self.assertEqual(self.scheduler.pending(), 0)
+        self.assertEqual(self.scheduler.last_convergence['abandoned'], 1)
+
+    def test_trx_power_cut(self):
+        trx = make_trx(self.manager, 1)
+        trx.new_reading(packet(1000, 1))
+        # Power cut: the IAM comes back a minute later in its off state
+        trx.new_reading(packet(1060, 0))
+        self.assertEqual(self.scheduler.pending_state(trx), 1)
+        self.assertEqual(self.nanode.commands, []) # not on the ingest path
+        # Another off packet before the switch isn't a button press
+        trx.new_reading(packet(1066, 0))
+        self.assertEqual(trx.state, 1)
+        self.scheduler.service(self.nanode)
+        self.assertEqual(self.nanode.commands, [('1', 1)])
+        trx.new_reading(packet(1072, 1))
+        self.assertEqual(self.scheduler.pending(), 0)
+        self.assertEqual(self.scheduler.last_convergence['restored'], 1)
+
+    def test_button_press_cancels_restoration(self):
+        trx = make_trx(self.manager, 1)
+        trx.new_reading(packet(1000, 1))
+        trx.new_reading(packet(1060, 0))
+        trx.new_reading(packet(1066, 0, reply_to_poll=0))
+        self.assertEqual(trx.state, 0)
+        self.assertEqual(self.scheduler.pending(), 0)
+
+if __name__ == "__main__":
+    unittest.main()